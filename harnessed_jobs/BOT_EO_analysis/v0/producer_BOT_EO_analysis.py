@@ -3,54 +3,101 @@
 Producer script for BOT analyses.
 """
 from __future__ import print_function
-from multiprocessor_execution import run_device_analysis_pool
+import os
+import sys
+import functools
+import importlib
 from camera_components import camera_info
-from bot_eo_analyses import fe55_jh_task, bias_frame_jh_task, \
-    read_noise_jh_task, \
-    dark_current_jh_task, bright_defects_jh_task, dark_defects_jh_task, \
-    ptc_jh_task, flat_pairs_jh_task, bf_jh_task, \
-    cte_jh_task, tearing_jh_task, \
-    get_analysis_types, raft_jh_noise_correlations, raft_results_task
+from bot_eo_analyses import get_analysis_types
+from dag_scheduler import DeviceTaskGraph
+from device_executors import executor_backend
+from multiprocessor_execution import run_device_analysis_pool
+
+
+def import_jh_task(job_name, task_name):
+    """Import a jh_task function from its harnessed job directory."""
+    job_dir = os.path.join(os.environ['EOANALYSISJOBSDIR'], 'harnessed_jobs',
+                           job_name, 'v0')
+    if job_dir not in sys.path:
+        sys.path.insert(0, job_dir)
+    return getattr(importlib.import_module(task_name), task_name)
+
 
 # Use the all of the available cores for processing.
 processes = None
 
-task_mapping = {'gain': (fe55_jh_task,),
-                'bias': (bias_frame_jh_task,),
-                'biasnoise': (read_noise_jh_task,),
-                'dark': (dark_current_jh_task,),
-                'badpixel': (bright_defects_jh_task, dark_defects_jh_task),
-                'ptc': (ptc_jh_task,),
-                'brighterfatter': (bf_jh_task,),
-                'linearity': (flat_pairs_jh_task,),
-                'cti': (cte_jh_task,),
-                'tearing': (tearing_jh_task,)}
+task_mapping = {'gain': (('fe55_analysis_BOT', 'fe55_jh_task'),),
+                'bias': (('bias_frame_BOT', 'bias_frame_jh_task'),),
+                'biasnoise': (('read_noise_BOT', 'read_noise_jh_task'),),
+                'dark': (('dark_current_BOT', 'dark_current_jh_task'),),
+                'badpixel': (('pixel_defects_BOT', 'bright_defects_jh_task'),
+                             ('pixel_defects_BOT', 'dark_defects_jh_task')),
+                'ptc': (('ptc_BOT', 'ptc_jh_task'),),
+                'brighterfatter': (('brighter_fatter_BOT', 'bf_jh_task'),),
+                'linearity': (('flat_pairs_BOT', 'flat_pairs_jh_task'),),
+                'cti': (('cti_BOT', 'cte_jh_task'),),
+                'tearing': (('tearing_BOT', 'tearing_jh_task'),)}
 
-analysis_types = get_analysis_types()
+# Per-detector prerequisites of each analysis type: bias frames and
+# rolloff masks come from 'bias', gains from 'gain', defect masks and
+# the medianed dark from 'badpixel', and the read noise results used
+# in the total noise plots from 'biasnoise'.  Tasks for analysis types
+# within a tuple of task_mapping run in the order given.
+task_dependencies = {'gain': ('bias',),
+                     'bias': (),
+                     'biasnoise': ('gain', 'badpixel'),
+                     'dark': ('bias', 'gain', 'badpixel', 'biasnoise'),
+                     'badpixel': ('bias', 'gain'),
+                     'ptc': ('bias', 'gain', 'badpixel'),
+                     'brighterfatter': ('bias', 'gain', 'badpixel'),
+                     'linearity': ('bias', 'gain', 'badpixel'),
+                     'cti': ('bias', 'gain', 'badpixel'),
+                     'tearing': ('bias',)}
+
+analysis_types = [_ for _ in get_analysis_types() if _ in task_mapping]
+
+# Add analysis types in dependency order, keeping the order of the
+# config file otherwise.
+ordered_types = []
+while len(ordered_types) < len(analysis_types):
+    for analysis_type in analysis_types:
+        if analysis_type in ordered_types:
+            continue
+        if all(_ in ordered_types or _ not in analysis_types
+               for _ in task_dependencies[analysis_type]):
+            ordered_types.append(analysis_type)
+
+graph = DeviceTaskGraph()
 
 # Detector-level analyses
 det_names = camera_info.get_det_names()
-for analysis_type in analysis_types:
-    print("**************************************")
-    print("Running analysis type %s" % analysis_type)
-    print("**************************************")
-    if analysis_type not in task_mapping:
-        print("   not in task_mapping. skipping")
-        continue
-    tasks = task_mapping[analysis_type]
-    for task in tasks:
-        run_device_analysis_pool(task, det_names, processes=processes)
+last_tasks = dict()
+for analysis_type in ordered_types:
+    depends_on = [last_tasks[_] for _ in task_dependencies[analysis_type]
+                  if _ in last_tasks]
+    for job_name, task_name in task_mapping[analysis_type]:
+        graph.add_task(task_name, import_jh_task(job_name, task_name),
+                       det_names, depends_on=depends_on)
+        depends_on = [task_name]
+    last_tasks[analysis_type] = task_name
 
 # Raft-level analyses
 raft_names = camera_info.get_raft_names()
 if 'biasnoise' in analysis_types:
-    print("**************************************")
-    print("Running analysis type biasnoise")
-    print("**************************************")
-    run_device_analysis_pool(raft_jh_noise_correlations, raft_names,
-                             processes=processes)
-
-print("**************************************")
-print("Running raft_results_task")
-print("**************************************")
-run_device_analysis_pool(raft_results_task, raft_names, processes=processes)
+    graph.add_task('raft_jh_noise_correlations',
+                   import_jh_task('read_noise_BOT',
+                                  'raft_jh_noise_correlations'),
+                   raft_names, exclusive=False)
+
+graph.add_task('raft_results_task',
+               import_jh_task('raft_results_summary_BOT', 'raft_results_task'),
+               raft_names, depends_on=list(graph.tasks))
+
+if executor_backend() == 'multiprocessing':
+    graph.run(processes=processes)
+else:
+    # Send each task to parsl or the ssh_dispatcher over all of the
+    # devices that are ready for it, with the backend's own placement,
+    # retries, and run time and memory histories.
+    graph.run_by_task(functools.partial(run_device_analysis_pool,
+                                        processes=processes))
@@ -9,7 +9,11 @@ def bias_frame_jh_task(det_name):
     import json
     from bot_eo_analyses import glob_pattern, bias_frame_task, \
         bias_stability_task
+    from amp_tasks import split_work_item
 
+    # For an amp-level work item, e.g., 'R22_S11:3', only the bias
+    # stability analysis is done, for that amp.
+    det_name, amp = split_work_item(det_name)
     run = siteUtils.getRunNumber()
     acq_jobname = siteUtils.getProcessName('BOT_acq')
     bias_files \
@@ -31,7 +35,9 @@ def bias_frame_jh_task(det_name):
         return None
 
     bias_stability_files = sorted(bias_stability_files)
-    bias_stability_task(run, det_name, bias_stability_files)
+    bias_stability_task(run, det_name, bias_stability_files, amp=amp)
+    if amp is not None:
+        return None
 
     return bias_frame_task(run, det_name, bias_files[1:])
 
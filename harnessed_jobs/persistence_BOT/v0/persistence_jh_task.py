@@ -7,7 +7,11 @@ def persistence_jh_task(det_name):
     import siteUtils
     from bot_eo_analyses import make_file_prefix, glob_pattern, \
         bias_frame_task, get_mask_files, get_bot_eo_config, persistence_task
+    from amp_tasks import split_work_item, make_once, amp_split_enabled
 
+    # For an amp-level work item, e.g., 'R22_S11:3', only the
+    # persistence statistics for that amp are computed.
+    det_name, amp = split_work_item(det_name)
     run = siteUtils.getRunNumber()
     file_prefix = make_file_prefix(run, det_name)
 
@@ -30,12 +34,19 @@ def persistence_jh_task(det_name):
     dark_files = sorted(dark_files)
 
     # Make a superbias frame using the pre-exposure persistence bias
-    # files, skipping the first exposure.
+    # files, skipping the first exposure.  The amp-level work items
+    # for a CCD share the one made by whichever of them runs first,
+    # which is made again if the bias files have changed.
     superbias_frame = f'{file_prefix}_persistence_superbias.fits'
-    bias_frame_task(run, det_name, bias_files, bias_frame=superbias_frame)
+    if amp is None and not amp_split_enabled('persistence_jh_task'):
+        bias_frame_task(run, det_name, bias_files, bias_frame=superbias_frame)
+    else:
+        make_once(superbias_frame, bias_frame_task, run, det_name,
+                  bias_files, bias_frame=superbias_frame,
+                  input_files=bias_files)
 
     return persistence_task(run, det_name, dark_files, superbias_frame,
-                            get_mask_files(det_name))
+                            get_mask_files(det_name), amp=amp)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,253 @@
+"""
+Amp-level work items for device-level tasks.  A task that supports
+them is first run for each amp of each CCD, e.g., for 'R22_S11:3',
+writing a partial result file for that amp, and is then run for each
+CCD, which gathers the partial results, computes any that are missing,
+and writes the usual per-CCD outputs.
+"""
+import os
+import json
+import pickle
+import fcntl
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['AMP_SEPARATOR', 'AMP_LEVEL_TASKS', 'split_work_item',
+           'amp_count', 'amp_work_items', 'amp_split_enabled',
+           'partial_result_file', 'write_partial_result',
+           'gather_amp_results', 'make_once', 'amp_thread_budget',
+           'amp_threads', 'amp_thread_env', 'map_amps']
+
+AMP_SEPARATOR = ':'
+
+# jh_tasks that accept amp-level work items.
+AMP_LEVEL_TASKS = ('bias_frame_jh_task', 'persistence_jh_task')
+
+
+def split_work_item(device_name):
+    """
+    Split a work item into the device name and the amp number, which
+    is None for a whole device.
+    """
+    if AMP_SEPARATOR not in device_name:
+        return device_name, None
+    device_name, amp = device_name.split(AMP_SEPARATOR)
+    return device_name, int(amp)
+
+
+def amp_count(det_name):
+    """Number of amps of a CCD:  8 for the wavefront sensors, else 16."""
+    return 8 if det_name.split('_')[-1].startswith('SW') else 16
+
+
+def amp_work_items(device_names):
+    """
+    Expand the CCD names into amp-level work items.  Raft names are
+    left as is.
+    """
+    items = []
+    for device_name in device_names:
+        if '_' not in device_name:
+            items.append(device_name)
+            continue
+        items.extend(f'{device_name}{AMP_SEPARATOR}{amp}'
+                     for amp in range(1, amp_count(device_name) + 1))
+    return items
+
+
+def amp_split_enabled(task):
+    """
+    Return True if the task, given by name, should be run with
+    amp-level work items, i.e., if it is in AMP_LEVEL_TASKS and the
+    LCATR_AMP_SPLIT environment variable is set to True.
+    """
+    return (os.environ.get('LCATR_AMP_SPLIT', 'False') == 'True'
+            and task in AMP_LEVEL_TASKS)
+
+
+def partial_result_file(file_prefix, kind, amp):
+    """Name of the partial result file for an amp."""
+    return f'{file_prefix}_{kind}_amp{amp:02d}.pickle'
+
+
+def write_partial_result(file_prefix, kind, amp, result):
+    """Write the partial result for an amp."""
+    outfile = partial_result_file(file_prefix, kind, amp)
+    tmp_file = f'{outfile}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as output:
+        pickle.dump(result, output)
+    os.replace(tmp_file, outfile)
+
+
+def gather_amp_results(file_prefix, kind, amps, compute):
+    """
+    Gather the partial results for the amps of a CCD.  The partial
+    result files are deleted once they have been read.
+
+    Parameters
+    ----------
+    file_prefix: str
+        File prefix for the CCD.
+    kind: str
+        Kind of result, used in the partial result file names.
+    amps: list
+        Amps of the CCD.
+    compute: function
+        Function that takes a list of amps and returns a dict of
+        results, keyed by amp, for those with no partial result.
+
+    Returns
+    -------
+    dict: The results keyed by amp.
+    """
+    results = dict()
+    partial_files = []
+    for amp in amps:
+        partial_file = partial_result_file(file_prefix, kind, amp)
+        try:
+            with open(partial_file, 'rb') as fd:
+                results[amp] = pickle.load(fd)
+            partial_files.append(partial_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            pass
+    missing = [_ for _ in amps if _ not in results]
+    if missing:
+        results.update(compute(missing))
+    for partial_file in partial_files:
+        os.remove(partial_file)
+    return results
+
+
+@contextlib.contextmanager
+def _file_lock(lock_file):
+    with open(lock_file, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def _input_signature(input_files):
+    """Paths, sizes, and modification times of the input files."""
+    signature = []
+    for path in sorted(input_files):
+        try:
+            stat = os.stat(path)
+            signature.append([path, stat.st_size, stat.st_mtime_ns])
+        except OSError:
+            signature.append([path, None, None])
+    return signature
+
+
+def make_once(outfile, func, *args, input_files=None, **kwds):
+    """
+    Call func(*args, **kwds) to make outfile unless it already exists.
+    This holds a lock so that when the work items for the amps of a
+    CCD need the same input file, e.g., a superbias frame, only one of
+    them makes it, and the others wait for it.
+
+    If input_files is given, the paths, sizes, and modification times
+    of those files are saved in outfile + '.inputs', and outfile is
+    made again if they have changed, e.g., in a rerun with new data.
+    """
+    signature_file = f'{outfile}.inputs'
+    with _file_lock(f'{outfile}.lock'):
+        signature = None
+        if input_files is not None:
+            signature = _input_signature(input_files)
+            try:
+                with open(signature_file) as fd:
+                    current = json.load(fd) == signature
+            except (OSError, ValueError):
+                current = False
+            if not current and os.path.isfile(outfile):
+                os.remove(outfile)
+        if not os.path.isfile(outfile):
+            func(*args, **kwds)
+            if signature is not None:
+                with open(signature_file, 'w') as output:
+                    json.dump(signature, output)
+    return outfile
+
+
+def amp_thread_budget(processes, num_tasks=None, cores=None):
+    """
+    Number of threads each task can use to process the amps of a CCD
+    when up to `processes` tasks run at once on the current node, so
+    that, e.g., the 9 CCDs of a single raft can use all of the cores.
+    The LCATR_AMP_THREADS environment variable overrides this value.
+
+    Parameters
+    ----------
+    processes: int
+        Maximum number of concurrent tasks.
+    num_tasks: int [None]
+        Number of tasks to be run, if fewer than `processes`.
+    cores: int [None]
+        Number of cores to share among the tasks.  If None, then use
+        the number of cores on the node.
+    """
+    if 'LCATR_AMP_THREADS' in os.environ:
+        return amp_threads()
+    if num_tasks is not None:
+        processes = min(processes, num_tasks)
+    if cores is None:
+        cores = multiprocessing.cpu_count()
+    return max(1, cores//max(1, processes))
+
+
+def amp_threads():
+    """
+    Number of threads for processing the amps of a CCD, from the
+    LCATR_AMP_THREADS environment variable, default 1.
+    """
+    return max(1, int(os.environ.get('LCATR_AMP_THREADS', 1)))
+
+
+@contextlib.contextmanager
+def amp_thread_env(threads):
+    """
+    Context manager to set LCATR_AMP_THREADS while running a task.  If
+    threads is None, the environment is left as is.
+    """
+    if threads is None:
+        yield
+        return
+    old_value = os.environ.get('LCATR_AMP_THREADS')
+    os.environ['LCATR_AMP_THREADS'] = str(threads)
+    try:
+        yield
+    finally:
+        if old_value is None:
+            del os.environ['LCATR_AMP_THREADS']
+        else:
+            os.environ['LCATR_AMP_THREADS'] = old_value
+
+
+def map_amps(func, amps, threads=None):
+    """
+    Call func(amp) for each amp, using a thread pool.  The numpy and
+    afw calls that do the work release the GIL, so the amps are
+    processed in parallel.  func should not make any matplotlib calls,
+    which need to be made from the main thread.
+
+    Parameters
+    ----------
+    func: function
+        Function of the amp number.
+    amps: list
+        Amps to process.
+    threads: int [None]
+        Number of threads.  If None, then use amp_threads().
+
+    Returns
+    -------
+    dict: The function values keyed by amp, in the order of amps.
+    """
+    amps = list(amps)
+    if threads is None:
+        threads = amp_threads()
+    threads = min(threads, len(amps))
+    if threads <= 1:
+        return {amp: func(amp) for amp in amps}
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return dict(zip(amps, executor.map(func, amps)))
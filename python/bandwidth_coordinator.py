@@ -0,0 +1,324 @@
+"""
+Coordination of the file server bandwidth used by the staging scripts
+on the worker nodes.  A coordinator running on the head node grants
+each file to be read an open file slot, and hands out byte-rate tokens
+for each block of the file as it is copied, capping the cluster-wide
+read rate and the number of files being read at once.  The waiting
+transfers from all of the hosts are served in one queue, highest
+priority first, e.g., those for the devices whose tasks will be
+launched first.  It also totals the throughput of each host.
+
+The limits are set for each site with these environment variables:
+
+    LCATR_STAGING_MAX_RATE
+        Maximum total read rate in MB/s.
+    LCATR_STAGING_MAX_OPEN_FILES
+        Maximum number of files being read at once.
+
+The staging scripts find the coordinator via the host:port address in
+LCATR_BANDWIDTH_COORDINATOR.
+"""
+import os
+import json
+import time
+import heapq
+import socket
+import logging
+import itertools
+import threading
+import contextlib
+import socketserver
+from collections import defaultdict
+from rate_limiter import TokenBucket
+
+__all__ = ['staging_limits', 'BandwidthCoordinator', 'start_coordinator',
+           'BandwidthClient', 'coordinator_client']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+def staging_limits():
+    """
+    Return the maximum read rate in bytes/s and the maximum number of
+    open files for staging, from LCATR_STAGING_MAX_RATE (MB/s) and
+    LCATR_STAGING_MAX_OPEN_FILES.  A value of None means no limit.
+    """
+    max_rate = os.environ.get('LCATR_STAGING_MAX_RATE', None)
+    if max_rate is not None:
+        max_rate = float(max_rate)*1024**2
+    max_open_files = os.environ.get('LCATR_STAGING_MAX_OPEN_FILES', None)
+    if max_open_files is not None:
+        max_open_files = int(max_open_files)
+    return max_rate, max_open_files
+
+
+class _CoordinatorHandler(socketserver.StreamRequestHandler):
+    """
+    Handler for a client connection, which sends one json request per
+    line and receives one json reply per line.  Any grants that are
+    still held when the connection closes are released.
+    """
+    def handle(self):
+        held = 0
+        try:
+            for line in self.rfile:
+                request = json.loads(line)
+                if request['op'] == 'acquire':
+                    self.server.acquire(request['host'],
+                                        request.get('priority', 0))
+                    held += 1
+                    reply = dict(granted=True)
+                elif request['op'] == 'consume':
+                    self.server.consume(request['host'], request['bytes'],
+                                        request.get('priority', 0))
+                    reply = dict(granted=True)
+                elif request['op'] == 'release':
+                    self.server.release(request['host'], request['bytes'],
+                                        request['seconds'])
+                    held -= 1
+                    reply = dict(released=True)
+                else:
+                    reply = self.server.report()
+                self.wfile.write((json.dumps(reply) + '\n').encode())
+                self.wfile.flush()
+        except (OSError, ValueError, KeyError):
+            pass
+        finally:
+            for _ in range(held):
+                self.server.release(None, 0, 0)
+
+
+class BandwidthCoordinator(socketserver.ThreadingTCPServer):
+    """
+    TCP server that grants the staging transfers.  A transfer is
+    granted an open file slot once it is the highest priority one
+    waiting over all of the hosts, i.e., the one with the lowest
+    priority value, then the earliest, and a slot is free.  Each block
+    of the file is then read once the token bucket has its bytes, with
+    the blocks of the transfers waiting for tokens also served in
+    priority order, so that the read rate is capped over each second
+    rather than for each whole file.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, max_rate=None, max_open_files=None, port=0):
+        """
+        Parameters
+        ----------
+        max_rate: float [None]
+            Maximum total read rate in bytes/s.  If None, then there
+            is no limit.
+        max_open_files: int [None]
+            Maximum number of files being read at once.  If None, then
+            there is no limit.
+        port: int [0]
+            Port to listen on.  If 0, then a free port is used.
+        """
+        super().__init__(('', port), _CoordinatorHandler)
+        # Allow bursts of up to one second at the maximum rate.
+        self.bucket = TokenBucket(max_rate, capacity=max_rate)
+        self.max_open_files = max_open_files
+        self.open_files = 0
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.reading = []
+        self.counter = itertools.count()
+        self.stats = defaultdict(lambda: dict(files=0, bytes=0, seconds=0.,
+                                              waited=0.))
+
+    @property
+    def address(self):
+        """host:port address for the clients."""
+        return f'{socket.gethostname()}:{self.server_address[1]}'
+
+    def acquire(self, host, priority=0):
+        """Wait until a transfer from host is granted an open file slot."""
+        t0 = time.time()
+        ticket = (priority, next(self.counter))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            while (self.waiting[0] != ticket
+                   or (self.max_open_files is not None
+                       and self.open_files >= self.max_open_files)):
+                self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.open_files += 1
+            self.stats[host]['waited'] += time.time() - t0
+            self.condition.notify_all()
+
+    def consume(self, host, nbytes, priority=0):
+        """Wait until a granted transfer from host can read nbytes."""
+        t0 = time.time()
+        ticket = (priority, next(self.counter))
+        with self.condition:
+            heapq.heappush(self.reading, ticket)
+            while True:
+                if self.reading[0] == ticket:
+                    wait_time = self.bucket.try_acquire(nbytes)
+                    if wait_time == 0:
+                        break
+                    self.condition.wait(wait_time)
+                else:
+                    self.condition.wait()
+            heapq.heappop(self.reading)
+            self.stats[host]['waited'] += time.time() - t0
+            self.condition.notify_all()
+
+    def release(self, host, nbytes, seconds):
+        """
+        Free the open file slot of a finished transfer and record its
+        size and duration for the host.  If host is None, then nothing
+        is recorded.
+        """
+        with self.condition:
+            self.open_files -= 1
+            if host is not None:
+                self.stats[host]['files'] += 1
+                self.stats[host]['bytes'] += nbytes
+                self.stats[host]['seconds'] += seconds
+            self.condition.notify_all()
+
+    def report(self):
+        """
+        Return the number of files, MB read, transfer time, time
+        waiting for grants, and mean throughput in MB/s of each host.
+        """
+        with self.condition:
+            report = dict()
+            for host, stats in self.stats.items():
+                report[host] = dict(stats, mb=stats['bytes']/1024**2)
+                report[host]['mb_per_sec'] \
+                    = (report[host]['mb']/stats['seconds']
+                       if stats['seconds'] > 0 else 0)
+            return report
+
+
+def start_coordinator(max_rate=None, max_open_files=None, port=0):
+    """
+    Start a BandwidthCoordinator in a background thread and return it.
+    Call its shutdown() and server_close() methods to stop it.
+    """
+    coordinator = BandwidthCoordinator(max_rate=max_rate,
+                                       max_open_files=max_open_files,
+                                       port=port)
+    thread = threading.Thread(target=coordinator.serve_forever, daemon=True)
+    thread.start()
+    return coordinator
+
+
+class BandwidthClient:
+    """
+    Client for a BandwidthCoordinator.  Each concurrent transfer uses
+    its own connection from a pool, so that copy threads can wait for
+    their grants independently.  If the coordinator can't be reached,
+    then the transfers are not throttled.
+    """
+    def __init__(self, address, host=None, timeout=10):
+        """
+        Parameters
+        ----------
+        address: str
+            host:port address of the coordinator.
+        host: str [None]
+            Name of the current host for the throughput report.  If
+            None, then use socket.gethostname().
+        timeout: float [10]
+            Timeout in seconds for connecting to the coordinator.
+        """
+        server, port = address.rsplit(':', 1)
+        self.server_address = server, int(port)
+        self.host = socket.gethostname() if host is None else host
+        self.timeout = timeout
+        self.connections = []
+        self.lock = threading.Lock()
+        self.available = True
+        self.logger = logging.getLogger('BandwidthClient')
+        self.logger.setLevel(logging.INFO)
+
+    def _connect(self):
+        with self.lock:
+            if self.connections:
+                return self.connections.pop()
+        sock = socket.create_connection(self.server_address,
+                                        timeout=self.timeout)
+        # Grants may take a while, so only the connection times out.
+        sock.settimeout(None)
+        return sock, sock.makefile('rb')
+
+    def _request(self, connection, request):
+        sock, rfile = connection
+        sock.sendall((json.dumps(request) + '\n').encode())
+        line = rfile.readline()
+        if not line:
+            raise OSError('bandwidth coordinator closed the connection')
+        return json.loads(line)
+
+    def _unavailable(self, eobj):
+        self.logger.info('bandwidth coordinator unavailable: %s', eobj)
+        self.available = False
+
+    @contextlib.contextmanager
+    def transfer(self, nbytes, priority=0):
+        """
+        Context manager to wait for an open file slot before a transfer
+        of nbytes and report it afterwards.  It provides a function to
+        call with the size of each block before it is read, which waits
+        for the coordinator to grant the bytes.
+        """
+        connection = None
+        if self.available:
+            try:
+                connection = self._connect()
+                self._request(connection, dict(op='acquire', host=self.host,
+                                               priority=priority))
+            except (OSError, ValueError) as eobj:
+                self._unavailable(eobj)
+                connection = None
+
+        def consume(block_size):
+            nonlocal connection
+            if connection is None:
+                return
+            try:
+                self._request(connection, dict(op='consume', host=self.host,
+                                               bytes=block_size,
+                                               priority=priority))
+            except (OSError, ValueError) as eobj:
+                self._unavailable(eobj)
+                connection[0].close()
+                connection = None
+
+        t0 = time.time()
+        try:
+            yield consume
+        finally:
+            if connection is not None:
+                try:
+                    self._request(connection,
+                                  dict(op='release', host=self.host,
+                                       bytes=nbytes,
+                                       seconds=time.time() - t0))
+                    with self.lock:
+                        self.connections.append(connection)
+                except (OSError, ValueError):
+                    connection[0].close()
+
+    def close(self):
+        """Close the connections to the coordinator."""
+        with self.lock:
+            for sock, rfile in self.connections:
+                rfile.close()
+                sock.close()
+            self.connections = []
+
+
+def coordinator_client(host=None):
+    """
+    Return a BandwidthClient for the coordinator given by
+    LCATR_BANDWIDTH_COORDINATOR, or None if that is not set.
+    """
+    address = os.environ.get('LCATR_BANDWIDTH_COORDINATOR', None)
+    if address is None:
+        return None
+    return BandwidthClient(address, host=host)
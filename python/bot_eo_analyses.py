@@ -10,12 +10,14 @@ import shutil
 import json
 import pickle
 import warnings
+import functools
 from collections import defaultdict
 import configparser
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from astropy.io import fits
+import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.eotest.image_utils as imutils
 import lsst.eotest.sensor as sensorTest
@@ -26,7 +28,13 @@ from focal_plane_plotting import plot_focal_plane
 from correlated_noise import correlated_noise, raft_level_oscan_correlations
 from camera_components import camera_info
 from tearing_detection import tearing_detection
-from multiprocessor_execution import run_device_analysis_pool
+from multiprocessor_execution import run_device_analysis_pool, \
+    shared_device_pool
+from task_history import task_name
+from completion_ledger import CompletionLedger
+from device_executors import executor_backend
+from amp_tasks import amp_count, amp_split_enabled, amp_work_items, \
+    gather_amp_results, write_partial_result, map_amps
 try:
     import scope
     import multiscope
@@ -516,6 +524,45 @@ def bias_frame_task(run, det_name, bias_files, bias_frame=None):
     sensorTest.rolloff_mask(bias_files[0], rolloff_mask_file)
     return bias_frame
 
+class AmpMaskedCCD(sensorTest.MaskedCCD):
+    """
+    sensorTest.MaskedCCD that reads the HDUs of the specified amps
+    only, so that an amp-level work item reads one amp of each file
+    rather than the whole CCD.
+    """
+    def __init__(self, imfile, amps, mask_files=(), bias_frame=None):
+        # Set up the same attributes as MaskedCCD.__init__, but only
+        # for the amps given.
+        dict.__init__(self)
+        self.imfile = imfile
+        self.md = imutils.Metadata(imfile)
+        self.amp_geom = sensorTest.makeAmplifierGeometry(imfile)
+        for amp in amps:
+            image = afwImage.ImageF(imfile, imutils.dm_hdu(amp))
+            mask = afwImage.Mask(image.getDimensions())
+            self[amp] = afwImage.MaskedImageF(image, mask)
+        self._added_mask_types = []
+        for mask_file in mask_files:
+            self.add_masks(mask_file)
+        self.stat_ctrl = afwMath.StatisticsControl()
+        if mask_files:
+            self.setAllMasks()
+        self.bias_frame = None if bias_frame is None \
+                          else AmpMaskedCCD(bias_frame, amps)
+        self.dark_frame = None
+        self.linearity_correction = None
+
+def masked_ccd(imfile, amps, mask_files=(), bias_frame=None):
+    """
+    Return a sensorTest.MaskedCCD for imfile if all of its amps are
+    needed, otherwise an AmpMaskedCCD for the specified amps.
+    """
+    if set(amps) == set(imutils.allAmps(imfile)):
+        return sensorTest.MaskedCCD(imfile, mask_files=mask_files,
+                                    bias_frame=bias_frame)
+    return AmpMaskedCCD(imfile, amps, mask_files=mask_files,
+                        bias_frame=bias_frame)
+
 def image_stats(image, nsigma=10):
     """Compute clipped mean and stdev of the image."""
     stat_ctrl = afwMath.StatisticsControl(numSigmaClip=nsigma)
@@ -523,33 +570,43 @@ def image_stats(image, nsigma=10):
     stats = afwMath.makeStatistics(image, flags=flags, sctrl=stat_ctrl)
     return stats.getValue(afwMath.MEANCLIP), stats.getValue(afwMath.STDEVCLIP)
 
-def bias_stability_task(run, det_name, bias_files, nsigma=10):
-    """Compute amp-wise bias stability time histories and serial profiles."""
-    raft, slot = det_name.split('_')
-    file_prefix = make_file_prefix(run, det_name)
-    data = defaultdict(list)
-
-    fig = plt.figure(figsize=(16, 16))
-    xlabel_amps = (13, 14, 15, 16)
-    ylabel_amps = (1, 5, 9, 13)
-    ax = {amp: fig.add_subplot(4, 4, amp) for amp in range(1, 17)}
+def bias_stability_amp_data(run, det_name, bias_files, amps, nsigma=10):
+    """
+    Compute the bias stability statistics and serial profiles for
+    the specified amps of a CCD.  Only the HDUs of those amps are read
+    (see masked_ccd), and the amps of each file are processed on
+    LCATR_AMP_THREADS threads (see amp_tasks.map_amps).
 
-    for bias_file in bias_files:
+    Returns
+    -------
+    dict: For each amp, a dict with the `data` columns for the
+        bias_frame_stats data frame, including the index of each bias
+        file, and the serial `profiles`, one per bias file.
+    """
+    raft, slot = det_name.split('_')
+    results = {amp: dict(data=defaultdict(list), profiles=[])
+               for amp in amps}
+    for ifile, bias_file in enumerate(bias_files):
         with fits.open(bias_file) as hdus:
             temps = dict()
             for i in range(1, 10):
                 key = f'TEMP{i}'
                 if key in hdus['REB_COND'].header:
                     temps[key] = hdus['REB_COND'].header[key]
-        ccd = sensorTest.MaskedCCD(bias_file)
-        for amp in ccd:
+        ccd = masked_ccd(bias_file, amps)
+        def amp_stats(amp):
             # Retrieve the per row overscan subtracted imaging section.
             amp_image = ccd.unbiased_and_trimmed_image(amp)
-            # Plot the median of each column versus serial pixel number.
+            # Compute the median of each column.
             imarr = amp_image.getImage().array
-            ax[amp].plot(range(imarr.shape[1]), np.median(imarr, axis=0))
+            profile = np.median(imarr, axis=0)
             # Compute 10-sigma clipped mean and stdev
-            mean, stdev = image_stats(amp_image, nsigma=nsigma)
+            return profile, image_stats(amp_image, nsigma=nsigma)
+        for amp, (profile, stats) in map_amps(amp_stats, amps).items():
+            mean, stdev = stats
+            data = results[amp]['data']
+            results[amp]['profiles'].append(profile)
+            data['file_index'].append(ifile)
             data['raft'].append(raft)
             data['slot'].append(slot)
             data['tseqnum'].append(ccd.md.get('TSEQNUM'))
@@ -559,13 +616,47 @@ def bias_stability_task(run, det_name, bias_files, nsigma=10):
             data['amp'].append(amp)
             data['mean'].append(mean)
             data['stdev'].append(stdev)
+    return results
+
+def bias_stability_task(run, det_name, bias_files, nsigma=10, amp=None):
+    """
+    Compute amp-wise bias stability time histories and serial profiles.
+    If amp is given, then only compute the partial result for that amp
+    (see amp_tasks).  Otherwise, the partial results for the amps are
+    gathered, the missing ones are computed, and the outputs for the
+    CCD are written.
+    """
+    file_prefix = make_file_prefix(run, det_name)
+    if amp is not None:
+        results = bias_stability_amp_data(run, det_name, bias_files, [amp],
+                                          nsigma=nsigma)
+        write_partial_result(file_prefix, 'bias_stability', amp,
+                             results[amp])
+        return
+
+    amps = list(range(1, amp_count(det_name) + 1))
+    results = gather_amp_results(
+        file_prefix, 'bias_stability', amps,
+        lambda missing: bias_stability_amp_data(run, det_name, bias_files,
+                                                missing, nsigma=nsigma))
+
+    fig = plt.figure(figsize=(16, 16))
+    ax = {amp: fig.add_subplot(4, 4, amp) for amp in amps}
+    for amp in amps:
+        # Plot the median of each column versus serial pixel number.
+        for profile in results[amp]['profiles']:
+            ax[amp].plot(range(len(profile)), profile)
     plt.suptitle(f'{det_name}, Run {run}\nmedian signal (ADU) vs column')
     plt.tight_layout(rect=(0, 0, 1, 0.95))
-    for amp in ccd:
+    for amp in amps:
         ax[amp].annotate(f'amp {amp}', (0.5, 0.95),
                          xycoords='axes fraction', ha='center')
     plt.savefig(f'{file_prefix}_bias_serial_profiles.png')
-    df = pd.DataFrame(data=data)
+    # Order the rows by bias file, then by amp, as they are read.
+    df = pd.concat([pd.DataFrame(data=results[amp]['data'])
+                    for amp in amps], ignore_index=True)
+    df = df.sort_values(['file_index', 'amp'], kind='mergesort')\
+           .drop(columns=['file_index']).reset_index(drop=True)
     df.to_pickle(f'{file_prefix}_bias_frame_stats.pickle')
 
 
@@ -1017,29 +1108,68 @@ def overscan_task(run, det_name, flat_files, gains, bias_frame=None):
         plt.close()
 
 
-def persistence_task(run, det_name, bias_files, superbias_frame, mask_files):
-    """Single sensor execution of the persistence analysis."""
-    file_prefix = make_file_prefix(run, det_name)
-    data = defaultdict(list)
-    ccd = None
-    for bias_file in bias_files:
-        ccd = sensorTest.MaskedCCD(bias_file, mask_files=mask_files,
-                                   bias_frame=superbias_frame)
+def persistence_amp_data(bias_files, superbias_frame, mask_files, amps):
+    """
+    Compute the persistence statistics for the specified amps of a
+    CCD.  Only the HDUs of those amps are read (see masked_ccd), and
+    the amps of each file are processed on LCATR_AMP_THREADS threads
+    (see amp_tasks.map_amps).
+
+    Returns
+    -------
+    dict: For each amp, a dict with the columns for the
+        persistence_data data frame, including the index of each file.
+    """
+    results = {amp: defaultdict(list) for amp in amps}
+    for ifile, bias_file in enumerate(bias_files):
+        ccd = masked_ccd(bias_file, amps, mask_files=mask_files,
+                         bias_frame=superbias_frame)
         tseqnum = ccd.md.get('TSEQNUM')
-        for amp in ccd:
+        def amp_stats(amp):
             amp_image = ccd.unbiased_and_trimmed_image(amp)
-            stats = afwMath.makeStatistics(amp_image,
-                                           afwMath.MEAN | afwMath.STDEV,
-                                           ccd.stat_ctrl)
+            return afwMath.makeStatistics(amp_image,
+                                          afwMath.MEAN | afwMath.STDEV,
+                                          ccd.stat_ctrl)
+        for amp, stats in map_amps(amp_stats, amps).items():
+            data = results[amp]
+            data['file_index'].append(ifile)
             data['tseqnum'].append(tseqnum)
             data['amp'].append(amp)
             data['mean_signal'].append(stats.getValue(afwMath.MEAN))
             data['stdev'].append(stats.getValue(afwMath.STDEV))
-    df = pd.DataFrame(data=data)
+    return results
+
+
+def persistence_task(run, det_name, bias_files, superbias_frame, mask_files,
+                     amp=None):
+    """
+    Single sensor execution of the persistence analysis.  If amp is
+    given, then only compute the partial result for that amp (see
+    amp_tasks).  Otherwise, the partial results for the amps are
+    gathered, the missing ones are computed, and the outputs for the
+    CCD are written.
+    """
+    file_prefix = make_file_prefix(run, det_name)
+    if amp is not None:
+        results = persistence_amp_data(bias_files, superbias_frame,
+                                       mask_files, [amp])
+        write_partial_result(file_prefix, 'persistence', amp, results[amp])
+        return
+
+    amps = list(range(1, amp_count(det_name) + 1))
+    results = gather_amp_results(
+        file_prefix, 'persistence', amps,
+        lambda missing: persistence_amp_data(bias_files, superbias_frame,
+                                             mask_files, missing))
+    # Order the rows by file, then by amp, as they are read.
+    df = pd.concat([pd.DataFrame(data=results[amp]) for amp in amps],
+                   ignore_index=True)
+    df = df.sort_values(['file_index', 'amp'], kind='mergesort')\
+           .drop(columns=['file_index']).reset_index(drop=True)
     outfile = f'{file_prefix}_persistence_data.pickle'
     df.to_pickle(outfile)
     fig = plt.figure()
-    for amp in ccd:
+    for amp in amps:
         my_df = df.query(f'amp == {amp}')
         plt.scatter(my_df['tseqnum'], my_df['mean_signal'], s=2, label=f'{amp}')
     xmax = 1.2*(np.max(df['tseqnum']) - np.min(df['tseqnum'])) \
@@ -1176,6 +1306,17 @@ def run_jh_tasks(*jh_tasks, device_names=None, processes=None, walltime=3600):
     Because the number of jh_task functions can vary, the keyword arguments
     should reference the keywords explicitly, i.e., one cannot rely on
     keyword position to pass those values.
+
+    The outcome for each jh_task and device is recorded in the
+    jh_task_ledger.json file in the working directory along with a
+    fingerprint of the input files and code.  If the producer is
+    rerun, only the devices that are missing from the ledger, failed,
+    or have a different fingerprint are processed.  Set LCATR_RESUME
+    to False to process all of the devices.
+
+    If LCATR_AMP_SPLIT=True, the jh_tasks in amp_tasks.AMP_LEVEL_TASKS
+    are first run for each amp of the CCDs, and then for the CCDs to
+    combine the amp-level results.
     """
     if device_names is None:
         device_names = camera_info.get_det_names()
@@ -1214,14 +1355,46 @@ def run_jh_tasks(*jh_tasks, device_names=None, processes=None, walltime=3600):
     # tasks being run in parallel to avoid eT db access contention.
     GetAmplifierGains()
 
+    # Optional delay before each jh_task, e.g., to give remote workers
+    # time to exit at sites where that is needed.  This is not needed
+    # for the DevicePool or parsl workers, since run_device_analysis_pool
+    # only returns once all of the devices for a jh_task have finished.
+    delay = float(os.environ.get('LCATR_JH_TASK_DELAY', 0))
+
+    ledger = CompletionLedger()
+    resume = os.environ.get('LCATR_RESUME', 'True') == 'True'
+
+    # Keep the same worker processes for all of the jh_tasks run
+    # by this producer.
+    pool = shared_device_pool(processes=processes)
     for jh_task in jh_tasks:
-        # Add 30 second sleep before launching jh_task processes in
-        # parallel to allow for parsl process_pool_workers from the
-        # previous set of jh_task processes to finish.
-        time.sleep(30)
-        run_device_analysis_pool(jh_task, device_names,
-                                 processes=processes, cwd=cwd,
-                                 walltime=walltime)
+        task = task_name(jh_task)
+        if resume:
+            pending = ledger.pending(task, jh_task, device_names)
+            if len(pending) < len(device_names):
+                print(f'{task}: skipping {len(device_names) - len(pending)}'
+                      ' device(s) completed in a previous attempt')
+            if not pending:
+                continue
+        else:
+            pending = device_names
+        time.sleep(delay)
+        if amp_split_enabled(task):
+            # Run the amp-level work items first.  Any amps that fail
+            # here are computed by the device-level task below.
+            try:
+                run_device_analysis_pool(jh_task, amp_work_items(pending),
+                                         processes=processes, cwd=cwd,
+                                         walltime=walltime, pool=pool)
+            except RuntimeError as eobj:
+                print(f'{task}: amp-level work items failed: {eobj}')
+        try:
+            run_device_analysis_pool(
+                jh_task, pending, processes=processes, cwd=cwd,
+                walltime=walltime, pool=pool,
+                on_complete=functools.partial(ledger.record, task, jh_task))
+        finally:
+            ledger.save()
 
 
 def run_python_task_or_cl_script(python_task, cl_script, device_names=None,
@@ -1238,8 +1411,7 @@ def run_python_task_or_cl_script(python_task, cl_script, device_names=None,
     bot_eo_acq_cfg = acq_config['bot_eo_acq_cfg']
     shutil.copy(bot_eo_acq_cfg, '.')
 
-    if (os.environ.get('LCATR_USE_PARSL', False) == 'True'
-        or siteUtils.getUnitType() == 'LCA-10134_Cryostat'):
+    if executor_backend() in ('parsl', 'ssh'):
         # Run command-line verions using parsl or ssh_dispatcher.
         run_jh_tasks(cl_script, device_names=device_names,
                      processes=processes, walltime=walltime)
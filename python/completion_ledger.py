@@ -0,0 +1,188 @@
+"""
+Ledger of the device-level jh_task runs completed in a job's working
+directory, so that a rerun of the producer only dispatches the devices
+that are missing, failed, or whose inputs or code have changed.
+"""
+import os
+import json
+import time
+import hashlib
+import inspect
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['CompletionLedger', 'job_input_files', 'code_version',
+           'ANALYSIS_MODULES']
+
+# Modules in $EOANALYSISJOBSDIR/python that implement the analyses, as
+# opposed to the task execution machinery.
+ANALYSIS_MODULES = ('bot_eo_analyses', 'correlated_noise',
+                    'flat_gain_stability', 'tearing_detection',
+                    'assemble_amp_gains')
+
+
+def job_input_files(device_name, job=None):
+    """
+    The data and calibration files read by the current job for a
+    device, as staged by stage_bot_data.
+
+    Parameters
+    ----------
+    device_name: str
+        CCD or raft name, e.g., 'R22_S11' or 'R22', or an amp-level
+        work item, e.g., 'R22_S11:3'.
+    job: str [None]
+        Harnessed job name.  If None, then use LCATR_JOB.
+    """
+    import siteUtils
+    from stage_bot_data import CCD_DATA_KEYS, RAFT_DATA_KEYS, get_files, \
+        get_isr_files
+    from amp_tasks import split_work_item
+    device_name, _ = split_work_item(device_name)
+    if job is None:
+        job = os.environ['LCATR_JOB']
+    if '_' in device_name:
+        files = get_files(CCD_DATA_KEYS.get(job, ()), device_name)
+        files = files.union(get_isr_files(device_name,
+                                          siteUtils.getRunNumber()))
+    else:
+        files = get_files(RAFT_DATA_KEYS.get(job, ()), device_name)
+    return files
+
+
+def code_version(task_func):
+    """
+    Hash of the source code of a jh_task and of the analysis modules,
+    the eotest package location, and the BOT EO configuration file.
+    """
+    code_dir = os.environ.get('EOANALYSISJOBSDIR', '')
+    paths = [os.path.join(code_dir, 'python', f'{_}.py')
+             for _ in ANALYSIS_MODULES]
+    if isinstance(task_func, str):
+        paths.append(task_func)
+    else:
+        try:
+            paths.append(inspect.getsourcefile(task_func))
+        except TypeError:
+            pass
+    try:
+        import siteUtils
+        paths.append(siteUtils.get_bot_eo_config_file())
+    except Exception:
+        pass
+    sha = hashlib.sha1(os.environ.get('EOTEST_DIR', '').encode())
+    for path in paths:
+        if path is None:
+            continue
+        sha.update(path.encode())
+        try:
+            with open(path, 'rb') as fd:
+                sha.update(fd.read())
+        except OSError:
+            pass
+    return sha.hexdigest()
+
+
+class CompletionLedger:
+    """
+    Class to keep track of the (task, device) runs that have completed,
+    along with a fingerprint of their input files, i.e., their paths,
+    sizes and modification times, and of the code version.
+    """
+    def __init__(self, ledger_file='jh_task_ledger.json', input_files=None,
+                 code_version_func=code_version):
+        """
+        Parameters
+        ----------
+        ledger_file: str ['jh_task_ledger.json']
+            json file containing the ledger.
+        input_files: function [None]
+            Function that returns the input files for a device name.
+            If None, then use job_input_files.
+        code_version_func: function [code_version]
+            Function that returns the code version of a task function
+            or script.
+        """
+        self.ledger_file = ledger_file
+        self.input_files = job_input_files if input_files is None \
+                           else input_files
+        self.code_version_func = code_version_func
+        self.entries = dict()
+        try:
+            with open(ledger_file) as fd:
+                self.entries = json.load(fd)
+        except (OSError, ValueError):
+            pass
+        self._code_versions = dict()
+        self._fingerprints = dict()
+
+    def code_version(self, task, task_func):
+        """The code version for a task, computed once per ledger."""
+        if task not in self._code_versions:
+            self._code_versions[task] = self.code_version_func(task_func)
+        return self._code_versions[task]
+
+    def fingerprint(self, task, task_func, device_name):
+        """
+        Fingerprint of the inputs and code for a task and device, or
+        None if the input files can't be determined.
+        """
+        self._fingerprints[(task, device_name)] = None
+        try:
+            paths = sorted(self.input_files(device_name))
+        except Exception:
+            return None
+        files = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                files.append((path, stat.st_size, stat.st_mtime))
+            except OSError:
+                files.append((path, None, None))
+        sha = hashlib.sha1(self.code_version(task, task_func).encode())
+        sha.update(json.dumps(files).encode())
+        self._fingerprints[(task, device_name)] = sha.hexdigest()
+        return self._fingerprints[(task, device_name)]
+
+    def pending(self, task, task_func, device_names):
+        """
+        Return the devices for which the task has not succeeded with
+        the current inputs and code.  Fingerprints are only computed,
+        in parallel, for the devices recorded as succeeded.
+        """
+        task_entries = self.entries.get(task, {})
+        succeeded = [_ for _ in device_names if
+                     task_entries.get(_, {}).get('status') == 'succeeded']
+        if not succeeded:
+            return list(device_names)
+        self.code_version(task, task_func)
+        threads = min(len(succeeded), 16)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            fingerprints = dict(zip(succeeded, executor.map(
+                functools.partial(self.fingerprint, task, task_func),
+                succeeded)))
+        return [_ for _ in device_names if fingerprints.get(_) is None
+                or fingerprints[_] != task_entries[_]['fingerprint']]
+
+    def record(self, task, task_func, device_name, succeeded):
+        """
+        Record the outcome of a task run on a device.  The fingerprint
+        from the pending call is used, if available.  Fingerprints are
+        only needed for the runs that succeeded.
+        """
+        if not succeeded:
+            fingerprint = None
+        elif (task, device_name) in self._fingerprints:
+            fingerprint = self._fingerprints[(task, device_name)]
+        else:
+            fingerprint = self.fingerprint(task, task_func, device_name)
+        self.entries.setdefault(task, dict())[device_name] \
+            = dict(status='succeeded' if succeeded else 'failed',
+                   fingerprint=fingerprint, time=time.time())
+
+    def save(self):
+        """Write the ledger file."""
+        tmp_file = f'{self.ledger_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as output:
+            json.dump(self.entries, output, indent=1)
+        os.replace(tmp_file, self.ledger_file)
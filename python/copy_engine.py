@@ -0,0 +1,266 @@
+"""
+Parallel, verified file copies for staging data to the local scratch
+areas.  Files are copied by a bounded pool of threads using kernel-side
+copies, i.e., copy_file_range or sendfile, where available, to a
+temporary .part file that is renamed once the copy has been verified,
+so that an interrupted staging can be resumed and never leaves a
+truncated file in place.
+"""
+import os
+import time
+import errno
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['copy_threads', 'copy_checksum', 'file_checksum', 'is_current',
+           'copy_file', 'CopyEngine']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+PART_SUFFIX = '.part'
+
+_BLOCK_SIZE = 8*1024**2
+
+# Errors indicating that a kernel-side copy isn't supported for the
+# pair of files, in which case the next method is tried.
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTSUP, errno.EBADF)
+
+
+def copy_threads(threads=None):
+    """
+    Number of threads for copying files:  the value of
+    LCATR_COPY_THREADS, if set, otherwise threads, default 8.
+    """
+    if threads is None:
+        threads = 8
+    return max(1, int(os.environ.get('LCATR_COPY_THREADS', threads)))
+
+
+def copy_checksum(checksum=False):
+    """
+    Return True if copies should also be verified by checksum, i.e.,
+    if LCATR_COPY_CHECKSUM is set to True, or, if it is not set, the
+    value of checksum.
+    """
+    if 'LCATR_COPY_CHECKSUM' in os.environ:
+        return os.environ['LCATR_COPY_CHECKSUM'] == 'True'
+    return checksum
+
+
+def file_checksum(path, algorithm='md5'):
+    """Return the hex digest of the file contents."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fd:
+        for block in iter(lambda: fd.read(_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def is_current(src, dest, checksum=False):
+    """
+    Return True if dest is a complete copy of src, i.e., it has the
+    same size and modification time, and, if checksum is True, the
+    same contents.
+    """
+    try:
+        src_stat = os.stat(src)
+        dest_stat = os.stat(dest)
+    except FileNotFoundError:
+        return False
+    if (src_stat.st_size != dest_stat.st_size
+            or src_stat.st_mtime_ns != dest_stat.st_mtime_ns):
+        return False
+    return not checksum or file_checksum(src) == file_checksum(dest)
+
+
+def _copy_range(src_fd, dest_fd, offset, size, consume=None):
+    """
+    Copy the bytes of src_fd from offset to size to the same offset in
+    dest_fd, and return the offset reached.  If consume is given, the
+    bytes are copied in blocks of at most _BLOCK_SIZE, and consume is
+    called with the size of each block before it is copied.
+    """
+    max_count = 1024**3 if consume is None else _BLOCK_SIZE
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+        try:
+            while offset < size:
+                count = min(size - offset, max_count)
+                if consume is not None:
+                    consume(count)
+                if method == 'copy_file_range':
+                    nbytes = os.copy_file_range(src_fd, dest_fd, count,
+                                                offset, offset)
+                else:
+                    nbytes = os.sendfile(dest_fd, src_fd, offset, count)
+                if nbytes == 0:
+                    break
+                offset += nbytes
+            return offset
+        except OSError as eobj:
+            if eobj.errno not in _UNSUPPORTED:
+                raise
+    # Fall back to copying in user space.
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dest_fd, offset, os.SEEK_SET)
+    while offset < size:
+        count = min(size - offset, _BLOCK_SIZE)
+        if consume is not None:
+            consume(count)
+        block = os.read(src_fd, count)
+        if not block:
+            break
+        view = memoryview(block)
+        while view:
+            view = view[os.write(dest_fd, view):]
+        offset += len(block)
+    return offset
+
+
+def copy_file(src, dest, checksum=False, consume=None):
+    """
+    Copy src to dest, unless dest is already a complete copy.  The
+    data are written to dest + '.part', which is renamed to dest once
+    its size, and, if checksum is True, its contents, have been
+    verified.  A .part file left by an interrupted copy of the same
+    version of src is resumed rather than started over.  If consume
+    is given, it is called with the size of each block of the copy
+    before it is read, e.g., to wait for a rate limit.
+
+    Returns
+    -------
+    int: The number of bytes copied.
+    """
+    if is_current(src, dest, checksum=checksum):
+        return 0
+    part_file = dest + PART_SUFFIX
+    src_stat = os.stat(src)
+    offset = 0
+    try:
+        part_stat = os.stat(part_file)
+        if (part_stat.st_size <= src_stat.st_size
+                and part_stat.st_mtime >= src_stat.st_mtime):
+            offset = part_stat.st_size
+    except FileNotFoundError:
+        pass
+    start = offset
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        flags = os.O_WRONLY | os.O_CREAT | (0 if offset else os.O_TRUNC)
+        dest_fd = os.open(part_file, flags, 0o644)
+        try:
+            offset = _copy_range(src_fd, dest_fd, offset, src_stat.st_size,
+                                 consume=consume)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
+    if (offset != src_stat.st_size
+            or os.path.getsize(part_file) != src_stat.st_size):
+        os.remove(part_file)
+        raise OSError(f'incomplete copy of {src} to {dest}')
+    if checksum and file_checksum(src) != file_checksum(part_file):
+        os.remove(part_file)
+        raise OSError(f'checksum mismatch copying {src} to {dest}')
+    shutil.copymode(src, part_file)
+    os.utime(part_file, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+    os.replace(part_file, dest)
+    return offset - start
+
+
+class CopyEngine:
+    """
+    Class to copy files with a bounded pool of threads, so that
+    staging many files is limited by the disk and network bandwidth
+    rather than by the latency of each copy.
+    """
+    def __init__(self, threads=None, checksum=None, fetch=None,
+                 throttle=None):
+        """
+        Parameters
+        ----------
+        threads: int [None]
+            Number of copy threads.  If None, then use copy_threads().
+        checksum: bool [None]
+            Flag to verify the copies by checksum.  If None, then use
+            copy_checksum().
+        fetch: function [None]
+            Function with (src, dest) arguments to try first for files
+            that need to be copied, e.g., a peer_staging.PeerFetcher.
+            It should return the number of bytes copied, or None if it
+            could not provide the file, in which case src is copied.
+        throttle: object [None]
+            Object with a transfer(nbytes, priority) method that
+            returns a context manager, which is used to wrap each copy
+            of a source file, e.g., a
+            bandwidth_coordinator.BandwidthClient.  The context manager
+            provides the function that the copy calls with the size of
+            each block before reading it (see copy_file).
+        """
+        self.threads = copy_threads(threads)
+        self.checksum = copy_checksum() if checksum is None else checksum
+        self.fetch = fetch
+        self.throttle = throttle
+        self.logger = logging.getLogger('CopyEngine')
+        self.logger.setLevel(logging.INFO)
+
+    def copy(self, files, priority=0):
+        """
+        Copy files, given as a dict of destination paths keyed by
+        source path.  All of the copies are attempted, and the first
+        error, if any, is raised once they have finished.  The
+        priority is passed to the throttle, with lower values going
+        first.
+
+        Returns
+        -------
+        dict: The number of bytes copied for each destination path.
+        """
+        if not files:
+            return dict()
+        t0 = time.time()
+        for dest in set(files.values()):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+
+        def do_copy(item):
+            src, dest = item
+            try:
+                if is_current(src, dest, checksum=self.checksum):
+                    return 0
+                if self.fetch is not None:
+                    nbytes = self.fetch(src, dest)
+                    if nbytes is not None and (
+                            not self.checksum
+                            or is_current(src, dest, checksum=True)):
+                        return nbytes
+                if self.throttle is None:
+                    return copy_file(src, dest, checksum=self.checksum)
+                with self.throttle.transfer(os.path.getsize(src),
+                                            priority=priority) as consume:
+                    return copy_file(src, dest, checksum=self.checksum,
+                                     consume=consume)
+            except OSError as eobj:
+                return eobj
+
+        threads = min(self.threads, len(files))
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = dict(zip(files.values(),
+                               executor.map(do_copy, files.items())))
+        errors = [_ for _ in results.values() if isinstance(_, OSError)]
+        copied = {dest: nbytes for dest, nbytes in results.items()
+                  if not isinstance(nbytes, OSError)}
+        nbytes = sum(copied.values())
+        dt = max(time.time() - t0, 1e-6)
+        self.logger.info('copied %d of %d files, %.1f MB in %.1f s '
+                         '(%.1f MB/s), %d errors',
+                         sum(1 for _ in copied.values() if _ > 0),
+                         len(files), nbytes/1024**2, dt,
+                         nbytes/1024**2/dt, len(errors))
+        if errors:
+            raise errors[0]
+        return copied
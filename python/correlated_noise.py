@@ -1,17 +1,17 @@
 from __future__ import print_function
 import glob
-import copy
 from collections import namedtuple, defaultdict
 import itertools
 import numpy as np
 import scipy
+from astropy.io import fits
 import astropy.visualization as viz
 from astropy.visualization.mpl_normalize import ImageNormalize
 import matplotlib.pyplot as plt
 from matplotlib import ticker
-import lsst.afw.image as afw_image
 import lsst.eotest.image_utils as imutils
 import lsst.eotest.sensor as sensorTest
+from amp_tasks import map_amps
 
 plt.rcParams['xtick.labelsize'] = 'x-small'
 plt.rcParams['ytick.labelsize'] = 'x-small'
@@ -30,10 +30,14 @@ def get_overscans(infile, oscan_indices=None):
         y0, y1, x0, x1 = get_oscan_indices(infile)
     else:
         y0, y1, x0, x1 = oscan_indices
+    # The HDUs are read serially from a single open of the file, since
+    # concurrent FITS reads are not thread-safe.  The statistics
+    # computed from the overscans are what is run on threads.
     overscans = dict()
-    for amp in imutils.allAmps(infile):
-        oscan_data = afw_image.ImageF(infile, imutils.dm_hdu(amp)).getArray()
-        overscans[amp] = copy.deepcopy(oscan_data[y0:y1, x0:x1])
+    with fits.open(infile) as hdus:
+        for amp in imutils.allAmps(infile):
+            overscans[amp] = np.array(hdus[amp].data[y0:y1, x0:x1],
+                                      dtype=np.float32)
     return overscans
 
 
@@ -44,11 +48,11 @@ def get_mean_overscans(infiles, oscan_indices=None):
     else:
         y0, y1, x0, x1 = oscan_indices
     mean_overscans = defaultdict(list)
+    amps = imutils.allAmps(infiles[0])
     for infile in infiles:
-        for amp in imutils.allAmps(infiles[0]):
-            oscan_data \
-                = afw_image.ImageF(infile, imutils.dm_hdu(amp)).getArray()
-            mean_overscans[amp].append(copy.deepcopy(oscan_data[y0:y1, x0:x1]))
+        overscans = get_overscans(infile, oscan_indices=(y0, y1, x0, x1))
+        for amp in amps:
+            mean_overscans[amp].append(overscans[amp])
     for amp, images in mean_overscans.items():
         mean_overscans[amp] = sum(images)/float(len(images))
     return mean_overscans
@@ -103,10 +107,8 @@ def correlated_noise(bias_files, target=0, make_plots=False, plot_corr=True,
     # Construct the mean bias overscans from the remaining files.
     mean_oscans = get_mean_overscans(bias_files)
 
-    # Loop over amps in target frame and compute statistics.
-    bias_stats = dict()
-    correlation_data = dict()
-    for amp in bias_oscans:
+    # Compute the statistics for each amp in the target frame.
+    def amp_stats(amp):
         # Loop over other amps and construct the mean image of the
         # bias-subtracted overscans.  Require included amps to have
         # (unsubtracted) overscans with 4 < stdev < 25 rms ADU.
@@ -127,10 +129,14 @@ def correlated_noise(bias_files, target=0, make_plots=False, plot_corr=True,
         covmat = scipy.cov(dmat, rowvar=True)
         corr_factor = covmat[0, 1]/covmat[0, 0]
         fdiff = fdata1 - corr_factor*reduced_mean_oscan
-        bias_stats[amp] = BiasStats(np.sqrt(covmat[1, 1]), np.std(fdiff),
-                                    corr_factor,
-                                    np.mean(bias_oscans[amp]))
-        correlation_data[amp] = reduced_mean_oscan, fdata1, fdiff
+        return (BiasStats(np.sqrt(covmat[1, 1]), np.std(fdiff), corr_factor,
+                          np.mean(bias_oscans[amp])),
+                (reduced_mean_oscan, fdata1, fdiff))
+    bias_stats = dict()
+    correlation_data = dict()
+    for amp, (stats, corr_data) in map_amps(amp_stats, bias_oscans).items():
+        bias_stats[amp] = stats
+        correlation_data[amp] = corr_data
 
     f1 = None
     f2 = None
@@ -0,0 +1,339 @@
+"""
+Dependency-aware scheduling of device-level jh tasks.  Each
+(task, device) pair is a node in a graph, and a node is dispatched
+as soon as the nodes it depends on for the same device (or for the
+raft containing it, or the CCDs it contains) have finished, rather
+than waiting for every device to finish the previous analysis type.
+The nodes are run in a multiprocessing.Pool on the current node.  For
+the backends that run the tasks on other nodes, DeviceTaskGraph
+.run_by_task runs each task over all of its devices instead, skipping
+the devices whose prerequisites failed.
+"""
+import os
+import time
+import queue
+import logging
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from task_timeout import TaskTimeoutError, task_walltime, WorkerWatchdog, \
+    dead_workers
+
+__all__ = ['DeviceTaskGraph', 'devices_overlap']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+def devices_overlap(device1, device2):
+    """
+    Return True if the two device names refer to the same device or if
+    one is a raft and the other is a CCD in that raft, e.g., 'R22' and
+    'R22_S11'.
+    """
+    return (device1 == device2
+            or device1.startswith(device2 + '_')
+            or device2.startswith(device1 + '_'))
+
+
+def _run_node(task_func, device_name, node=None, running_tasks=None):
+    """
+    Run a task function on a device, printing the traceback if an
+    exception is raised since it is lost when the exception is
+    pickled and returned to the parent process.  If running_tasks is
+    given, the node and its start time are recorded in it, keyed by
+    the pid of the worker, while the task runs.
+    """
+    if running_tasks is not None:
+        running_tasks[os.getpid()] = (node, time.time())
+    try:
+        return task_func(device_name)
+    except Exception as eobj:
+        traceback.print_exc()
+        print('')
+        raise eobj
+    finally:
+        if running_tasks is not None:
+            running_tasks.pop(os.getpid(), None)
+
+
+class DeviceTaskGraph:
+    """
+    Graph of device-level tasks with per-device dependencies.
+
+    Tasks must be added in an order consistent with their dependencies,
+    i.e., every task named in `depends_on` must already be in the graph,
+    so cycles cannot occur.  Tasks that operate on the same device are
+    run one at a time by default, since most of them update the same
+    eotest results file for that device.
+    """
+    def __init__(self):
+        self.tasks = OrderedDict()
+
+    def add_task(self, name, task_func, device_names, depends_on=(),
+                 exclusive=True):
+        """
+        Add a task to the graph.
+
+        Parameters
+        ----------
+        name: str
+            Name of the task, e.g., 'ptc_jh_task'.
+        task_func: function
+            A pickleable function that takes the device name as its
+            single argument.
+        device_names: list
+            Devices (CCDs or rafts) on which to run the task.
+        depends_on: list-like [()]
+            Names of previously added tasks that must have finished for
+            a given device before this task can run on that device.
+        exclusive: bool [True]
+            If True, then this task will not run on a device at the same
+            time as any other task for that device.
+        """
+        if name in self.tasks:
+            raise ValueError(f'task {name} is already in the graph')
+        for dep in depends_on:
+            if dep not in self.tasks:
+                raise ValueError(f'dependency {dep} of task {name} '
+                                 'must be added to the graph first')
+        self.tasks[name] = dict(func=task_func,
+                                device_names=list(device_names),
+                                depends_on=tuple(depends_on),
+                                exclusive=exclusive)
+
+    def nodes(self):
+        """
+        Return the list of (task name, device name) nodes in the order
+        in which they would be dispatched absent any dependencies.
+        """
+        return [(name, device) for name, task in self.tasks.items()
+                for device in task['device_names']]
+
+    def prerequisites(self, node):
+        """Return the set of nodes that must finish before `node`."""
+        name, device = node
+        prereqs = set()
+        for dep in self.tasks[name]['depends_on']:
+            for other in self.tasks[dep]['device_names']:
+                if devices_overlap(device, other):
+                    prereqs.add((dep, other))
+        return prereqs
+
+    def _is_blocked(self, node, running):
+        """
+        Check if a node is blocked by a running node on the same device.
+        """
+        name, device = node
+        for other_name, other_device in running:
+            if not (self.tasks[name]['exclusive']
+                    or self.tasks[other_name]['exclusive']):
+                continue
+            if devices_overlap(device, other_device):
+                return True
+        return False
+
+    def run(self, processes=None, walltime=None, interval=5):
+        """
+        Run all of the tasks in the graph.  Nodes whose pool worker
+        dies, or is killed for exceeding the walltime, are marked as
+        failed, so that their dependents are skipped.
+
+        Parameters
+        ----------
+        processes: int [None]
+            The maximum number of processes to have running at once.
+            If None, then set to 1 or one less than the number of cores,
+            whichever is larger.  The LCATR_PARALLEL_PROCESSES
+            environment variable overrides this value.
+        walltime: float [None]
+            Maximum time in seconds for each node run in the pool.  The
+            LCATR_TASK_WALLTIME environment variable overrides this
+            value.  If None, then there is no limit.
+        interval: float [5]
+            Time in seconds between checks of the pool workers.
+
+        Raises
+        ------
+        RuntimeError: This will be raised if any nodes failed or were
+            skipped because a prerequisite failed.
+        """
+        logger = logging.getLogger('DeviceTaskGraph.run')
+        logger.setLevel(logging.INFO)
+
+        if processes is None:
+            processes = max(1, multiprocessing.cpu_count() - 1)
+        processes = int(os.environ.get('LCATR_PARALLEL_PROCESSES', processes))
+
+        prereqs = {node: self.prerequisites(node) for node in self.nodes()}
+        pending = list(prereqs)
+        running = set()
+        done, failed, skipped = set(), set(), set()
+        completed = queue.Queue()
+        next_check = time.time() + interval
+        lost = set()
+
+        pool, manager, running_tasks, watchdog = None, None, None, None
+        if processes > 1:
+            pool = multiprocessing.Pool(processes=processes)
+            manager = multiprocessing.Manager()
+            running_tasks = manager.dict()
+            walltime = task_walltime(walltime)
+            if walltime is not None:
+                watchdog = WorkerWatchdog(running_tasks, walltime)
+        try:
+            while pending or running:
+                for node in list(pending):
+                    if prereqs[node] & (failed | skipped):
+                        pending.remove(node)
+                        skipped.add(node)
+                        logger.info('Skipping %s for %s', *node)
+                        continue
+                    if (len(running) >= processes
+                            or not prereqs[node] <= done
+                            or self._is_blocked(node, running)):
+                        continue
+                    pending.remove(node)
+                    running.add(node)
+                    self._dispatch(pool, node, completed, running_tasks)
+                if not running:
+                    break
+                if time.time() >= next_check:
+                    # The tasks of workers that died or were killed are
+                    # lost, so their callbacks will never run.
+                    for item in self._lost_nodes(running_tasks, watchdog):
+                        lost.add(item[0])
+                        completed.put(item)
+                    next_check = time.time() + interval
+                try:
+                    node, error = completed.get(timeout=interval)
+                except queue.Empty:
+                    continue
+                if node not in running:
+                    # A lost node whose result arrived after all.
+                    continue
+                running.remove(node)
+                if error is None:
+                    done.add(node)
+                    logger.info('Done: %s for %s', *node)
+                else:
+                    failed.add(node)
+                    logger.info('Failed: %s for %s: %s', *node, error)
+        finally:
+            if pool is not None:
+                # The pool can't be joined while it has lost tasks.
+                if running or lost:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+                manager.shutdown()
+
+        self._check_failures(failed, skipped)
+
+    def run_by_task(self, run_pool):
+        """
+        Run the tasks one at a time, in the order they were added,
+        each over all of its devices whose prerequisites succeeded.
+        This is for backends that dispatch the tasks to other nodes,
+        e.g., parsl or the ssh_dispatcher, with their own placement
+        and retries.
+
+        Parameters
+        ----------
+        run_pool: function
+            Function with (task_func, device_names, on_complete=None)
+            arguments that runs a task over devices and calls
+            on_complete with each device name and a bool indicating
+            success, e.g.,
+            multiprocessor_execution.run_device_analysis_pool.
+            Devices that it doesn't report are taken to have failed
+            if it raises an exception and to have succeeded otherwise.
+
+        Raises
+        ------
+        RuntimeError: This will be raised if any nodes failed or were
+            skipped because a prerequisite failed.
+        """
+        logger = logging.getLogger('DeviceTaskGraph.run_by_task')
+        logger.setLevel(logging.INFO)
+
+        done, failed, skipped = set(), set(), set()
+        for name, task in self.tasks.items():
+            device_names = []
+            for device in task['device_names']:
+                if self.prerequisites((name, device)) <= done:
+                    device_names.append(device)
+                else:
+                    skipped.add((name, device))
+                    logger.info('Skipping %s for %s', name, device)
+            if not device_names:
+                continue
+            reported = dict()
+            def on_complete(device_name, succeeded):
+                reported[device_name] = succeeded
+            try:
+                run_pool(task['func'], device_names, on_complete=on_complete)
+            except Exception as eobj:
+                logger.info('Failed: %s: %s', name, eobj)
+                succeeded = False
+            else:
+                succeeded = True
+            for device in device_names:
+                if reported.get(device, succeeded):
+                    done.add((name, device))
+                else:
+                    failed.add((name, device))
+
+        self._check_failures(failed, skipped)
+
+    @staticmethod
+    def _check_failures(failed, skipped):
+        """Raise a RuntimeError listing any failed or skipped nodes."""
+        messages = []
+        if failed:
+            messages.append(f'  Failed tasks: {sorted(failed)}')
+        if skipped:
+            messages.append('  Tasks skipped because of failed '
+                            f'prerequisites: {sorted(skipped)}')
+        if messages:
+            raise RuntimeError('\n'.join(messages))
+
+    @staticmethod
+    def _lost_nodes(running_tasks, watchdog):
+        """
+        Return (node, error) for the nodes whose pool workers have
+        died or were killed by the watchdog for exceeding the walltime.
+        """
+        if running_tasks is None:
+            return []
+        lost = []
+        if watchdog is not None:
+            eobj = TaskTimeoutError('Task exceeded walltime of '
+                                    f'{watchdog.walltime} s')
+            lost.extend((tuple(node), eobj) for node in watchdog.check())
+        for pid, node in dead_workers(running_tasks):
+            lost.append((tuple(node),
+                         RuntimeError(f'worker process {pid} died')))
+        return lost
+
+    def _dispatch(self, pool, node, completed, running_tasks=None):
+        """
+        Run a node in the pool, or in the current process if pool
+        is None, and put (node, error) in the completed queue when
+        it has finished.  The pool workers record the nodes they are
+        running in running_tasks.
+        """
+        name, device = node
+        func = self.tasks[name]['func']
+        if pool is None:
+            try:
+                _run_node(func, device)
+            except Exception as eobj:
+                completed.put((node, eobj))
+            else:
+                completed.put((node, None))
+            return
+        pool.apply_async(_run_node, (func, device, node, running_tasks),
+                         callback=lambda _: completed.put((node, None)),
+                         error_callback=lambda eobj: completed.put((node,
+                                                                    eobj)))
@@ -0,0 +1,144 @@
+"""
+Placement of device-level tasks on the hosts that hold the staged data
+for the devices, with work stealing by idle hosts.
+"""
+import os
+import json
+from collections import Counter, deque
+from amp_tasks import split_work_item
+
+__all__ = ['read_device_hosts', 'LocalityQueues']
+
+
+def read_device_hosts(device_names, device_map_file='device_list_map.json',
+                      hosts=None):
+    """
+    Return the host holding the staged data for each device, from the
+    host -> device list map written by the data staging (see
+    ssh_dispatcher.TaskRunner.stage_data).
+
+    Parameters
+    ----------
+    device_names: list
+        Devices to look up.  For an amp-level work item, e.g.,
+        'R22_S11:3', the host of its CCD is used, and for a raft, the
+        host with the most CCDs of the raft.
+    device_map_file: str ['device_list_map.json']
+        File with the host -> device list map.
+    hosts: list [None]
+        Hosts that can run the tasks.  Devices staged on other hosts
+        are not placed.  If None, then all hosts are allowed.
+
+    Returns
+    -------
+    dict: The host of each device that could be placed.  This is
+        empty if device_map_file does not exist.
+    """
+    if not os.path.isfile(device_map_file):
+        return dict()
+    with open(device_map_file) as fd:
+        device_list_map = json.load(fd)
+    staged = dict()
+    for host, device_list in device_list_map.items():
+        if hosts is not None and host not in hosts:
+            continue
+        for item in device_list:
+            staged[split_work_item(item)[0]] = host
+    device_hosts = dict()
+    for device_name in device_names:
+        device = split_work_item(device_name)[0]
+        if device in staged:
+            device_hosts[device_name] = staged[device]
+        elif '_' not in device:
+            raft_hosts = Counter(host for ccd, host in staged.items()
+                                 if ccd.startswith(device + '_'))
+            if raft_hosts:
+                device_hosts[device_name] = raft_hosts.most_common(1)[0][0]
+    return device_hosts
+
+
+class LocalityQueues:
+    """
+    Per-host queues of devices to run.  Each host runs the devices
+    whose data it holds, and only once its own queue is empty, i.e.,
+    when it would otherwise be idle, takes the devices with no host,
+    and then steals from the end of the longest queue of another host.
+    """
+    def __init__(self, device_names, device_hosts, slots, max_running=None):
+        """
+        Parameters
+        ----------
+        device_names: list
+            Devices to run, in the order in which they should start.
+        device_hosts: dict
+            Host holding the data for each device, see
+            read_device_hosts.  Devices that are not in this dict can
+            run on any host.
+        slots: dict
+            Number of tasks that can run at once on each host.
+        max_running: int [None]
+            Maximum number of tasks running at once over all of the
+            hosts.  If None, then there is no limit beyond the slots.
+        """
+        self.slots = dict(slots)
+        self.max_running = max_running
+        self.queues = {host: deque() for host in self.slots}
+        self.unplaced = deque()
+        for device_name in device_names:
+            host = device_hosts.get(device_name)
+            if host in self.queues:
+                self.queues[host].append(device_name)
+            else:
+                self.unplaced.append(device_name)
+        self.running = Counter()
+        self.stolen = dict()
+
+    def __len__(self):
+        return len(self.unplaced) + sum(len(_) for _ in self.queues.values())
+
+    def _free(self, host):
+        if (self.max_running is not None
+                and sum(self.running.values()) >= self.max_running):
+            return False
+        return self.running[host] < self.slots[host]
+
+    def _own(self, host):
+        return self.queues[host].popleft() if self.queues[host] else None
+
+    def _unplaced(self, host):
+        return self.unplaced.popleft() if self.unplaced else None
+
+    def _steal(self, host):
+        victim = max(self.queues, key=lambda _: len(self.queues[_]))
+        if not self.queues[victim]:
+            return None
+        device_name = self.queues[victim].pop()
+        self.stolen[device_name] = victim
+        return device_name
+
+    def launch(self):
+        """
+        Return the (device name, host) pairs to start now, given the
+        free slots on the hosts.  The hosts are first filled from their
+        own queues, so that a host only takes other devices once it has
+        run out of its own.
+        """
+        launches = []
+        for take in (self._own, self._unplaced, self._steal):
+            progress = True
+            while progress:
+                progress = False
+                for host in self.slots:
+                    if not self._free(host):
+                        continue
+                    device_name = take(host)
+                    if device_name is None:
+                        continue
+                    self.running[host] += 1
+                    launches.append((device_name, host))
+                    progress = True
+        return launches
+
+    def done(self, host):
+        """Free the slot of a finished task on the host."""
+        self.running[host] -= 1
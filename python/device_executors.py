@@ -0,0 +1,706 @@
+"""
+Asyncio interface for running device-level tasks with interchangeable
+backends:  in-process threads (for tests), forked processes on the
+current node, parsl apps, and ssh_dispatcher tasks on remote hosts.
+The backends share one submit/as_completed/cancel API, and the
+walltime, resource admission, retry and instrumentation logic in this
+module applies to all of them.
+"""
+import os
+import sys
+import time
+import pickle
+import signal
+import asyncio
+import logging
+import traceback
+import multiprocessing
+import concurrent.futures
+from collections import namedtuple, defaultdict
+from task_history import TaskRuntimeHistory, task_name
+from task_failures import TaskFailure, TaskFailedError, FailureReport, \
+    max_task_retries, retry_delay
+from task_timeout import TaskTimeoutError, task_walltime
+from amp_tasks import amp_thread_budget, amp_thread_env
+from memory_admission import TaskMemoryHistory, task_peak_memory, \
+    available_memory, reset_peak_rss, peak_rss
+
+__all__ = ['ResourceHints', 'DeviceExecutor', 'InProcessExecutor',
+           'MultiprocessingExecutor', 'ParslExecutor', 'SshExecutor',
+           'EXECUTORS', 'executor_backend', 'make_executor',
+           'run_device_tasks_async', 'run_device_tasks']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+ResourceHints = namedtuple('ResourceHints', ('cores', 'memory', 'walltime'),
+                           defaults=(1, None, None))
+ResourceHints.__doc__ = """
+Resources needed by a task:  the number of cores, which count against
+the executor's `processes`, the expected peak memory in GB, which
+counts against its `memory_budget`, and the walltime in seconds, after
+which the task is cancelled and raises a TaskTimeoutError.  None means
+no limit.
+"""
+
+
+class RemoteTraceback(Exception):
+    """The formatted traceback of an exception raised in another process."""
+    def __init__(self, tb):
+        super().__init__(tb)
+        self.tb = tb
+
+    def __str__(self):
+        return self.tb
+
+
+class DeviceExecutor:
+    """
+    Base class for the backends.  Subclasses implement the coroutine
+    _execute(task_func, device_name, hints), which runs the task and
+    returns its result, and which stops the task if it is cancelled.
+    The `run_times` and `peak_memory` dicts, keyed by device name, are
+    filled in as the tasks finish, the latter only by backends that
+    measure it.
+    """
+    def __init__(self, processes=None, memory_budget=None):
+        """
+        Parameters
+        ----------
+        processes: int [None]
+            Maximum number of cores used by the running tasks.  If None,
+            then there is no limit.
+        memory_budget: float [None]
+            Maximum expected peak memory in GB of the running tasks.
+            If None, then there is no limit.
+        """
+        self.processes = processes
+        self.memory_budget = memory_budget
+        self.run_times = dict()
+        self.peak_memory = dict()
+        self._condition = None
+        self._condition_loop = None
+        self._cores_used = 0
+        self._memory_used = 0
+
+    def submit(self, task_func, device_name, hints=None, delay=0):
+        """
+        Submit a task for a device.  This must be called from a
+        running event loop.
+
+        Parameters
+        ----------
+        task_func: function or str
+            Task function or command-line script, which take the
+            device name as their argument.
+        device_name: str
+            Device to run the task for.
+        hints: ResourceHints [None]
+            Resources needed by the task.  If None, then use the
+            defaults.
+        delay: float [0]
+            Time in seconds to wait before starting the task.
+
+        Returns
+        -------
+        asyncio.Task: The task, named by the device, whose result is
+            the result of the task function.
+        """
+        hints = ResourceHints() if hints is None else hints
+        return asyncio.get_running_loop().create_task(
+            self._run(task_func, device_name, hints, delay),
+            name=device_name)
+
+    @staticmethod
+    def cancel(task):
+        """Cancel a submitted task, stopping it if it is running."""
+        return task.cancel()
+
+    @staticmethod
+    async def as_completed(tasks):
+        """Asynchronously iterate over the submitted tasks as they finish."""
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task
+
+    def close(self):
+        """Release the resources of the executor."""
+
+    async def _run(self, task_func, device_name, hints, delay):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if (self._condition is None
+                or self._condition_loop is not asyncio.get_running_loop()):
+            self._condition = asyncio.Condition()
+            self._condition_loop = asyncio.get_running_loop()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._fits(hints))
+            self._cores_used += hints.cores
+            self._memory_used += hints.memory or 0
+        try:
+            t0 = time.time()
+            try:
+                result = await asyncio.wait_for(
+                    self._execute(task_func, device_name, hints),
+                    hints.walltime)
+            except asyncio.TimeoutError:
+                raise TaskTimeoutError(f'Task for {device_name} exceeded '
+                                       f'walltime of {hints.walltime} s')
+            self.run_times[device_name] = time.time() - t0
+            return result
+        finally:
+            async with self._condition:
+                self._cores_used -= hints.cores
+                self._memory_used -= hints.memory or 0
+                self._condition.notify_all()
+
+    def _fits(self, hints):
+        if self._cores_used == 0:
+            # Always admit a task if nothing else is running.
+            return True
+        if (self.processes is not None
+                and self._cores_used + hints.cores > self.processes):
+            return False
+        return (self.memory_budget is None or hints.memory is None
+                or self._memory_used + hints.memory <= self.memory_budget)
+
+    async def _execute(self, task_func, device_name, hints):
+        raise NotImplementedError
+
+
+class InProcessExecutor(DeviceExecutor):
+    """
+    Run task functions in threads of the current process.  This is
+    meant for tests:  cancelled tasks are abandoned, but their threads
+    can't be stopped.
+    """
+    def __init__(self, processes=1, memory_budget=None):
+        super().__init__(processes=processes, memory_budget=memory_budget)
+        self._threads = concurrent.futures.ThreadPoolExecutor(
+            max_workers=processes)
+
+    async def _execute(self, task_func, device_name, hints):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._threads, task_func, device_name)
+
+    def close(self):
+        self._threads.shutdown(wait=False)
+
+
+def _run_forked_child(task_func, device_name, write_fd, cores=1):
+    """Run the task in the forked child and send the outcome to the parent."""
+    status = 0
+    try:
+        reset_peak_rss()
+        try:
+            with amp_thread_env(cores):
+                payload = ('result', task_func(device_name), None)
+        except BaseException as eobj:
+            traceback.print_exc()
+            payload = ('error', eobj, traceback.format_exc())
+        payload += (peak_rss(),)
+        try:
+            data = pickle.dumps(payload)
+        except Exception:
+            data = pickle.dumps(('error', RuntimeError(repr(payload[1])),
+                                 payload[2], payload[3]))
+        with os.fdopen(write_fd, 'wb') as output:
+            output.write(data)
+    except BaseException:
+        status = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+class MultiprocessingExecutor(DeviceExecutor):
+    """
+    Run each task function in a process forked from the current one,
+    so that the modules already imported here are shared with the
+    tasks, and a cancelled or timed-out task is stopped by killing its
+    process.  The peak resident memory of each task is measured, and
+    LCATR_AMP_THREADS is set to the task's cores hint, so that it can
+    use that many threads for the amps of a CCD.
+    """
+    def __init__(self, processes=None, memory_budget=None):
+        """
+        Parameters
+        ----------
+        processes: int [None]
+            Maximum number of concurrent tasks.  If None, then use
+            LCATR_PARALLEL_PROCESSES if set, otherwise one less than
+            the number of cores.
+        memory_budget: float [None]
+            Maximum expected peak memory in GB of the running tasks.
+            If None, then use 90% of the memory available on the node.
+        """
+        if processes is None:
+            processes = int(os.environ.get(
+                'LCATR_PARALLEL_PROCESSES',
+                max(1, multiprocessing.cpu_count() - 1)))
+        if memory_budget is None:
+            mem_available = available_memory()
+            if mem_available is not None:
+                memory_budget = 0.9*mem_available
+        super().__init__(processes=processes, memory_budget=memory_budget)
+
+    async def _execute(self, task_func, device_name, hints):
+        loop = asyncio.get_running_loop()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _run_forked_child(task_func, device_name, write_fd, hints.cores)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        finished = loop.create_future()
+        chunks = []
+        def read():
+            try:
+                chunk = os.read(read_fd, 1024**2)
+            except BlockingIOError:
+                return
+            if chunk:
+                chunks.append(chunk)
+            elif not finished.done():
+                finished.set_result(b''.join(chunks))
+        loop.add_reader(read_fd, read)
+        try:
+            data = await finished
+        except asyncio.CancelledError:
+            os.kill(pid, signal.SIGKILL)
+            raise
+        finally:
+            loop.remove_reader(read_fd)
+            os.close(read_fd)
+            os.waitpid(pid, 0)
+        if not data:
+            raise RuntimeError(f'Process for {device_name} exited '
+                               'without returning a result')
+        kind, value, tb, peak_memory = pickle.loads(data)
+        self.peak_memory[device_name] = peak_memory
+        if kind == 'error':
+            raise value from RemoteTraceback(tb)
+        return value
+
+
+class ParslExecutor(DeviceExecutor):
+    """
+    Run task functions or command-line scripts as parsl apps, with the
+    configuration from parsl_ir2_dc_config.
+    """
+    def __init__(self, processes=None, memory_budget=None, cwd=None):
+        """
+        Parameters
+        ----------
+        processes: int [None]
+            Maximum number of concurrent apps.  If None, then use
+            LCATR_PARALLEL_PROCESSES if set, otherwise one less than
+            the number of parsl threads.
+        memory_budget: float [None]
+            Maximum expected peak memory in GB of the running apps.
+        cwd: str [None]
+            Working directory for the apps on the worker nodes.
+        """
+        import siteUtils
+        from parsl_ir2_dc_config import load_ir2_dc_config, \
+            max_parsl_threads
+        from parsl_execution import ParslSubmitter
+        load_ir2_dc_config()
+        if processes is None:
+            processes = int(os.environ.get('LCATR_PARALLEL_PROCESSES',
+                                           max(1, max_parsl_threads() - 1)))
+        super().__init__(processes=processes, memory_budget=memory_budget)
+        self.cwd = cwd
+        self.lcatr_envs = siteUtils.get_lcatr_envs()
+        self.submitter = ParslSubmitter()
+
+    async def _execute(self, task_func, device_name, hints):
+        from parsl_execution import bash_wrapper, python_wrapper
+        if isinstance(task_func, str):
+            app, time_kwds = bash_wrapper, dict(walltime=hints.walltime)
+        else:
+            app, time_kwds = python_wrapper, dict(time_limit=hints.walltime)
+        future = self.submitter.submit(app, device_name, task_func,
+                                       device_name, cwd=self.cwd,
+                                       lcatr_envs=self.lcatr_envs,
+                                       logger=None, **time_kwds)
+        # Cancelling the wrapped future cancels the app if it hasn't
+        # started.
+        return await asyncio.wrap_future(future)
+
+
+class SshExecutor(DeviceExecutor):
+    """
+    Run command-line task scripts on remote hosts with the
+    ssh_dispatcher.  The status files of all of the running tasks are
+    checked with one directory listing per polling interval, and a
+    cancelled task is killed on its host.  A task waits for a host to
+    have room for it, and frees its place on the host when it
+    finishes.  Data staging is not done here; use
+    ssh_device_analysis_pool for jobs that need it.
+    """
+    def __init__(self, processes=None, memory_budget=None, cwd='.',
+                 setup=None, remote_hosts=None, interval=1):
+        """
+        Parameters
+        ----------
+        processes: int [None]
+            Maximum number of concurrent tasks over all hosts.  If
+            None, then there is no limit apart from the host capacity.
+        memory_budget: float [None]
+            Maximum expected peak memory in GB of the running tasks.
+        cwd: str ['.']
+            Working directory for the tasks on the remote hosts.
+        setup: str [None]
+            Setup script for the task runtime environment.  If None,
+            then use LCATR_SETUP_SCRIPT if set, otherwise
+            $INST_DIR/setup.sh.
+        remote_hosts: iterable [None]
+            Iterable that provides the remote host for each task.  If
+            None, then use ssh_dispatcher.default_remote_hosts.
+        interval: float [1]
+            Polling interval in seconds for the status files.
+        """
+        super().__init__(processes=processes, memory_budget=memory_budget)
+        self.cwd = os.path.abspath(cwd)
+        if setup is None:
+            setup = os.environ.get(
+                'LCATR_SETUP_SCRIPT',
+                os.path.join(os.environ.get('INST_DIR', ''), 'setup.sh'))
+        self.setup = setup
+        self.remote_hosts = remote_hosts
+        self.interval = interval
+        self.runners = dict()
+        self._waiters = dict()
+        self._poller = None
+        self._hosts_condition = None
+        self._hosts_loop = None
+
+    def runner(self, task_script, hints):
+        """The ssh_dispatcher.TaskRunner for a task script."""
+        from ssh_dispatcher import TaskRunner
+        if task_script not in self.runners:
+            runner = TaskRunner(task_script, self.cwd, self.setup,
+                                remote_hosts=self.remote_hosts,
+                                mem_per_task=hints.memory or 2.)
+            runner.host_map = dict()
+            self.runners[task_script] = runner
+        return self.runners[task_script]
+
+    def _condition_for_hosts(self):
+        if (self._hosts_condition is None
+                or self._hosts_loop is not asyncio.get_running_loop()):
+            self._hosts_condition = asyncio.Condition()
+            self._hosts_loop = asyncio.get_running_loop()
+        return self._hosts_condition
+
+    async def reserve_host(self, remote_hosts):
+        """
+        Return the host for a task from remote_hosts, waiting for a
+        running task to finish if the task doesn't fit on any host,
+        i.e., if a LoadAwareHosts returns None.
+        """
+        condition = self._condition_for_hosts()
+        async with condition:
+            while True:
+                remote_host = next(remote_hosts)
+                if remote_host is not None:
+                    return remote_host
+                await condition.wait()
+
+    async def release_host(self, remote_hosts, remote_host):
+        """
+        Remove a finished task from the tasks assigned to its host, so
+        that the host can take another one.
+        """
+        condition = self._condition_for_hosts()
+        async with condition:
+            assigned = getattr(remote_hosts, 'assigned', None)
+            if assigned is not None and assigned[remote_host] > 0:
+                assigned[remote_host] -= 1
+            condition.notify_all()
+
+    async def _execute(self, task_script, device_name, hints):
+        runner = self.runner(task_script, hints)
+        remote_host = await self.reserve_host(runner.remote_hosts)
+        try:
+            return await self._execute_on(runner, task_script, device_name,
+                                          remote_host)
+        finally:
+            await self.release_host(runner.remote_hosts, remote_host)
+
+    async def _execute_on(self, runner, task_script, device_name,
+                          remote_host):
+        loop = asyncio.get_running_loop()
+        runner.host_map[device_name] = remote_host
+        runner.make_log_file(device_name)
+        if runner.warm_workers:
+            await loop.run_in_executor(None, runner.start_warm_workers,
+                                       [remote_host])
+        runner.start_times[device_name] = time.time()
+        await loop.run_in_executor(None, runner.launch_script,
+                                   remote_host, device_name)
+        finished = loop.create_future()
+        self._waiters[(task_script, device_name)] = finished
+        if self._poller is None or self._poller.done():
+            self._poller = loop.create_task(self._poll())
+        try:
+            status = await finished
+        except asyncio.CancelledError:
+            await loop.run_in_executor(None, runner.kill_task, remote_host,
+                                       runner.pid_files[device_name])
+            raise
+        finally:
+            self._waiters.pop((task_script, device_name), None)
+        if device_name in runner.peak_memory:
+            self.peak_memory[device_name] = runner.peak_memory[device_name]
+        if status != 'succeeded':
+            raise RuntimeError(f'{task_name(task_script)} failed for '
+                               f'{device_name} on {remote_host}; see '
+                               f'{runner.log_files[device_name]}')
+        return None
+
+    async def _poll(self):
+        while self._waiters:
+            status_names = dict()
+            for (task_script, device_name), finished \
+                    in list(self._waiters.items()):
+                runner = self.runners[task_script]
+                if runner.status_dir not in status_names:
+                    status_names[runner.status_dir] \
+                        = set(os.listdir(runner.status_dir))
+                status = runner.task_status(
+                    device_name, status_names=status_names[runner.status_dir])
+                if status is not None and not finished.done():
+                    finished.set_result(status)
+            await asyncio.sleep(self.interval)
+
+
+EXECUTORS = dict(in_process=InProcessExecutor,
+                 multiprocessing=MultiprocessingExecutor,
+                 parsl=ParslExecutor,
+                 ssh=SshExecutor)
+
+
+def executor_backend():
+    """
+    Name of the backend for device-level tasks:  the value of
+    LCATR_EXECUTOR, if set, otherwise 'parsl' if LCATR_USE_PARSL=True,
+    'ssh' for the Cryostat, which uses the diagnostic cluster, or
+    'multiprocessing' for the current node.
+    """
+    if 'LCATR_EXECUTOR' in os.environ:
+        return os.environ['LCATR_EXECUTOR']
+    if os.environ.get('LCATR_USE_PARSL', False) == 'True':
+        return 'parsl'
+    import siteUtils
+    if siteUtils.getUnitType() == 'LCA-10134_Cryostat':
+        return 'ssh'
+    return 'multiprocessing'
+
+
+def make_executor(backend=None, processes=None, cwd=None):
+    """
+    Create the executor for a backend.
+
+    Parameters
+    ----------
+    backend: str [None]
+        Name of the backend in EXECUTORS.  If None, then use
+        executor_backend().
+    processes: int [None]
+        Maximum number of concurrent tasks.  If None, then use the
+        backend's default.
+    cwd: str [None]
+        Working directory for the parsl and ssh backends.
+    """
+    if backend is None:
+        backend = executor_backend()
+    executor_class = EXECUTORS[backend]
+    kwds = dict(processes=processes)
+    if backend in ('parsl', 'ssh') and cwd is not None:
+        kwds['cwd'] = cwd
+    if backend == 'in_process' and processes is None:
+        kwds['processes'] = 1
+    return executor_class(**kwds)
+
+
+async def run_device_tasks_async(executor, task_func, device_names,
+                                 hints=None, max_retries=None,
+                                 on_complete=None, report=None):
+    """
+    Run a task for each device with an executor, retrying failed
+    devices with exponential backoff.
+
+    Parameters
+    ----------
+    executor: DeviceExecutor
+        The executor to use.
+    task_func: function or str
+        Task function or command-line script.
+    device_names: list
+        Devices to run the task for, in the order they should start.
+    hints: ResourceHints [None]
+        Resources needed by each task.
+    max_retries: int [None]
+        Number of retries for a failed device, see
+        task_failures.max_task_retries.  Devices that exceed the
+        walltime are not retried.
+    on_complete: function [None]
+        Function called with the device name and a bool indicating
+        success when a device succeeds or fails for the last time.
+    report: FailureReport [None]
+        Report of the failed attempts.  If None, then use the default
+        FailureReport for the task.
+
+    Returns
+    -------
+    list: The task results in the order of device_names.
+
+    Raises
+    ------
+    task_failures.TaskFailedError: If any devices failed after all
+        retries.
+    """
+    logger = logging.getLogger('run_device_tasks')
+    logger.setLevel(logging.INFO)
+
+    task = task_name(task_func)
+    max_retries = max_task_retries(max_retries)
+    if report is None:
+        report = FailureReport(task)
+    attempts = defaultdict(int)
+    results = dict()
+    failures = dict()
+    running = {executor.submit(task_func, _, hints): _ for _ in device_names}
+    try:
+        while running:
+            done, _ = await asyncio.wait(running,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                device_name = running.pop(future)
+                attempts[device_name] += 1
+                eobj = future.exception()
+                if eobj is None:
+                    results[device_name] = future.result()
+                    if on_complete is not None:
+                        on_complete(device_name, True)
+                    continue
+                failure = TaskFailure(
+                    device_name, repr(eobj),
+                    ''.join(traceback.format_exception(type(eobj), eobj,
+                                                       eobj.__traceback__)),
+                    isinstance(eobj, TaskTimeoutError))
+                final = failure.timed_out \
+                        or attempts[device_name] > max_retries
+                report.record(failure, attempts[device_name], final)
+                if final:
+                    failures[device_name] = failure
+                    if on_complete is not None:
+                        on_complete(device_name, False)
+                    continue
+                delay = retry_delay(attempts[device_name])
+                logger.info('Retrying %s for %s in %s s', task,
+                            device_name, delay)
+                running[executor.submit(task_func, device_name, hints,
+                                        delay=delay)] = device_name
+    finally:
+        for future in running:
+            executor.cancel(future)
+        if running:
+            await asyncio.wait(running)
+    if failures:
+        raise TaskFailedError(task, failures)
+    return [results[_] for _ in device_names]
+
+
+def run_device_tasks(task_func, device_names, backend=None, processes=None,
+                     cwd=None, walltime=3600, max_retries=None,
+                     on_complete=None, executor=None):
+    """
+    Run a device-level task over a collection of devices with one of
+    the executor backends.
+
+    Parameters
+    ----------
+    task_func: function or str
+        Pickleable task function or command-line script that takes the
+        device name as its argument.
+    device_names: list
+        Devices to run the task for.
+    backend: str [None]
+        Name of the backend in EXECUTORS.  If None, then use
+        executor_backend().
+    processes: int [None]
+        Maximum number of concurrent tasks.  If None, then use the
+        backend's default.
+    cwd: str [None]
+        Working directory for the parsl and ssh backends.
+    walltime: float [3600]
+        Walltime in seconds for each task.  The LCATR_TASK_WALLTIME
+        environment variable overrides this value, and a value <= 0
+        means no limit.
+    max_retries: int [None]
+        Number of retries for a failed device, see
+        task_failures.max_task_retries.
+    on_complete: function [None]
+        Function called with the device name and a bool indicating
+        success when a device succeeds or fails for the last time.
+    executor: DeviceExecutor [None]
+        Executor to use instead of creating one for the backend.  It
+        is not closed afterwards.
+
+    Returns
+    -------
+    list: The task results in the order of device_names.
+
+    Notes
+    -----
+    If LCATR_USE_TASK_HISTORY is not False, the devices are started in
+    order of decreasing wall time, the memory hint is taken from the
+    measured peak memory (see memory_admission.task_peak_memory), and
+    the wall times and peak memory of the tasks are recorded.
+    """
+    task = task_name(task_func)
+    history = None
+    memory_history = None
+    if os.environ.get('LCATR_USE_TASK_HISTORY', 'True') == 'True':
+        history = TaskRuntimeHistory()
+        memory_history = TaskMemoryHistory()
+        device_names = history.order(task, device_names)
+    close = executor is None
+    if executor is None:
+        executor = make_executor(backend, processes=processes, cwd=cwd)
+    cores = 1
+    if isinstance(executor, MultiprocessingExecutor):
+        # Share the executor's cores among the amps of each CCD.
+        cores = min(executor.processes,
+                    amp_thread_budget(executor.processes, len(device_names),
+                                      cores=executor.processes))
+    hints = ResourceHints(cores=cores,
+                          memory=task_peak_memory(task, device_names,
+                                                  memory_history),
+                          walltime=task_walltime(walltime))
+    executor.run_times.clear()
+    executor.peak_memory.clear()
+    try:
+        return asyncio.run(run_device_tasks_async(
+            executor, task_func, device_names, hints=hints,
+            max_retries=max_retries, on_complete=on_complete))
+    finally:
+        if history is not None:
+            for device_name, run_time in executor.run_times.items():
+                history.record(task, device_name, run_time)
+            for device_name, peak_memory in executor.peak_memory.items():
+                memory_history.record(task, device_name, peak_memory)
+            history.save()
+            memory_history.save()
+        if close:
+            executor.close()
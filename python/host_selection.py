@@ -0,0 +1,308 @@
+"""
+Selection of diagnostic cluster hosts for remote tasks based on the
+load average, free memory, and free scratch space of each node.
+"""
+import os
+import re
+import socket
+import logging
+import subprocess
+from collections import namedtuple, Counter
+from concurrent.futures import ThreadPoolExecutor
+
+__all__ = ['HostStatus', 'SshHostProbe', 'LoadAwareHosts', 'ir2_host_names',
+           'worker_node_names', 'probe_hosts', 'workers_per_host']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+HostStatus = namedtuple('HostStatus',
+                        ('load', 'ncores', 'mem_available', 'scratch_free'))
+HostStatus.__doc__ = """
+Snapshot of a host's resources: 1-minute load average, number of
+cores, and available memory and free scratch space in GB.
+"""
+
+
+def ir2_host_names():
+    """
+    Return the lsst-dc* host names, excluding the current host and
+    any hosts in the '_'-delimited LCATR_BAD_NODES list.
+    """
+    bad_nodes = os.environ.get('LCATR_BAD_NODES', '').split('_')
+    hosts = []
+    for i in range(1, 11):
+        host = f'lsst-dc{i:02}'
+        if host in socket.gethostname() or host in bad_nodes:
+            continue
+        hosts.append(host)
+    return hosts
+
+
+def worker_node_names(node_file=None):
+    """
+    Return the names of the worker nodes for parsl, excluding the
+    current host:  the hosts listed in node_file, one per line with '#'
+    comments, if given, otherwise in the file given by the
+    LCATR_PARSL_NODE_FILE environment variable, if set, otherwise the
+    comma-, space- or '_'-delimited LCATR_PARSL_NODES list, if set,
+    otherwise ir2_host_names().  The node file is read on each call,
+    so nodes can be added or dropped while a job is running by
+    editing it.
+    """
+    if node_file is None:
+        node_file = os.environ.get('LCATR_PARSL_NODE_FILE', None)
+    if node_file is not None:
+        with open(node_file) as fd:
+            hosts = [_.split('#')[0].strip() for _ in fd]
+    elif 'LCATR_PARSL_NODES' in os.environ:
+        hosts = re.split(r'[,_\s]+', os.environ['LCATR_PARSL_NODES'])
+    else:
+        return ir2_host_names()
+    current_host = socket.gethostname().split('.')[0]
+    return [_ for _ in dict.fromkeys(hosts) if _ and _ != current_host]
+
+
+def probe_hosts(hosts, probe=None):
+    """
+    Measure the resources of the hosts concurrently.
+
+    Parameters
+    ----------
+    hosts: list
+        Host names.
+    probe: function [None]
+        Function that takes a host name and returns a HostStatus.  If
+        None, then use SshHostProbe().
+
+    Returns
+    -------
+    dict: HostStatus keyed by host for the hosts that could be probed.
+    """
+    logger = logging.getLogger('probe_hosts')
+    logger.setLevel(logging.INFO)
+    probe = SshHostProbe() if probe is None else probe
+    if not hosts:
+        return dict()
+    with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+        futures = {host: executor.submit(probe, host) for host in hosts}
+    statuses = dict()
+    for host, future in futures.items():
+        try:
+            statuses[host] = future.result()
+        except Exception as eobj:
+            logger.info('Excluding %s: probe failed: %s', host, eobj)
+    return statuses
+
+
+def workers_per_host(statuses, mem_per_worker=None, mem_fraction=0.9):
+    """
+    Number of workers to run on each host:  one per core, limited so
+    that the workers' expected memory fits in the available memory.
+
+    Parameters
+    ----------
+    statuses: dict
+        HostStatus keyed by host.
+    mem_per_worker: float [None]
+        Expected peak memory in GB of each worker.  If None, then use
+        LCATR_PARSL_MEM_PER_WORKER if set, otherwise 2.
+    mem_fraction: float [0.9]
+        Fraction of the available memory to use.
+
+    Returns
+    -------
+    dict: The number of workers keyed by host.
+    """
+    if mem_per_worker is None:
+        mem_per_worker = float(os.environ.get('LCATR_PARSL_MEM_PER_WORKER',
+                                              2))
+    return {host: max(1, int(min(status.ncores, mem_fraction
+                                 *status.mem_available/mem_per_worker)))
+            for host, status in statuses.items()}
+
+
+class SshHostProbe:
+    """
+    Functor class to measure the resources of a remote host via ssh.
+    """
+    def __init__(self, scratch_dir=None, timeout=10):
+        """
+        Parameters
+        ----------
+        scratch_dir: str [None]
+            Scratch area to check for free space.  If None, then use
+            LCATR_SCRATCH_DIR if set, otherwise /scratch.
+        timeout: float [10]
+            Timeout in seconds for the ssh command.
+        """
+        if scratch_dir is None:
+            scratch_dir = os.environ.get('LCATR_SCRATCH_DIR', '/scratch')
+        self.scratch_dir = scratch_dir
+        self.timeout = timeout
+
+    def __call__(self, host):
+        command = ['ssh', '-o', 'BatchMode=yes', host,
+                   'cat /proc/loadavg; nproc; '
+                   'grep MemAvailable /proc/meminfo; '
+                   f'df -Pk {self.scratch_dir} | tail -1']
+        output = subprocess.check_output(command, timeout=self.timeout,
+                                         universal_newlines=True)
+        return self.parse(output)
+
+    @staticmethod
+    def parse(output):
+        """Parse the output of the probe command into a HostStatus."""
+        lines = output.strip().split('\n')
+        load = float(lines[0].split()[0])
+        ncores = int(lines[1])
+        mem_available = float(lines[2].split()[1])/1024**2
+        scratch_free = float(lines[3].split()[3])/1024**2
+        return HostStatus(load, ncores, mem_available, scratch_free)
+
+
+class LoadAwareHosts:
+    """
+    Iterator class to provide host names for remote tasks, placing
+    each task on the host with the most spare capacity given its
+    measured load and memory and the tasks already assigned to it.
+    Hosts that cannot be probed, or that have too little free memory
+    or scratch space, are not used.
+    """
+    def __init__(self, hosts=None, probe=None, mem_per_task=2.,
+                 min_scratch_free=None):
+        """
+        Parameters
+        ----------
+        hosts: list [None]
+            Candidate host names.  If None, then use ir2_host_names().
+        probe: function [None]
+            Function that takes a host name and returns a HostStatus,
+            raising an exception if the host is unavailable.  If None,
+            then use SshHostProbe().
+        mem_per_task: float [2.]
+            Expected peak memory in GB for each task.
+        min_scratch_free: float [None]
+            Minimum free scratch space in GB for a host to be used.  If
+            None, then use LCATR_MIN_SCRATCH_GB if set, otherwise 20.
+        """
+        self.candidates = ir2_host_names() if hosts is None else list(hosts)
+        self.probe = SshHostProbe() if probe is None else probe
+        self.mem_per_task = mem_per_task
+        if min_scratch_free is None:
+            min_scratch_free = float(os.environ.get('LCATR_MIN_SCRATCH_GB',
+                                                    20))
+        self.min_scratch_free = min_scratch_free
+        self.status = None
+        self.assigned = Counter()
+        self.refresh()
+
+    def refresh(self, force=True):
+        """
+        Measure the resources of the candidate hosts and clear the
+        task assignment counts, e.g., before each batch of tasks.  If
+        force is False, then the hosts are only measured again if tasks
+        have been assigned since the last measurement.
+        """
+        if not force and self.status is not None and not self.assigned:
+            return
+        logger = logging.getLogger('LoadAwareHosts.refresh')
+        logger.setLevel(logging.INFO)
+
+        nworkers = max(1, len(self.candidates))
+        with ThreadPoolExecutor(max_workers=nworkers) as executor:
+            futures = {host: executor.submit(self.probe, host)
+                       for host in self.candidates}
+        self.status = dict()
+        for host, future in futures.items():
+            try:
+                status = future.result()
+            except Exception as eobj:
+                logger.info('Excluding %s: probe failed: %s', host, eobj)
+                continue
+            if status.scratch_free < self.min_scratch_free:
+                logger.info('Excluding %s: %.1f GB free scratch', host,
+                            status.scratch_free)
+                continue
+            if status.mem_available < self.mem_per_task:
+                logger.info('Excluding %s: %.1f GB available memory', host,
+                            status.mem_available)
+                continue
+            self.status[host] = status
+        if not self.status:
+            logger.info('No hosts passed the resource checks. '
+                        'Using all candidate hosts.')
+            self.status = {host: HostStatus(0, 1, float('inf'), float('inf'))
+                           for host in self.candidates}
+        self.assigned = Counter()
+
+    @property
+    def hosts(self):
+        """The hosts that can be used."""
+        return [_ for _ in self.candidates if _ in self.status]
+
+    @property
+    def num_hosts(self):
+        """The number of hosts that can be used."""
+        return len(self.status)
+
+    def capacity(self, mem_fraction=0.9):
+        """
+        Number of tasks that fit in the available memory of the usable
+        hosts, with at most one task per core on each host.
+        """
+        total = 0
+        for status in self.status.values():
+            total += int(min(status.ncores, mem_fraction*status.mem_available
+                             /self.mem_per_task))
+        return max(1, total)
+
+    def utilization(self, host, extra_tasks=1):
+        """
+        Fractional utilization of the host's cores or memory, whichever
+        is larger, if `extra_tasks` more tasks were assigned to it.
+        """
+        status = self.status[host]
+        ntasks = self.assigned[host] + extra_tasks
+        cpu = (status.load + ntasks)/status.ncores
+        mem = ntasks*self.mem_per_task/status.mem_available
+        return max(cpu, mem)
+
+    def fits(self, host, ntasks, mem_fraction=0.9):
+        """
+        Return True if `ntasks` more tasks fit in the available memory
+        of the host.  A host with no tasks assigned always takes them,
+        so that every task can be run.
+        """
+        if not self.assigned[host]:
+            return True
+        return ((self.assigned[host] + ntasks)*self.mem_per_task
+                <= mem_fraction*self.status[host].mem_available)
+
+    def __next__(self):
+        return self.reserve(1)
+
+    def reserve(self, ntasks, host=None):
+        """
+        Assign a group of tasks that should run on the same host,
+        e.g., the CCDs of a raft, and return that host, or None if
+        the group doesn't fit in the memory of any host.
+
+        Parameters
+        ----------
+        ntasks: int
+            Number of tasks in the group.
+        host: str [None]
+            Preferred host, used if it is usable and the group fits in
+            its memory.  Otherwise, the host that would be least
+            utilized with the group is chosen.
+        """
+        if host not in self.status or not self.fits(host, ntasks):
+            hosts = [_ for _ in self.hosts if self.fits(_, ntasks)]
+            if not hosts:
+                return None
+            host = min(hosts, key=lambda _: self.utilization(_, ntasks))
+        self.assigned[host] += ntasks
+        return host
+
+    def __iter__(self):
+        return self
@@ -0,0 +1,159 @@
+"""
+Memory-based admission control for device-level tasks:  the peak
+resident memory of each task is measured and recorded, and the number
+of tasks run at once on a node is limited so that their expected peak
+memory fits in the node's available memory.
+"""
+import os
+import resource
+from task_history import TaskRuntimeHistory, history_key
+
+__all__ = ['TaskMemoryHistory', 'DECLARED_PEAK_MEMORY', 'task_peak_memory',
+           'available_memory', 'memory_limited_processes',
+           'reset_peak_rss', 'peak_rss']
+
+# Peak memory in GB declared for tasks known to need more than the
+# default.  These are only used until the peak memory of a task has
+# been measured.
+DEFAULT_PEAK_MEMORY = 2.
+DECLARED_PEAK_MEMORY = {'flat_pairs_jh_task': 6.,
+                        'ptc_jh_task': 4.,
+                        'bf_jh_task': 4.,
+                        'persistence_jh_task': 4.,
+                        'raft_jh_noise_correlations': 8.,
+                        'scan_mode_analysis_jh_task': 8.,
+                        'raft_results_task': 8.}
+
+
+class TaskMemoryHistory(TaskRuntimeHistory):
+    """
+    Class to record and query the peak resident memory in GB of
+    device-level tasks.  The values are kept in the same way as the
+    wall times in TaskRuntimeHistory, but in their own file, given by
+    LCATR_TASK_MEMORY_FILE or ~/.lcatr/task_peak_memory.json.
+    """
+    env_var = 'LCATR_TASK_MEMORY_FILE'
+    default_file = 'task_peak_memory.json'
+
+    def peak(self, task, device_names=()):
+        """
+        Largest recorded peak memory for a task run on any of the
+        devices, or if there are no values for those devices, on any
+        device.  None is returned if the task has no history.  The
+        amp-level work items are kept separately (see
+        task_history.history_key).
+        """
+        keys = {history_key(task, _) for _ in device_names} or {task}
+        values, all_values = [], []
+        for key in keys:
+            task_values = self.wall_times.get(key, {})
+            values.extend(value for device in device_names
+                          for value in task_values.get(device, []))
+            all_values.extend(value for device_values in task_values.values()
+                              for value in device_values)
+        values = values or all_values
+        return max(values) if values else None
+
+
+def task_peak_memory(task, device_names=(), history=None, margin=1.2):
+    """
+    Expected peak memory in GB for a task.
+
+    Parameters
+    ----------
+    task: str
+        Task name.
+    device_names: list [()]
+        Devices the task will be run on.
+    history: TaskMemoryHistory [None]
+        History of measured peak memory.  If None, then only the
+        declared values are used.
+    margin: float [1.2]
+        Factor applied to measured values to allow for variations
+        from run to run.
+
+    Returns
+    -------
+    float: The value of LCATR_TASK_MEMORY_GB if set, otherwise the
+        measured peak memory times the margin, otherwise the declared
+        value for the task, or 2 GB if there is none.
+    """
+    if 'LCATR_TASK_MEMORY_GB' in os.environ:
+        return float(os.environ['LCATR_TASK_MEMORY_GB'])
+    if history is not None:
+        peak = history.peak(task, device_names)
+        if peak is not None:
+            return margin*peak
+    return DECLARED_PEAK_MEMORY.get(task, DEFAULT_PEAK_MEMORY)
+
+
+def available_memory(meminfo='/proc/meminfo'):
+    """
+    Memory in GB available for new processes on the current node, or
+    None if it can't be determined.
+    """
+    try:
+        with open(meminfo) as fd:
+            for line in fd:
+                if line.startswith('MemAvailable:'):
+                    return float(line.split()[1])/1024**2
+    except OSError:
+        pass
+    return None
+
+
+def memory_limited_processes(processes, mem_per_task, mem_fraction=0.9,
+                             mem_available=None):
+    """
+    Limit the number of concurrent tasks so that their peak memory
+    fits in the available memory of the current node.
+
+    Parameters
+    ----------
+    processes: int
+        Requested number of processes.
+    mem_per_task: float
+        Expected peak memory in GB for each task.
+    mem_fraction: float [0.9]
+        Fraction of the available memory that the tasks may use.
+    mem_available: float [None]
+        Available memory in GB.  If None, then use available_memory().
+
+    Returns
+    -------
+    int: The number of processes, at least 1.
+    """
+    if mem_available is None:
+        mem_available = available_memory()
+    if mem_available is None or mem_per_task <= 0:
+        return processes
+    return max(1, min(processes, int(mem_fraction*mem_available/mem_per_task)))
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident memory of the current process so that the
+    next peak_rss() call measures the peak from now on.  This is a
+    no-op if the kernel doesn't support it.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    """
+    Peak resident memory in GB of the current process since the last
+    reset_peak_rss() call, or since the process started.
+    """
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmHWM:'):
+                    return float(line.split()[1])/1024**2
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024**2
@@ -3,6 +3,13 @@ Function to parallelize subcomponent analyses for an assembly such
 as raft or full focal plane.
 """
 import os
+import gc
+import atexit
+import sys
+import time
+import logging
+import importlib
+import threading
 import multiprocessing
 import traceback
 import warnings
@@ -15,8 +22,24 @@ except ImportError as eobj:
     #warnings.warn(f'ImportError: {eobj}')
     pass
 from ssh_dispatcher import ssh_device_analysis_pool
+from task_history import TaskRuntimeHistory, task_name
+from memory_admission import TaskMemoryHistory, task_peak_memory, \
+    memory_limited_processes, reset_peak_rss, peak_rss
+from task_timeout import TaskTimeoutError, WorkerWatchdog, task_walltime, \
+    deadline, run_with_deadline, dead_workers
+from task_failures import TaskFailure, TaskFailedError, FailureReport, \
+    max_task_retries, retry_delay
+from device_executors import executor_backend, run_device_tasks
+from amp_tasks import amp_thread_budget, amp_thread_env
+from worker_recycling import worker_max_tasks, worker_max_rss, current_rss, \
+    WorkerMemoryReport
 
-__all__ = ['sensor_analyses', 'run_device_analysis_pool']
+__all__ = ['sensor_analyses', 'run_device_analysis_pool', 'DevicePool',
+           'shared_device_pool']
+
+# Shared dict of worker pid -> (device name, start time) for the
+# pool workers, set by the pool initializer.
+_RUNNING_TASKS = None
 
 
 class TracebackDecorator:
@@ -33,8 +56,214 @@ class TracebackDecorator:
             raise eobj
 
 
+class TimedTask:
+    """
+    Class to run a task function over a chunk of devices in a
+    multiprocessing.Pool worker and return the wall time and peak
+    resident memory in GB for each device along with the task function
+    results.  Exceptions raised by the task function are returned as
+    TaskFailure tuples, so that a failure on one device doesn't lose
+    the results for the other devices in the chunk.  The worker's pid
+    and resident memory before and after each device, once the worker
+    has cleaned up, are also returned, so that memory left behind by
+    the tasks can be found.  If amp_threads is given,
+    LCATR_AMP_THREADS is set to it while the task function runs (see
+    amp_tasks.map_amps).
+    """
+    def __init__(self, func, amp_threads=None):
+        self.func = func
+        self.amp_threads = amp_threads
+    def __call__(self, device_names):
+        with amp_thread_env(self.amp_threads):
+            return self._run(device_names)
+    def _run(self, device_names):
+        results = []
+        for device_name in device_names:
+            rss_before = current_rss()
+            reset_peak_rss()
+            t0 = time.time()
+            if _RUNNING_TASKS is not None:
+                # Let the parent's WorkerWatchdog know what this
+                # worker is running.
+                _RUNNING_TASKS[os.getpid()] = (device_name, t0)
+            result, failure = None, None
+            try:
+                result = self.func(device_name)
+            except Exception as eobj:
+                failure = TaskFailure(device_name, repr(eobj),
+                                      traceback.format_exc(),
+                                      isinstance(eobj, TaskTimeoutError))
+            finally:
+                if _RUNNING_TASKS is not None:
+                    _RUNNING_TASKS.pop(os.getpid(), None)
+            wall_time, peak_memory = time.time() - t0, peak_rss()
+            _clean_up_worker()
+            results.append((device_name, result, wall_time, peak_memory,
+                            failure, (os.getpid(), rss_before,
+                                      current_rss())))
+        return results
+
+
+def _clean_up_worker():
+    """
+    Release per-task state in a worker process so that the next task,
+    possibly from a different jh_task, starts from a clean slate.
+    """
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    gc.collect()
+
+
+def _init_worker(module_names=(), running_tasks=None):
+    """
+    Pool initializer to set the shared dict of running tasks and to
+    import the analysis modules once per worker.
+    """
+    global _RUNNING_TASKS
+    _RUNNING_TASKS = running_tasks
+    for module_name in module_names:
+        try:
+            importlib.import_module(module_name)
+        except ImportError:
+            pass
+
+
+def _use_multiprocessing():
+    """
+    Return True if device-level tasks will be run with a
+    multiprocessing.Pool on the current node rather than with parsl
+    or the ssh_dispatcher.
+    """
+    return executor_backend() == 'multiprocessing'
+
+
+class DevicePool:
+    """
+    Context manager for a multiprocessing.Pool that is reused by
+    successive run_device_analysis_pool calls, e.g., for all of the
+    jh_tasks of one producer (see shared_device_pool), so that the
+    worker processes and their imports are set up once.  Each
+    run_device_analysis_pool call waits for all of its devices to
+    finish, and the workers clean up after every device, so no state
+    is carried from one jh_task to the next.
+
+    If the tasks will not be run with multiprocessing on the current
+    node, or only one process would be used, then no pool is created
+    and the `pool` attribute is None.
+
+    If a worker is killed for exceeding the walltime, the pool is
+    marked as broken, since the lost task prevents it from being
+    closed cleanly.  It is then terminated on exit, and
+    shared_device_pool replaces it.
+
+    Memory that the tasks leave behind in the workers, e.g., from
+    matplotlib figures, afw images, or cached HDUs, is recovered by
+    replacing the workers, either after each has run max_tasks chunks
+    of devices, or when recycle() is called, e.g., because a worker's
+    resident memory exceeds LCATR_WORKER_MAX_RSS_GB.
+    """
+    def __init__(self, processes=None,
+                 preload_modules=('bot_eo_analyses',), max_tasks=None):
+        """
+        Parameters
+        ----------
+        processes: int [None]
+            Number of worker processes.  If None, then set to 1 or one
+            less than the number of cores, whichever is larger.  The
+            LCATR_PARALLEL_PROCESSES environment variable overrides
+            this value.
+        preload_modules: tuple [('bot_eo_analyses',)]
+            Modules to import in each worker when it starts.
+        max_tasks: int [None]
+            Number of chunks of devices each worker runs before it is
+            replaced.  The LCATR_WORKER_MAX_TASKS environment variable
+            overrides this value.  None means the workers are only
+            replaced by recycle().
+        """
+        if processes is None:
+            processes = max(1, multiprocessing.cpu_count() - 1)
+        self.processes \
+            = int(os.environ.get('LCATR_PARALLEL_PROCESSES', processes))
+        self.preload_modules = tuple(preload_modules)
+        self.max_tasks = worker_max_tasks(max_tasks)
+        self.pool = None
+        self.manager = None
+        self.running_tasks = None
+        self.broken = False
+        self.retired = []
+
+    def __enter__(self):
+        if self.processes > 1 and _use_multiprocessing():
+            self.manager = multiprocessing.Manager()
+            self.running_tasks = self.manager.dict()
+            self.pool = self._make_pool()
+        return self
+
+    def _make_pool(self):
+        return multiprocessing.Pool(
+            processes=self.processes, initializer=_init_worker,
+            initargs=(self.preload_modules, self.running_tasks),
+            maxtasksperchild=self.max_tasks)
+
+    def recycle(self):
+        """
+        Replace the workers with new ones.  Tasks submitted from now
+        on go to a new pool, and the workers of the old pool exit once
+        they have finished the tasks they already have, so no tasks
+        are lost.
+        """
+        old_pool = self.pool
+        self.pool = self._make_pool()
+        old_pool.close()
+        self.retired.append(old_pool)
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.pool is None:
+            return
+        for pool in self.retired + [self.pool]:
+            if exc_type is None and not self.broken:
+                pool.close()
+                pool.join()
+            else:
+                pool.terminate()
+        self.manager.shutdown()
+        self.pool = None
+        self.retired = []
+        self.manager = None
+        self.running_tasks = None
+
+
+_SHARED_POOL = None
+
+
+def shared_device_pool(processes=None):
+    """
+    Return the DevicePool shared by all of the run_jh_tasks calls made
+    by the current process, e.g., the fe55 and gain stability tasks of
+    the fe55_analysis_BOT producer.  The pool is created on first use,
+    re-created if a different number of processes is requested, and
+    closed when the process exits.
+    """
+    global _SHARED_POOL
+    requested = DevicePool(processes=processes)
+    if _SHARED_POOL is not None:
+        if (_SHARED_POOL.processes == requested.processes
+                and not _SHARED_POOL.broken):
+            return _SHARED_POOL
+        _SHARED_POOL.__exit__(None, None, None)
+    _SHARED_POOL = requested.__enter__()
+    return _SHARED_POOL
+
+
+@atexit.register
+def _close_shared_pool():
+    if _SHARED_POOL is not None:
+        _SHARED_POOL.__exit__(None, None, None)
+
+
 def run_device_analysis_pool(task_func, device_names, processes=None, cwd=None,
-                             walltime=3600):
+                             walltime=3600, pool=None, on_complete=None,
+                             max_retries=None):
     """
     Use a multiprocessing.Pool to run a device-level analysis task
     over a collection of device names.  The task_func should be
@@ -55,60 +284,378 @@ def run_device_analysis_pool(task_func, device_names, processes=None, cwd=None,
     cwd: str [None]
         Working directory to cd to for parsl multi-node processing.
     walltime: float [3600]
-        Walltime in seconds for parsl app execution.  If the app does not
-        return within walltime, a parsl.app.errors.AppTimeout exception
-        will be raised.  This is not used for non-parsl processing.
+        Walltime in seconds for the task for each device.  Tasks that
+        run longer are killed and reported as failed, and the pool
+        continues with the remaining devices.  The LCATR_TASK_WALLTIME
+        environment variable overrides this value, and a value <= 0
+        means no limit.  This is not used for the ssh_dispatcher.
+    pool: DevicePool [None]
+        Persistent pool to run the tasks in.  If None or if its pool
+        attribute is None, then a new multiprocessing.Pool is created
+        for this call, if needed.  The processes argument is ignored
+        if a pool is used.
+    on_complete: function [None]
+        Function called with the device name and a bool indicating
+        success as the task finishes for each device, or for failures,
+        once it won't be retried.
+    max_retries: int [None]
+        Number of times to retry the task for a device that failed.
+        If None, then the LCATR_MAX_RETRIES environment variable is
+        used, if set, otherwise 1.  Retries are delayed by
+        LCATR_RETRY_BACKOFF seconds, default 10, doubling with each
+        attempt.  Devices that exceed the walltime are not retried.
+        For the ssh_dispatcher, this sets the number of retries of its
+        own retry logic.
 
     Raises
     ------
-    parsl.app.errors.AppTimeout
+    task_failures.TaskFailedError
+        If the task failed for any devices after all retries.
 
     Notes
     -----
-    Exceptions from subprocesses will be buffered until all of the
-    subprocesses have finished running.  If any exceptions are thrown
-    and are uncaught, a non-zero exit code will be generated for the
-    overall process. Output to stdout or stderr from the subprocesses
-    will be interleaved.
+    A failure for one device doesn't stop the tasks for the other
+    devices.  Each failed attempt is appended as a json record, with
+    the exception and the traceback from the subprocess, to the
+    task_failures.jsonl file (see task_failures.FailureReport) as it
+    occurs, and a TaskFailedError listing the devices that failed is
+    raised after all of the tasks have finished.  Output to stdout or
+    stderr from the subprocesses will be interleaved.
 
     Users can override the default or keyword argument values by setting
     the LCATR_PARALLEL_PROCESSES environment variable.
+
+    Devices are submitted in order of decreasing wall time from previous
+    runs, as recorded in the TaskRuntimeHistory file, and that history is
+    also used to choose the chunk size.  The wall times are recorded for
+    all of the backends.  Setting LCATR_USE_TASK_HISTORY=False disables
+    this.
+
+    The number of tasks run at once on the current node is limited so
+    that their expected peak memory, from the TaskMemoryHistory file or
+    the declared values in memory_admission, fits in the available
+    memory.
+
+    The pool workers are replaced after LCATR_WORKER_MAX_TASKS chunks
+    of devices, or when the resident memory of a worker after a task
+    exceeds LCATR_WORKER_MAX_RSS_GB (see DevicePool.recycle).  The
+    memory growth of the workers over each task is summarized in
+    worker_memory_report.json (see worker_recycling.WorkerMemoryReport),
+    including the device that left the most memory behind.
+
+    The cores not used by the concurrent tasks are shared among them
+    for processing the amps of each CCD with threads, see
+    amp_tasks.amp_thread_budget.
+
+    The backend is chosen by device_executors.executor_backend().  If
+    LCATR_ASYNC_EXECUTOR=True, then the tasks are run with
+    device_executors.run_device_tasks instead of the code here.
     """
-    if os.environ.get('LCATR_USE_PARSL', False) == 'True':
+    backend = executor_backend()
+    if os.environ.get('LCATR_ASYNC_EXECUTOR', 'False') == 'True':
+        return run_device_tasks(task_func, device_names, backend=backend,
+                                processes=processes, cwd=cwd,
+                                walltime=walltime, max_retries=max_retries,
+                                on_complete=on_complete)
+
+    history = None
+    memory_history = None
+    if os.environ.get('LCATR_USE_TASK_HISTORY', 'True') == 'True':
+        history = TaskRuntimeHistory()
+        memory_history = TaskMemoryHistory()
+        device_names = history.order(task_name(task_func), device_names)
+
+    if backend == 'parsl':
         return parsl_device_analysis_pool(task_func, device_names,
-                                          processes=processes, cwd=cwd)
+                                          processes=processes, cwd=cwd,
+                                          walltime=walltime,
+                                          on_complete=on_complete)
 
-    if siteUtils.getUnitType() == 'LCA-10134_Cryostat':
+    if backend == 'ssh':
         max_time = os.environ.get('LCATR_MAX_JOB_TIME', None)
         verbose = os.environ.get('LCATR_VERBOSE_SSH_DISPATCH', False) == 'True'
         return ssh_device_analysis_pool(task_func, device_names, cwd=cwd,
-                                        max_time=max_time, verbose=verbose)
+                                        max_time=max_time, verbose=verbose,
+                                        on_complete=on_complete,
+                                        max_retries=max_task_retries(
+                                            max_retries))
 
     if processes is None:
         # Use the maximum number of cores available, reserving one for
         # the parent process.
         processes = max(1, multiprocessing.cpu_count() - 1)
     processes = int(os.environ.get('LCATR_PARALLEL_PROCESSES', processes))
+    if backend == 'in_process':
+        processes = 1
+    if pool is not None and pool.pool is not None:
+        processes = pool.processes
+    chunksize = 1
+    if history is not None:
+        processes, chunksize \
+            = history.pool_params(task_name(task_func), device_names,
+                                  processes)
+    mem_per_task = task_peak_memory(task_name(task_func), device_names,
+                                    memory_history)
+    processes = memory_limited_processes(processes, mem_per_task)
 
-    if processes == 1:
-        # For cases where only one process will be run at a time, it's
-        # faster to run serially instead of using a
-        # multiprocessing.Pool since the pickling that occurs can
-        # cause significant overhead.
-        for device_name in device_names:
-            task_func(device_name)
-    else:
-        with multiprocessing.Pool(processes=processes) as pool:
-            results = [pool.apply_async(TracebackDecorator(task_func),
-                                        (device_name,))
-                       for device_name in device_names]
-            pool.close()
-            pool.join()
-            for res in results:
-                res.get()
+    walltime = task_walltime(walltime)
+    max_retries = max_task_retries(max_retries)
+    memory_report = WorkerMemoryReport()
+    recorder = _TaskRecorder(task_func, history, memory_history, on_complete,
+                             FailureReport(task_name(task_func)), max_retries,
+                             memory_report=memory_report,
+                             max_rss=worker_max_rss())
+    # Share the cores left over by the concurrent tasks among the amps
+    # of each CCD, e.g., for the 9 CCDs of a single raft.
+    amp_threads = amp_thread_budget(processes, len(device_names))
+    timed_task = TimedTask(TracebackDecorator(task_func),
+                           amp_threads=amp_threads)
+    logger = logging.getLogger('run_device_analysis_pool')
+    logger.setLevel(logging.INFO)
+    if amp_threads > 1:
+        logger.info('Using %s threads per task for the amps', amp_threads)
+    pending = device_names
+    try:
+        while pending:
+            chunks = [pending[i:i + chunksize]
+                      for i in range(0, len(pending), chunksize)]
+            _run_attempt(timed_task, chunks, recorder, processes, walltime,
+                         pool)
+            failed_attempt = recorder.attempt
+            pending = recorder.next_attempt()
+            if pending:
+                delay = retry_delay(failed_attempt)
+                logger.info('Retrying %s for %s in %s s',
+                            recorder.task, pending, delay)
+                time.sleep(delay)
+    finally:
+        for item in (history, memory_history, memory_report):
+            if item is not None:
+                item.save()
+    if recorder.failures:
+        raise TaskFailedError(recorder.task, recorder.failures)
     return None
 
 
+def _run_attempt(timed_task, chunks, recorder, processes, walltime, pool):
+    """Run one attempt of the task for the chunks of devices."""
+    if pool is None or pool.pool is None:
+        if processes == 1:
+            # For cases where only one process will be run at a time,
+            # it's faster to run serially instead of using a
+            # multiprocessing.Pool since the pickling that occurs can
+            # cause significant overhead.  The devices are run one at a
+            # time so that the walltime applies to each.  A walltime is
+            # enforced by running each device in a forked child, which
+            # can be killed even if it is blocked in a system call,
+            # e.g., a hung read, unlike a SIGALRM handler, which is
+            # used only if forking is not possible.
+            for device_name in (_ for chunk in chunks for _ in chunk):
+                try:
+                    if hasattr(os, 'fork'):
+                        results = run_with_deadline(timed_task,
+                                                    [device_name],
+                                                    walltime=walltime)
+                    else:
+                        with deadline(walltime):
+                            results = timed_task([device_name])
+                except Exception as eobj:
+                    recorder.failed([device_name], eobj,
+                                    killed=[device_name] if isinstance(
+                                        eobj, TaskTimeoutError) else ())
+                else:
+                    recorder.succeeded(results)
+            return
+        # Use a pool for this attempt only, with the number of
+        # processes already adjusted for the history and memory.
+        new_pool = DevicePool(preload_modules=())
+        new_pool.processes = processes
+        with new_pool:
+            _run_attempt(timed_task, chunks, recorder, processes, walltime,
+                         new_pool)
+        return
+    watchdog = None
+    if walltime is not None:
+        watchdog = WorkerWatchdog(pool.running_tasks, walltime)
+    try:
+        _run_chunks(pool, timed_task, chunks, recorder, max_active=processes,
+                    watchdog=watchdog)
+    finally:
+        if watchdog is not None and watchdog.killed:
+            pool.broken = True
+
+
+def _run_chunks(pool, timed_task, chunks, recorder, max_active=None,
+                watchdog=None, interval=1):
+    """
+    Run the chunks of devices in the DevicePool, with at most
+    max_active chunks submitted at a time, and pass their outcomes to
+    the recorder as they finish.  Every `interval` seconds, the pool
+    workers are checked, and the chunks whose workers have died, e.g.,
+    from a segfault or the OOM killer, are reported as failed, so that
+    they can be retried.  The pool is then marked as broken.  If a
+    WorkerWatchdog is given, the chunks whose workers it kills for
+    exceeding the walltime are also reported as failed.  If the
+    recorder asks for the workers to be recycled, that is done before
+    the next chunk is submitted.
+    """
+    active = None
+    if max_active is not None:
+        active = threading.BoundedSemaphore(max_active)
+    # The outcome of a chunk can be reported by its callbacks or by the
+    # worker checks, e.g., if a task finishes just as its worker is
+    # killed, so the first of them to claim the chunk, under the lock,
+    # reports it and releases its slot.
+    lock = threading.Lock()
+    finished = set()
+    def claim(index):
+        with lock:
+            if index in finished:
+                return False
+            finished.add(index)
+            return True
+    def release():
+        if active is not None:
+            active.release()
+    def callbacks(index, chunk):
+        # These run in the pool's result handler thread, which must
+        # not see any exceptions.
+        def callback(results):
+            if not claim(index):
+                return
+            try:
+                recorder.succeeded(results)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                release()
+        def error_callback(eobj):
+            if not claim(index):
+                return
+            try:
+                recorder.failed(chunk, eobj)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                release()
+        return dict(callback=callback, error_callback=error_callback)
+    results = []
+    lost = set()
+    def fail_lost(device_name, eobj, killed=()):
+        for i, chunk in enumerate(chunks[:len(results)]):
+            if device_name in chunk and claim(i):
+                # The worker's task is lost, so its callbacks won't run.
+                lost.add(i)
+                try:
+                    recorder.failed(chunk, eobj, killed=killed)
+                finally:
+                    release()
+    def check_workers():
+        if watchdog is not None:
+            for device_name in watchdog.check():
+                eobj = TaskTimeoutError('Task exceeded walltime of '
+                                        f'{watchdog.walltime} s')
+                fail_lost(device_name, eobj, killed=watchdog.killed)
+        for pid, device_name in dead_workers(pool.running_tasks):
+            pool.broken = True
+            fail_lost(device_name,
+                      RuntimeError(f'worker process {pid} died'))
+    for index, chunk in enumerate(chunks):
+        if active is not None:
+            while not active.acquire(timeout=interval):
+                check_workers()
+        if recorder.recycle:
+            recorder.recycle = False
+            pool.recycle()
+            recorder.memory_report.recycled(recorder.task)
+        results.append(pool.pool.apply_async(timed_task, (chunk,),
+                                             **callbacks(index, chunk)))
+    for i, res in enumerate(results):
+        while i not in lost and not res.ready():
+            res.wait(interval)
+            check_workers()
+
+
+class _TaskRecorder:
+    """
+    Record the wall times and peak memory returned by TimedTask calls,
+    write the failure report, and report the final outcome for each
+    device to the on_complete function.  Failed devices are collected
+    for the next attempt until max_retries retries have been made.
+    Devices that exceeded the walltime are not retried, since they
+    would very likely exceed it again.  The memory growth of the
+    workers is passed to the memory_report, and `recycle` is set if a
+    worker's resident memory exceeds max_rss.  The methods can be
+    called from the pool's result handler thread.
+    """
+    def __init__(self, task_func, history, memory_history, on_complete,
+                 report, max_retries, memory_report=None, max_rss=None):
+        self.task = task_name(task_func)
+        self.history = history
+        self.memory_history = memory_history
+        self.on_complete = on_complete
+        self.report = report
+        self.max_retries = max_retries
+        self.memory_report = WorkerMemoryReport() if memory_report is None \
+                             else memory_report
+        self.max_rss = max_rss
+        self.recycle = False
+        self.attempt = 1
+        self.retries = []
+        self.failures = dict()
+        self._lock = threading.Lock()
+
+    def succeeded(self, results):
+        """Record the results of a chunk of devices."""
+        with self._lock:
+            for (device_name, _, wall_time, peak_memory, failure,
+                 (pid, rss_before, rss_after)) in results:
+                self.memory_report.record(self.task, device_name, pid,
+                                          rss_before, rss_after)
+                if (self.max_rss is not None and rss_after is not None
+                        and rss_after > self.max_rss):
+                    self.recycle = True
+                if failure is not None:
+                    self._failed(failure)
+                    continue
+                if self.history is not None:
+                    self.history.record(self.task, device_name, wall_time)
+                if self.memory_history is not None:
+                    self.memory_history.record(self.task, device_name,
+                                               peak_memory)
+                if self.on_complete is not None:
+                    self.on_complete(device_name, True)
+
+    def failed(self, chunk, eobj, killed=()):
+        """
+        Record the failure of a chunk of devices that returned no
+        results, e.g., because its worker died or was killed.
+        """
+        tb = ''.join(traceback.format_exception(type(eobj), eobj,
+                                                eobj.__traceback__))
+        with self._lock:
+            for device_name in chunk:
+                self._failed(TaskFailure(device_name, repr(eobj), tb,
+                                         device_name in killed))
+
+    def _failed(self, failure):
+        final = failure.timed_out or self.attempt > self.max_retries
+        self.report.record(failure, self.attempt, final)
+        if final:
+            self.failures[failure.device_name] = failure
+            if self.on_complete is not None:
+                self.on_complete(failure.device_name, False)
+        else:
+            self.retries.append(failure.device_name)
+
+    def next_attempt(self):
+        """Start the next attempt and return the devices to retry."""
+        with self._lock:
+            retries, self.retries = self.retries, []
+            self.attempt += 1
+        return retries
+
+
 def sensor_analyses(run_task_func, raft_id=None, processes=None, cwd=None,
                     walltime=3600):
     """
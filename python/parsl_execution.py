@@ -5,33 +5,60 @@ as raft or full focal plane.
 import os
 import time
 import logging
+import functools
+import statistics
+import concurrent.futures
 from parsl.app.app import python_app, bash_app
 import siteUtils
 import camera_components
-from parsl_ir2_dc_config import load_ir2_dc_config, MAX_PARSL_THREADS
+from parsl_ir2_dc_config import load_ir2_dc_config, max_parsl_threads, \
+    active_nodes, node_workers
+from data_locality import read_device_hosts, LocalityQueues
+from rate_limiter import TokenBucket
+from task_timeout import task_walltime, run_with_deadline
+from task_history import TaskRuntimeHistory, task_name
 
 
-__all__ = ['parsl_sensor_analyses', 'parsl_device_analysis_pool']
+__all__ = ['parsl_sensor_analyses', 'parsl_device_analysis_pool',
+           'ParslSubmitter', 'executor_app']
 
 
-@bash_app
-def bash_wrapper(script_name, *args, cwd=None, lcatr_envs=None, **kwds):
+def _bash_wrapper(script_name, *args, cwd=None, lcatr_envs=None, **kwds):
     script_lines = []
     if cwd is not None:
         script_lines.append(f'cd {cwd}')
     if lcatr_envs is not None:
         script_lines.extend(['export {}={}'.format(*_)
                              for _ in lcatr_envs.items()])
-    script_lines.append(' '.join([script_name] + list(args)))
+    task = ' '.join([script_name] + list(args))
+    if lcatr_envs is not None \
+       and lcatr_envs.get('LCATR_WARM_WORKERS', 'False') == 'True':
+        # Run the script in the node's warm worker daemon, starting
+        # the daemon if needed, and fall back to running it directly
+        # if the daemon can't run it.
+        warm_worker = os.path.join(os.environ['EOANALYSISJOBSDIR'],
+                                   'python', 'warm_worker.py')
+        script_lines.append(f'python {warm_worker} start')
+        script_lines.append(f'python {warm_worker} submit --wait {task}')
+        script_lines.append('rc=$?')
+        script_lines.append(f'if [ $rc -eq 75 ]; then {task}; '
+                            'else exit $rc; fi')
+    else:
+        script_lines.append(task)
     return '\n'.join(script_lines)
 
 
-@python_app
-def python_wrapper(func, *args, cwd=None, lcatr_envs=None, logger=None,
-                   walltime=1800, **kwargs):
+bash_wrapper = bash_app(_bash_wrapper)
+
+
+def _python_wrapper(func, *args, cwd=None, lcatr_envs=None, logger=None,
+                   time_limit=None, **kwargs):
     """
     Parsl python_app function wrapper that is serialized and executed
-    on worker nodes.
+    on worker nodes.  If time_limit is given, func is run in a forked
+    process that is killed if it runs longer than time_limit seconds.
+    This is used instead of parsl's walltime option for python apps,
+    since parsl can only interrupt the app between python bytecodes.
     """
     if cwd is not None:
         # cd to the specified working directory which should be set to
@@ -45,7 +72,7 @@ def python_wrapper(func, *args, cwd=None, lcatr_envs=None, logger=None,
         # function.
         os.environ.update(lcatr_envs)
 
-    result = func(*args, **kwargs)
+    result = run_with_deadline(func, *args, walltime=time_limit, **kwargs)
     if logger is None:
         logger = logging.getLogger('python_wrapper')
         logger.setLevel(logging.INFO)
@@ -54,8 +81,107 @@ def python_wrapper(func, *args, cwd=None, lcatr_envs=None, logger=None,
     return result
 
 
+python_wrapper = python_app(_python_wrapper)
+
+
+@functools.lru_cache(maxsize=None)
+def executor_app(wrapper, labels):
+    """
+    Return the version of the bash_wrapper or python_wrapper app that
+    runs only on the executors with the specified labels, i.e., on
+    those worker nodes.
+
+    Parameters
+    ----------
+    wrapper: parsl app
+        bash_wrapper or python_wrapper.
+    labels: tuple
+        Executor labels.
+    """
+    if wrapper is bash_wrapper:
+        return bash_app(_bash_wrapper, executors=list(labels))
+    return python_app(_python_wrapper, executors=list(labels))
+
+
+class ParslSubmitter:
+    """
+    Class to launch parsl apps for a set of devices at a bounded rate
+    and to collect their results in the order in which they complete.
+    Failures are logged as soon as they occur, and the latency from
+    submission to completion of each app is recorded.
+    """
+    def __init__(self, rate=None, burst=None):
+        """
+        Parameters
+        ----------
+        rate: float [None]
+            Maximum number of app launches per second.  If None, then
+            the LCATR_PARSL_SUBMIT_RATE environment variable is used, if
+            set, otherwise 10.  A value <= 0 means no limit.
+        burst: int [None]
+            Number of apps that can be launched at once before the rate
+            limit applies.  If None, then LCATR_PARSL_SUBMIT_BURST is
+            used, if set, otherwise 10.
+        """
+        if rate is None:
+            rate = float(os.environ.get('LCATR_PARSL_SUBMIT_RATE', 10))
+        if burst is None:
+            burst = int(os.environ.get('LCATR_PARSL_SUBMIT_BURST', 10))
+        self.bucket = TokenBucket(rate, capacity=burst)
+        self.device_names = dict()
+        self.submit_times = dict()
+        self.latencies = dict()
+        self.failures = dict()
+        self.logger = logging.getLogger('ParslSubmitter')
+        self.logger.setLevel(logging.INFO)
+
+    def submit(self, parsl_app, device_name, *args, **kwds):
+        """
+        Launch a parsl app for a device once the rate limit allows it.
+        The positional and keyword arguments are passed to the app.
+        """
+        self.bucket.acquire()
+        self.logger.info('launching parsl job for %s', device_name)
+        future = parsl_app(*args, **kwds)
+        self.device_names[future] = device_name
+        self.submit_times[device_name] = time.time()
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        device_name = self.device_names[future]
+        self.latencies[device_name] \
+            = time.time() - self.submit_times[device_name]
+        if future.exception() is not None:
+            self.failures[device_name] = future.exception()
+            self.logger.info('Failed: %s: %s', device_name,
+                             future.exception())
+
+    def as_completed(self, timeout=None):
+        """
+        Iterate over (device_name, future) pairs as the apps complete.
+        """
+        for future in concurrent.futures.as_completed(self.device_names,
+                                                      timeout=timeout):
+            yield self.device_names[future], future
+
+    def latency_summary(self):
+        """
+        Return a dict with the count, min, median, mean, and max of the
+        submission-to-completion latencies in seconds, and the device
+        with the largest latency.
+        """
+        if not self.latencies:
+            return dict(count=0)
+        values = list(self.latencies.values())
+        return dict(count=len(values), min=min(values),
+                    median=statistics.median(values),
+                    mean=statistics.mean(values), max=max(values),
+                    slowest=max(self.latencies, key=self.latencies.get))
+
+
 def parsl_device_analysis_pool(task_func, device_names, processes=None,
-                               cwd=None, walltime=3600):
+                               cwd=None, walltime=3600, on_complete=None):
     """
     Use parsl in ad hoc mode to run a device-level analysis task
     over a collection of device names.  The task_func should be
@@ -78,13 +204,43 @@ def parsl_device_analysis_pool(task_func, device_names, processes=None,
         The working directory to cd to at the remote node.  Nominally, this
         is a location on the shared file system.
     walltime: float [3600]
-        Walltime in seconds for python app execution.  If the python app
-        does not return within walltime, a parsl.app.errors.AppTimeout
-        exception will be thrown.
+        Walltime in seconds for app execution.  Python apps that run
+        longer are killed and raise a task_timeout.TaskTimeoutError,
+        and bash apps raise a parsl.app.errors.AppTimeout exception.
+        The LCATR_TASK_WALLTIME environment variable overrides this
+        value, and a value <= 0 means no limit.
+    on_complete: function [None]
+        Function called with the device name and a bool indicating
+        success as each app finishes.
+
+    Returns
+    -------
+    list: The app results in the order of device_names.
 
     Raises
     ------
-    parsl.app.errors.AppTimeout
+    RuntimeError: This will be raised if any of the apps failed, e.g.,
+        with a parsl.app.errors.AppTimeout exception, after all of the
+        apps have completed.
+
+    Notes
+    -----
+    Apps are launched at the rate given by the LCATR_PARSL_SUBMIT_RATE
+    environment variable (see ParslSubmitter), and a summary of the
+    app latencies is logged at the end.
+
+    If the device_list_map.json file written by the data staging is
+    in cwd, each device runs on the executor for the host that holds
+    its staged data.  A host with no more devices of its own takes
+    devices from the other hosts only once it has a free worker (see
+    data_locality.LocalityQueues).
+
+    Unless LCATR_USE_TASK_HISTORY=False, the wall times of the devices
+    that succeed are recorded in the TaskRuntimeHistory file when they
+    are run serially or are held back for a free worker, as for the
+    staged data.  Otherwise, all of the apps are submitted at once, so
+    their latencies include the time queued in parsl, and nothing is
+    recorded.
     """
     load_ir2_dc_config()
 
@@ -94,36 +250,113 @@ def parsl_device_analysis_pool(task_func, device_names, processes=None,
     if processes is None:
         # Use the maximum number of cores available, reserving one for
         # the parent process.
-        processes = max(1, MAX_PARSL_THREADS - 1)
+        processes = max(1, max_parsl_threads() - 1)
     processes = int(os.environ.get('LCATR_PARALLEL_PROCESSES', processes))
 
     logger.info("Running in %i processes" % processes)
 
+    walltime = task_walltime(walltime)
+    history = None
+    if os.environ.get('LCATR_USE_TASK_HISTORY', 'True') == 'True':
+        history = TaskRuntimeHistory()
     if processes == 1:
         # For cases where only one process will be run at a time, it's
         # faster to run serially instead of using a
         # multiprocessing.Pool since the pickling that occurs can
         # cause significant overhead.
-        for device_name in device_names:
-            task_func(device_name)
+        try:
+            for device_name in device_names:
+                t0 = time.time()
+                try:
+                    run_with_deadline(task_func, device_name,
+                                      walltime=walltime)
+                except Exception:
+                    if on_complete is not None:
+                        on_complete(device_name, False)
+                    raise
+                if history is not None:
+                    history.record(task_name(task_func), device_name,
+                                   time.time() - t0)
+                if on_complete is not None:
+                    on_complete(device_name, True)
+        finally:
+            if history is not None:
+                history.save()
         return None
 
-    # Put the AppFutures in a list so that the task_funcs can run
-    # asynchronously on the workers.
-    parsl_wrapper = bash_wrapper if isinstance(task_func, str) \
-                    else python_wrapper
-    outputs = []
-    for i, device_name in enumerate(device_names):
-        logger.info(f"launching parsl job for task {i} and {device_name}")
-        time.sleep(1)
-        outputs.append(parsl_wrapper(task_func, device_name, cwd=cwd,
-                                     lcatr_envs=siteUtils.get_lcatr_envs(),
-                                     logger=None, walltime=walltime))
-
-    # Check the resolution of the AppFutures by asking for the result.
-    # Calling .result() blocks until the function has exited on the
-    # worker node.
-    return [_.result() for _ in outputs]
+    # Launch the apps so that the task_funcs can run asynchronously
+    # on the workers.
+    if isinstance(task_func, str):
+        parsl_wrapper = bash_wrapper
+        time_kwds = dict(walltime=walltime)
+    else:
+        parsl_wrapper = python_wrapper
+        time_kwds = dict(time_limit=walltime)
+    submitter = ParslSubmitter()
+    lcatr_envs = siteUtils.get_lcatr_envs()
+    results = dict()
+    failures = []
+    def collect(device_name, future):
+        if future.exception() is None:
+            results[device_name] = future.result()
+            logger.info('Done: %s', device_name)
+        else:
+            failures.append(device_name)
+        if on_complete is not None:
+            on_complete(device_name, future.exception() is None)
+
+    device_map_file = 'device_list_map.json' if cwd is None \
+                      else os.path.join(cwd, 'device_list_map.json')
+    device_hosts = read_device_hosts(device_names, device_map_file,
+                                     hosts=active_nodes())
+    if not device_hosts:
+        # Run on any of the active worker nodes.
+        app = executor_app(parsl_wrapper, tuple(active_nodes()))
+        for device_name in device_names:
+            submitter.submit(app, device_name, task_func,
+                             device_name, cwd=cwd, lcatr_envs=lcatr_envs,
+                             logger=None, **time_kwds)
+
+        # Collect the results as the apps finish on the worker nodes.
+        for device_name, future in submitter.as_completed():
+            collect(device_name, future)
+    else:
+        # Run each device on the executor for the host holding its
+        # staged data, holding back the apps until the host has a free
+        # worker so that idle hosts can take them instead.
+        queues = LocalityQueues(device_names, device_hosts, node_workers(),
+                                max_running=processes)
+        running = dict()
+        while queues or running:
+            for device_name, host in queues.launch():
+                app = executor_app(parsl_wrapper, (host,))
+                future = submitter.submit(app, device_name, task_func,
+                                          device_name, cwd=cwd,
+                                          lcatr_envs=lcatr_envs, logger=None,
+                                          **time_kwds)
+                running[future] = device_name, host
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                device_name, host = running.pop(future)
+                queues.done(host)
+                collect(device_name, future)
+        if queues.stolen:
+            logger.info('Ran away from their staged data: %s',
+                        sorted(queues.stolen))
+        if history is not None:
+            # The apps were only launched once a worker was free, so
+            # their latencies are their wall times.
+            for device_name, latency in submitter.latencies.items():
+                if device_name not in submitter.failures:
+                    history.record(task_name(task_func), device_name,
+                                   latency)
+            history.save()
+
+    logger.info('App latencies (s): %s', submitter.latency_summary())
+    if failures:
+        raise RuntimeError(f'Failed parsl apps: {sorted(failures)}')
+    return [results[_] for _ in device_names]
 
 
 def parsl_sensor_analyses(run_task_func, raft_id=None, processes=None,
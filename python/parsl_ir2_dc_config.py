@@ -2,6 +2,7 @@
 parsl configuration for running on IR2 diagnostic cluster.
 """
 import os
+import math
 import socket
 import logging
 import parsl
@@ -9,35 +10,25 @@ from parsl.executors import HighThroughputExecutor
 from parsl.providers import LocalProvider
 from parsl.channels import SSHChannel
 from parsl.config import Config
+from host_selection import worker_node_names, probe_hosts, workers_per_host
 
-__all__ = ['load_ir2_dc_config', 'MAX_PARSL_THREADS']
+__all__ = ['load_ir2_dc_config', 'update_ir2_dc_nodes', 'active_nodes',
+           'node_workers', 'max_parsl_threads']
 
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
 
 SETUP_SCRIPT = os.environ.get('LCATR_SETUP_SCRIPT',
                               os.path.join(os.environ['INST_DIR'], 'setup.sh'))
 
-worker_nodes = set([
-    'lsst-dc01',
-    'lsst-dc02',
-    'lsst-dc03',
-    'lsst-dc04',
-    'lsst-dc05',
-    'lsst-dc06',
-    'lsst-dc07',
-    'lsst-dc08',
-#    'lsst-dc09',
-    'lsst-dc10'
-])
-
-WORKER_NODE_ADDRESSES = set()
-WORKER_NODE_ADDRESSES = WORKER_NODE_ADDRESSES.union(worker_nodes)
-
 MOTHER_NODE_ADDRESS = socket.gethostname().split('.')[0]
-if MOTHER_NODE_ADDRESS in WORKER_NODE_ADDRESSES:
-    WORKER_NODE_ADDRESSES.remove(MOTHER_NODE_ADDRESS)
 
-NCORES = 28
-MAX_PARSL_THREADS = len(WORKER_NODE_ADDRESSES) * NCORES
+# Number of workers on each worker node, as sized from the node's
+# cores and memory when its executor was created.
+_NODE_WORKERS = dict()
+
+# Nodes that have been dropped from the node list, so that no more
+# apps are routed to their executors.
+_DROPPED_NODES = set()
 
 
 def script_dir(hostname, root_dir='.'):
@@ -47,31 +38,125 @@ def script_dir(hostname, root_dir='.'):
     return os.path.join(os.path.abspath(root_dir), 'runinfo', hostname)
 
 
+def discover_nodes(hosts=None):
+    """
+    Probe the worker nodes and return the number of workers to run on
+    each of them, see host_selection.workers_per_host.  Nodes that
+    can't be probed are left out.  If hosts is None, then use
+    host_selection.worker_node_names().
+    """
+    if hosts is None:
+        hosts = worker_node_names()
+    hosts = [_ for _ in hosts if _ != MOTHER_NODE_ADDRESS]
+    return workers_per_host(probe_hosts(hosts))
+
+
+def make_executor(host, workers):
+    """
+    Make the executor for a worker node.  The node's workers are
+    divided into blocks of LCATR_PARSL_BLOCK_WORKERS workers, default
+    4, which parsl starts and stops as the number of outstanding apps
+    for the node changes.  With min_blocks=0, all of the blocks of a
+    node with no apps are stopped once they are idle.
+    """
+    block_workers = min(workers,
+                        int(os.environ.get('LCATR_PARSL_BLOCK_WORKERS', 4)))
+    channel = SSHChannel(hostname=host, script_dir=script_dir(host))
+    provider = LocalProvider(channel=channel,
+                             init_blocks=1,
+                             min_blocks=0,
+                             max_blocks=math.ceil(workers/block_workers),
+                             parallelism=1,
+                             worker_init='source %s' % SETUP_SCRIPT)
+    return HighThroughputExecutor(label=host,
+                                  address=MOTHER_NODE_ADDRESS,
+                                  max_workers=block_workers,
+                                  worker_debug=False,
+                                  provider=provider,
+                                  heartbeat_period=2,
+                                  heartbeat_threshold=10)
+
+
 def load_ir2_dc_config():
     """
-    Load the parsl config for ad-hoc providers.
+    Load the parsl config for ad-hoc providers, with an executor for
+    each worker node that could be probed, sized from the node's cores
+    and memory.  If a config is already loaded, then update its nodes
+    with update_ir2_dc_nodes().
     """
     try:
         parsl.DataFlowKernelLoader.dfk()
-        print("parsl config is already loaded.")
-        return
     except RuntimeError:
         pass
+    else:
+        print("parsl config is already loaded.")
+        update_ir2_dc_nodes()
+        return
 
-    executors = []
-
-    for host in WORKER_NODE_ADDRESSES:
-        channel = SSHChannel(hostname=host, script_dir=script_dir(host))
-        provider = LocalProvider(channel=channel,
-                                 init_blocks=1,
-                                 worker_init='source %s' % SETUP_SCRIPT)
-        executors.append(HighThroughputExecutor(label=host,
-                                                address=MOTHER_NODE_ADDRESS,
-                                                worker_debug=False,
-                                                provider=provider,
-                                                heartbeat_period=2,
-                                                heartbeat_threshold=10))
+    workers = discover_nodes()
+    if not workers:
+        raise RuntimeError('No parsl worker nodes are available.')
+    executors = [make_executor(host, nworkers)
+                 for host, nworkers in workers.items()]
 
-    config = Config(executors=executors, strategy=None, retries=3)
+    # The 'simple' strategy adds blocks, up to max_blocks, for each
+    # executor as its apps queue up, and removes idle blocks, down to
+    # min_blocks=0, e.g., for nodes dropped from the node list.
+    config = Config(executors=executors, strategy='simple', retries=3)
 
     parsl.load(config)
+    _NODE_WORKERS.clear()
+    _NODE_WORKERS.update(workers)
+    _DROPPED_NODES.clear()
+
+
+def update_ir2_dc_nodes():
+    """
+    Bring the executors of the loaded parsl config up to date with
+    the current node list (see host_selection.worker_node_names):
+    executors are added for new nodes, and no more apps are routed to
+    the executors for nodes that have been removed from the list.  The
+    blocks of those executors are then stopped by the parsl strategy
+    once they are idle, since min_blocks=0 (see make_executor), rather
+    than scaled in here, which the strategy would undo.
+    """
+    logger = logging.getLogger('update_ir2_dc_nodes')
+    logger.setLevel(logging.INFO)
+    dfk = parsl.dfk()
+    hosts = set(worker_node_names())
+
+    for host in sorted(set(_NODE_WORKERS).difference(hosts, _DROPPED_NODES)):
+        logger.info('Dropping %s', host)
+        _DROPPED_NODES.add(host)
+
+    # Nodes that were dropped and are listed again resume using their
+    # existing executors, which the strategy scales out as apps arrive.
+    restored = hosts.intersection(_DROPPED_NODES)
+    _DROPPED_NODES.difference_update(restored)
+
+    new_nodes = discover_nodes(sorted(hosts.difference(_NODE_WORKERS)))
+    if new_nodes:
+        logger.info('Adding %s', sorted(new_nodes))
+        dfk.add_executors([make_executor(host, workers)
+                           for host, workers in new_nodes.items()])
+        _NODE_WORKERS.update(new_nodes)
+
+
+def active_nodes():
+    """Return the worker nodes that apps can be routed to."""
+    return sorted(set(_NODE_WORKERS).difference(_DROPPED_NODES))
+
+
+def node_workers():
+    """Return the number of workers on each active worker node."""
+    return {host: _NODE_WORKERS[host] for host in active_nodes()}
+
+
+def max_parsl_threads():
+    """
+    Total number of workers on the active worker nodes.  The nodes are
+    probed if no config has been loaded yet.
+    """
+    if not _NODE_WORKERS:
+        return sum(discover_nodes().values())
+    return sum(node_workers().values())
@@ -0,0 +1,169 @@
+"""
+Peer-to-peer staging between the nodes of the diagnostic cluster.  A
+per-run index on the shared file system records which files each node
+has in its scratch area, so that a node can copy a file, e.g., a bias
+frame or a mask file that another node has already staged, from that
+peer rather than from the central file server.
+"""
+import os
+import json
+import random
+import logging
+import subprocess
+
+__all__ = ['peer_index_dir', 'PeerIndex', 'scp_transfer', 'PeerFetcher']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+def peer_index_dir(run):
+    """
+    Directory of the peer index for a run, under the shared directory
+    given by LCATR_PEER_INDEX_DIR, or None if that is not set, in which
+    case peer staging is disabled.
+    """
+    index_dir = os.environ.get('LCATR_PEER_INDEX_DIR', None)
+    if index_dir is None:
+        return None
+    return os.path.join(index_dir, str(run))
+
+
+class PeerIndex:
+    """
+    Index of the files staged on each host.  Each host writes only its
+    own <host>.json file in the index directory, mapping the source
+    path of each of its staged files to the path of its copy, so no
+    locking across hosts is needed.
+    """
+    def __init__(self, index_dir):
+        """
+        Parameters
+        ----------
+        index_dir: str
+            Directory on the shared file system for the index files.
+        """
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        self._hosts = None
+
+    def _host_file(self, host):
+        return os.path.join(self.index_dir, f'{host}.json')
+
+    def host_files(self, host):
+        """Return the src -> staged path map for a host."""
+        try:
+            with open(self._host_file(host)) as fd:
+                return json.load(fd)
+        except (OSError, ValueError):
+            return dict()
+
+    def update(self, host, files, removed=()):
+        """
+        Record the files staged on a host.
+
+        Parameters
+        ----------
+        host: str
+            The host.
+        files: dict
+            Staged paths keyed by source path of the files to add.
+        removed: list [()]
+            Staged paths of files that are no longer on the host.
+        """
+        host_files = self.host_files(host)
+        host_files.update(files)
+        removed = set(removed)
+        host_files = {src: dest for src, dest in host_files.items()
+                      if dest not in removed}
+        tmp_file = f'{self._host_file(host)}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as output:
+            json.dump(host_files, output)
+        os.replace(tmp_file, self._host_file(host))
+        if self._hosts is not None:
+            self._hosts[host] = host_files
+
+    def load(self):
+        """Read the index files of all of the hosts."""
+        self._hosts = dict()
+        for item in os.listdir(self.index_dir):
+            if item.endswith('.json'):
+                host = item[:-len('.json')]
+                self._hosts[host] = self.host_files(host)
+
+    def peers(self, src, exclude=None):
+        """
+        Return (host, staged path) pairs for the hosts that have a copy
+        of src, other than exclude, as of the last call to load().
+        """
+        if self._hosts is None:
+            self.load()
+        return [(host, host_files[src])
+                for host, host_files in sorted(self._hosts.items())
+                if host != exclude and src in host_files]
+
+
+def scp_transfer(host, remote_path, local_path, timeout=600):
+    """
+    Copy remote_path on host to local_path with scp, and return True
+    if it succeeded.
+    """
+    command = ['scp', '-q', '-o', 'BatchMode=yes', f'{host}:{remote_path}',
+               local_path]
+    try:
+        return subprocess.run(command, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL,
+                              timeout=timeout).returncode == 0
+    except subprocess.TimeoutExpired:
+        return False
+
+
+class PeerFetcher:
+    """
+    Callable to fetch a file from a peer host that has already staged
+    it, for use as the fetch function of a copy_engine.CopyEngine.  The
+    peers are tried in random order, so that the load is spread over
+    them, and the copy is checked against the size of the source file.
+    """
+    def __init__(self, index, host, transfer=scp_transfer):
+        """
+        Parameters
+        ----------
+        index: PeerIndex
+            Index of the files staged on each host.
+        host: str
+            The current host, which is not used as a peer.
+        transfer: function [scp_transfer]
+            Function with (host, remote_path, local_path) arguments that
+            copies a file from a peer and returns True if it succeeded.
+        """
+        self.index = index
+        self.host = host
+        self.transfer = transfer
+        self.fetched = 0
+        self.logger = logging.getLogger('PeerFetcher')
+        self.logger.setLevel(logging.INFO)
+
+    def __call__(self, src, dest):
+        """
+        Copy src to dest from a peer, returning the number of bytes
+        copied, or None if no peer could provide it.
+        """
+        peers = self.index.peers(src, exclude=self.host)
+        if not peers:
+            return None
+        random.shuffle(peers)
+        src_stat = os.stat(src)
+        part_file = dest + '.part'
+        for peer, remote_path in peers:
+            if (self.transfer(peer, remote_path, part_file)
+                    and os.path.getsize(part_file) == src_stat.st_size):
+                os.utime(part_file,
+                         ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+                os.replace(part_file, dest)
+                self.fetched += 1
+                return src_stat.st_size
+            self.logger.info('unable to fetch %s from %s', remote_path, peer)
+        if os.path.isfile(part_file):
+            os.remove(part_file)
+        return None
@@ -0,0 +1,86 @@
+"""
+Token bucket rate limiter.
+"""
+import time
+import threading
+
+__all__ = ['TokenBucket']
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.  Tokens accumulate at `rate` per second
+    up to `capacity`, and each acquisition removes tokens from the
+    bucket, waiting until enough are available.  Requests larger than
+    the capacity are granted once the bucket is full and leave it in
+    debt, so they are throttled at the same average rate instead of
+    blocking forever.
+    """
+    def __init__(self, rate, capacity=None, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        Parameters
+        ----------
+        rate: float
+            Tokens added per second.  If None or not positive, then
+            acquisitions never wait.
+        capacity: float [None]
+            Maximum number of tokens in the bucket, i.e., the largest
+            burst.  If None, then use max(1, rate).
+        clock: function [time.monotonic]
+            Function returning the current time in seconds.
+        sleep: function [time.sleep]
+            Function used to wait for tokens.
+        """
+        self.rate = rate if rate is not None and rate > 0 else None
+        if capacity is None:
+            capacity = max(1, rate) if self.rate is not None else 1
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.last)*self.rate)
+        self.last = now
+
+    def try_acquire(self, tokens=1):
+        """
+        Try to take tokens from the bucket without waiting.
+
+        Returns
+        -------
+        float: 0 if the tokens were taken, otherwise the time in seconds
+            until enough tokens will be available.
+        """
+        if self.rate is None:
+            return 0
+        with self.lock:
+            self._refill()
+            needed = min(tokens, self.capacity)
+            # Allow for round-off in the refill so that waiting for the
+            # returned time always suffices.
+            if self.tokens >= needed - 1e-9*needed:
+                self.tokens -= tokens
+                return 0
+            return (needed - self.tokens)/self.rate
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until they are available.
+
+        Returns
+        -------
+        float: The total time in seconds spent waiting.
+        """
+        waited = 0
+        while True:
+            wait_time = self.try_acquire(tokens)
+            if wait_time == 0:
+                return waited
+            self.sleep(wait_time)
+            waited += wait_time
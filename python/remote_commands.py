@@ -0,0 +1,167 @@
+"""
+Runners for shell commands on remote hosts.  SshCommandRunner keeps
+one persistent ssh control connection per host and multiplexes the
+commands over it, so that each command avoids a full ssh handshake.
+LocalCommandRunner runs the commands in a local shell and can stand in
+for it in tests.
+"""
+import os
+import logging
+import threading
+import subprocess
+from collections import defaultdict
+
+__all__ = ['SshCommandRunner', 'LocalCommandRunner']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+class LocalCommandRunner:
+    """
+    Run commands with a local bash shell, ignoring the host name, with
+    at most `max_sessions` concurrent commands per host.
+    """
+    def __init__(self, max_sessions=8):
+        """
+        Parameters
+        ----------
+        max_sessions: int [8]
+            Maximum number of concurrent commands for each host.
+        """
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        self._semaphores = dict()
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] \
+                    = threading.BoundedSemaphore(self.max_sessions)
+            return self._semaphores[host]
+
+    def command(self, host, remote_command):
+        """Return the argument list to run remote_command on host."""
+        return ['bash', '-c', remote_command]
+
+    def run(self, host, remote_command, check=True):
+        """
+        Run a shell command on a host, waiting for it to finish.
+
+        Parameters
+        ----------
+        host: str
+            Name of the host.
+        remote_command: str
+            Shell command to run on the host.
+        check: bool [True]
+            Raise a subprocess.CalledProcessError if the command fails.
+
+        Returns
+        -------
+        int: The return code of the command.
+        """
+        with self._semaphore(host):
+            return subprocess.run(self.command(host, remote_command),
+                                  stdin=subprocess.DEVNULL,
+                                  check=check).returncode
+
+    def close(self):
+        """Release any resources held for the hosts."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SshCommandRunner(LocalCommandRunner):
+    """
+    Run commands on remote hosts via ssh connections multiplexed over
+    a persistent control connection to each host.  The control
+    connections stay open for `persist` seconds after their last use,
+    so later runners, e.g., for subsequent jh tasks, reuse them.
+    """
+    def __init__(self, max_sessions=None, control_dir=None, persist=600):
+        """
+        Parameters
+        ----------
+        max_sessions: int [None]
+            Maximum number of concurrent sessions per host.  This must
+            be less than the sshd MaxSessions setting (10 by default).
+            If None, then use LCATR_SSH_MAX_SESSIONS if set, otherwise 8.
+        control_dir: str [None]
+            Directory for the control sockets.  If None, then use
+            LCATR_SSH_CONTROL_DIR if set, otherwise ~/.ssh/lcatr_cm.
+        persist: int [600]
+            Time in seconds that an idle control connection is kept.
+        """
+        if max_sessions is None:
+            max_sessions = int(os.environ.get('LCATR_SSH_MAX_SESSIONS', 8))
+        super().__init__(max_sessions=max_sessions)
+        if control_dir is None:
+            control_dir = os.environ.get(
+                'LCATR_SSH_CONTROL_DIR',
+                os.path.join(os.path.expanduser('~'), '.ssh', 'lcatr_cm'))
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        self.control_dir = control_dir
+        self.persist = persist
+        self._host_locks = defaultdict(threading.Lock)
+        self._masters = set()
+
+    def ssh_options(self):
+        """The ssh options for using the control connections."""
+        # The %C token is a hash of the connection parameters, which
+        # keeps the socket path short.
+        return ['-o', 'BatchMode=yes',
+                '-o', f'ControlPath={os.path.join(self.control_dir, "%C")}',
+                '-o', f'ControlPersist={self.persist}']
+
+    def command(self, host, remote_command):
+        return ['ssh', *self.ssh_options(), '-o', 'ControlMaster=no',
+                host, remote_command]
+
+    def open(self, host):
+        """
+        Start the control connection to a host unless one is already
+        running.  If it can't be started, then the commands for that
+        host fall back to separate ssh connections.
+        """
+        logger = logging.getLogger('SshCommandRunner.open')
+        logger.setLevel(logging.INFO)
+        with self._lock:
+            host_lock = self._host_locks[host]
+        with host_lock:
+            if host in self._masters:
+                return
+            check = ['ssh', *self.ssh_options(), '-O', 'check', host]
+            if subprocess.run(check, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL).returncode != 0:
+                logger.info('Opening control connection to %s', host)
+                try:
+                    subprocess.check_call(['ssh', *self.ssh_options(),
+                                           '-o', 'ControlMaster=yes',
+                                           '-f', '-N', host],
+                                          stdin=subprocess.DEVNULL)
+                except subprocess.CalledProcessError as eobj:
+                    logger.info('Control connection to %s failed: %s',
+                                host, eobj)
+            self._masters.add(host)
+
+    def run(self, host, remote_command, check=True):
+        self.open(host)
+        return super().run(host, remote_command, check=check)
+
+    def close(self):
+        """
+        Stop the control connections opened by this runner.  This is
+        not needed for normal use, since idle connections time out.
+        """
+        with self._lock:
+            hosts, self._masters = self._masters, set()
+        for host in hosts:
+            subprocess.run(['ssh', *self.ssh_options(), '-O', 'exit', host],
+                           stdin=subprocess.DEVNULL,
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
@@ -3,18 +3,23 @@ Use ssh to run task scripts on remote nodes that are connected to
 a common file system and keep track of remote tasks via log files.
 """
 import os
-import copy
 import time
 import json
-import socket
+import shutil
 import logging
-import subprocess
-import multiprocessing
+import statistics
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import siteUtils
+from host_selection import LoadAwareHosts, ir2_host_names
+from remote_commands import SshCommandRunner
+from task_history import TaskRuntimeHistory, task_name
+from memory_admission import TaskMemoryHistory, task_peak_memory
+from amp_tasks import split_work_item
+from bandwidth_coordinator import staging_limits, start_coordinator
 
-__all__ = ['ssh_device_analysis_pool']
+__all__ = ['ssh_device_analysis_pool', 'place_devices', 'placement_policy']
 
 logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
 
@@ -23,13 +28,7 @@ class Ir2Hosts:
     Iterator class to provide lsst-dc* host names in a cyclic fashion.
     """
     def __init__(self):
-        bad_nodes = os.environ.get('LCATR_BAD_NODES', '').split('_')
-        self.hosts = []
-        for i in range(1, 11):
-            host = f'lsst-dc{i:02}'
-            if host in socket.gethostname() or host in bad_nodes:
-                continue
-            self.hosts.append(host)
+        self.hosts = ir2_host_names()
         self.num_hosts = len(self.hosts)
         self.index = 0
 
@@ -41,6 +40,168 @@ class Ir2Hosts:
     def __iter__(self):
         return self
 
+    def reserve(self, ntasks, host=None):
+        """
+        Return the host for a group of ntasks tasks that should run on
+        the same host:  the preferred host, if given and usable,
+        otherwise the next host.
+        """
+        if host in self.hosts:
+            return host
+        return next(self)
+
+
+def log_tail_status(log_file, nbytes=256):
+    """
+    Return 'succeeded' or 'failed' if the last line of a task log file
+    is the corresponding trailer, otherwise None.  Only the end of the
+    file is read.
+    """
+    try:
+        with open(log_file, 'rb') as fd:
+            fd.seek(0, os.SEEK_END)
+            fd.seek(max(0, fd.tell() - nbytes))
+            lines = fd.read().decode(errors='replace').splitlines()
+    except OSError:
+        return None
+    if lines and lines[-1].startswith('Task succeeded'):
+        return 'succeeded'
+    if lines and lines[-1].startswith('Task failed'):
+        return 'failed'
+    return None
+
+
+def default_remote_hosts(mem_per_task=2.):
+    """
+    Return the host iterator selected by the LCATR_HOST_SELECTION
+    environment variable: 'load' (the default) for LoadAwareHosts
+    or 'round_robin' for Ir2Hosts.  mem_per_task is the expected peak
+    memory in GB of each task.
+    """
+    if os.environ.get('LCATR_HOST_SELECTION', 'load') == 'round_robin':
+        return Ir2Hosts()
+    return LoadAwareHosts(mem_per_task=mem_per_task)
+
+
+def raft_name(device_name):
+    """
+    Return the raft of a device, e.g., 'R22' for 'R22_S11', for the
+    amp-level work item 'R22_S11:3', or for the raft 'R22' itself.
+    """
+    return split_work_item(device_name)[0].split('_')[0]
+
+
+def placement_policy():
+    """
+    Return the placement policy for the devices, from the
+    LCATR_PLACEMENT environment variable:  'device' (the default) to
+    place each device separately, or 'raft' to place all of the
+    devices of a raft on the same host.
+    """
+    policy = os.environ.get('LCATR_PLACEMENT', 'device')
+    if policy not in ('device', 'raft'):
+        raise ValueError(f'Invalid LCATR_PLACEMENT value: {policy}')
+    return policy
+
+
+def group_by_raft(device_names):
+    """
+    Reorder the devices so that those of each raft are adjacent,
+    keeping the order of the rafts by their first device and the
+    order of the devices within each raft.
+    """
+    groups = defaultdict(list)
+    for device_name in device_names:
+        groups[raft_name(device_name)].append(device_name)
+    return [_ for group in groups.values() for _ in group]
+
+
+def raft_boundary(device_names, index):
+    """
+    Return the index of the end of the raft of device_names[index - 1],
+    for devices ordered by group_by_raft, so that a batch of devices
+    ending there contains whole rafts.
+    """
+    if index <= 0:
+        return 0
+    raft = raft_name(device_names[index - 1])
+    while (index < len(device_names)
+           and raft_name(device_names[index]) == raft):
+        index += 1
+    return index
+
+
+def whole_rafts(device_names, max_devices):
+    """
+    Return the number of leading devices, for devices ordered by
+    group_by_raft, that make up whole rafts and number no more than
+    max_devices, or the number of devices of the first raft if that is
+    larger.
+    """
+    end = raft_boundary(device_names, 1)
+    while end < len(device_names):
+        next_end = raft_boundary(device_names, end + 1)
+        if next_end > max_devices:
+            break
+        end = next_end
+    return end
+
+
+def place_devices(device_names, remote_hosts, policy=None, raft_hosts=None):
+    """
+    Assign the devices to hosts.
+
+    Parameters
+    ----------
+    device_names: list
+        Devices to place.
+    remote_hosts: iterable
+        Iterable that provides the remote hosts.  If it has a
+        reserve(ntasks, host=None) method, as LoadAwareHosts and
+        Ir2Hosts do, that is used to place each raft for the 'raft'
+        policy.
+    policy: str [None]
+        'device' to take a host from remote_hosts for each device, or
+        'raft' to put all of the devices of a raft on the same host,
+        placing the rafts with the most devices first so that the
+        rafts are balanced across the hosts.  If None, then use
+        placement_policy().
+    raft_hosts: dict [None]
+        Hosts of the rafts from earlier placements, e.g., for the
+        CCD-level tasks preceding a raft-level task.  These hosts are
+        preferred for the 'raft' policy, and the dict is updated with
+        the new placements.
+
+    Returns
+    -------
+    dict: The host for each device.  Devices for which remote_hosts
+        has no host, e.g., since they don't fit in the memory of any of
+        the LoadAwareHosts, are left out.
+    """
+    if policy is None:
+        policy = placement_policy()
+    if policy == 'device':
+        host_map = dict(zip(device_names, remote_hosts))
+        return {_: host for _, host in host_map.items() if host is not None}
+    if raft_hosts is None:
+        raft_hosts = dict()
+    groups = defaultdict(list)
+    for device_name in device_names:
+        groups[raft_name(device_name)].append(device_name)
+    hosts = iter(remote_hosts)
+    host_map = dict()
+    for raft in sorted(groups, key=lambda _: len(groups[_]), reverse=True):
+        if hasattr(remote_hosts, 'reserve'):
+            host = remote_hosts.reserve(len(groups[raft]),
+                                        host=raft_hosts.get(raft))
+        else:
+            host = next(hosts)
+        if host is None:
+            continue
+        raft_hosts[raft] = host
+        host_map.update((_, host) for _ in groups[raft])
+    return {_: host_map[_] for _ in device_names if _ in host_map}
+
 
 def zero_func():
     """
@@ -56,7 +217,9 @@ class TaskRunner:
     on remote machines via ssh.
     """
     def __init__(self, script, working_dir, setup, max_retries=1,
-                 remote_hosts=None, verbose=False):
+                 remote_hosts=None, verbose=False, command_runner=None,
+                 concurrency=None, mem_per_task=2., on_complete=None,
+                 speculative_factor=None):
         """
         Parameters
         ----------
@@ -73,27 +236,99 @@ class TaskRunner:
             Maximum number of retries for failed task executions.
         remote_hosts: iterable [None]
             Iterable that provides the remote hosts for each process.
-            If None, then the lsst-dc* hosts will be used.
+            If None, then the lsst-dc* hosts will be used, as selected
+            by default_remote_hosts().
         verbose: bool [False]
             Flag to output additional diagnostic info about the task
             execution.
+        command_runner: object [None]
+            Object with a run(host, command) method that runs a shell
+            command on a remote host.  If None, then use a
+            remote_commands.SshCommandRunner.
+        concurrency: int [None]
+            Maximum number of concurrent launches over all hosts.  If
+            None, then use LCATR_SSH_CONCURRENCY if set, otherwise 32.
+        mem_per_task: float [2.]
+            Expected peak memory in GB of each task, used to place the
+            tasks if remote_hosts is None.
+        on_complete: function [None]
+            Function called with the task id and a bool indicating
+            success when a task succeeds or fails for the last time.
+        speculative_factor: float [None]
+            If a task runs longer than this factor times the median
+            run time of the completed tasks, then start a copy of it on
+            another host (see launch_copy).  If None, then use
+            LCATR_SPECULATIVE_FACTOR if set, otherwise no copies are
+            started.
+
+        The devices are assigned to the hosts according to the
+        LCATR_PLACEMENT policy (see place_devices).  For the 'raft'
+        policy, the host of each raft is saved in raft_host_map.json
+        in the working directory and is reused by later tasks.
         """
         self.params = script, working_dir, setup
         self.max_retries = max_retries
-        self.remote_hosts = Ir2Hosts() if remote_hosts is None else remote_hosts
+        self.remote_hosts = default_remote_hosts(mem_per_task) \
+                            if remote_hosts is None else remote_hosts
         self.verbose = verbose
+        self.command_runner = SshCommandRunner() if command_runner is None \
+                              else command_runner
+        if concurrency is None:
+            concurrency = int(os.environ.get('LCATR_SSH_CONCURRENCY', 32))
+        self.concurrency = concurrency
+        self.warm_workers \
+            = os.environ.get('LCATR_WARM_WORKERS', 'False') == 'True'
+        self.warm_worker = os.path.join(os.environ['EOANALYSISJOBSDIR'],
+                                        'python', 'warm_worker.py')
+        self.warm_hosts = set()
         self.log_dir = os.path.join(working_dir, 'logging')
         os.makedirs(self.log_dir, exist_ok=True)
+        self.status_dir = os.path.join(self.log_dir, 'status')
+        os.makedirs(self.status_dir, exist_ok=True)
         self.lcatr_envs = siteUtils.get_lcatr_envs()
         self.task_ids = dict()
         self.log_files = dict()
+        self.status_files = dict()
         self.retries = defaultdict(zero_func)
         self.host_map = None
+        self.peak_memory = dict()
+        self.on_complete = on_complete
+        if speculative_factor is None:
+            speculative_factor \
+                = os.environ.get('LCATR_SPECULATIVE_FACTOR', None)
+        self.speculative_factor = None if speculative_factor is None \
+                                  else float(speculative_factor)
+        self.pid_files = dict()
+        self.start_times = dict()
+        self.run_times = []
+        self.wall_times = dict()
+        self.copies = dict()
+        self.copied = set()
+        self.copy_executor = ThreadPoolExecutor(max_workers=4)
+        self.placement = placement_policy()
+        self.raft_host_file = os.path.join(working_dir, 'raft_host_map.json')
+        self.raft_hosts = dict()
+        if self.placement == 'raft' and os.path.isfile(self.raft_host_file):
+            with open(self.raft_host_file) as fd:
+                self.raft_hosts = json.load(fd)
+        self.pipelined_staging \
+            = os.environ.get('LCATR_PIPELINED_STAGING', 'False') == 'True'
+        self.ready_dir = os.path.join(self.log_dir, 'staged')
+        self.unstaged = []
+        self.staging_params = None
+        self.staged_hosts = set()
+        self.staging_retries = defaultdict(zero_func)
+        self.staging_failed = set()
+        self.coordinator = None
+        self.throughput_file = os.path.join(working_dir,
+                                            'staging_throughput.json')
 
     def make_log_file(self, task_id, clean_up=True, params=None):
         """
         Create a log filename from the task name and task_id and
         clean up any existing log files in the logging directory.
+        The name of the json file the remote process writes its
+        completion status to is also set here.
         """
         if params is None:
             params = self.params
@@ -102,14 +337,23 @@ class TaskRunner:
         log_file = os.path.join(self.log_dir, f'{task_name}_{task_id}.log')
         self.task_ids[log_file] = task_id
         self.log_files[task_id] = log_file
-        if clean_up and os.path.isfile(log_file):
-            os.remove(log_file)
+        self.status_files[task_id] \
+            = os.path.join(self.status_dir, f'{task_name}_{task_id}.json')
+        self.pid_files[task_id] \
+            = os.path.join(self.status_dir, f'{task_name}_{task_id}.pid')
+        if clean_up:
+            for item in (log_file, self.status_files[task_id],
+                         self.pid_files[task_id]):
+                if os.path.isfile(item):
+                    os.remove(item)
         return log_file
 
     def launch_script(self, remote_host, task_id, *args, niceness=10,
-                      params=None, wait=False):
+                      params=None, wait=False, files=None):
         """
-        Function to launch the script as a remote process via ssh.
+        Function to launch the script as a remote process via the
+        command runner.  The log, status and pid files are those of
+        the task_id, unless they are given as the `files` tuple.
         """
         logger = logging.getLogger('TaskRunner.launch_script')
         logger.setLevel(logging.INFO)
@@ -117,28 +361,355 @@ class TaskRunner:
         if params is None:
             params = self.params
         script, working_dir, setup = params
-        log_file = self.log_files[task_id]
-        command = f'ssh {remote_host} '
-        command += f'"cd {working_dir}; source {setup}; '
+        if files is None:
+            files = (self.log_files[task_id], self.status_files[task_id],
+                     self.pid_files[task_id])
+        log_file, status_file, pid_file = files
+        task = ' '.join([script, task_id] + [str(_) for _ in args])
+        # This is the command line for the remote shell, so no
+        # escapes for a local shell are needed.
+        command = f'cd {working_dir}; '
         for key, value in self.lcatr_envs.items():
             command += f'export {key}={value}; '
-        command += f'(echo; nice -n {niceness} ipython {script} {task_id} '
-        command += ' '.join([str(_) for _ in args])
-        command += r' && echo Task succeeded on \`hostname\`'
-        command += r' || echo Task failed on \`hostname\`)'
+        cold_start = f'source {setup}; '
+        # Measure the peak memory of the task in kB with GNU time, if
+        # it is available.
+        mem_file = f'{status_file}.mem'
+        cold_start += (f'(echo $BASHPID > {pid_file}; echo; '
+                       f'rm -f {mem_file}; t=; if [ -x /usr/bin/time ]; then '
+                       f't="/usr/bin/time -f %M -o {mem_file}"; fi; '
+                       f'$t nice -n {niceness} ipython {task}')
+        # Record the outcome in the log file and atomically write the
+        # json status file that monitor_tasks looks for, with the peak
+        # memory in GB.
+        cold_start += '; rc=$?; if [ $rc -eq 0 ]; then s=succeeded; '
+        cold_start += 'else s=failed; fi; echo Task $s on `hostname`; '
+        cold_start += (f'm=`tail -n 1 {mem_file} 2> /dev/null`; '
+                       f'rm -f {mem_file}; p=null; '
+                       'if [[ "$m" =~ ^[0-9]+$ ]]; then '
+                       'p=`awk "BEGIN {print $m/1048576}"`; fi; ')
+        cold_start += ('printf \'{"task_id": "%s", "status": "%s", '
+                       '"host": "%s", "returncode": %d, '
+                       '"peak_memory": %s}\\n\' ')
+        cold_start += f'{task_id} $s `hostname` $rc $p '
+        cold_start += (f'> {status_file}.tmp && '
+                       f'mv {status_file}.tmp {status_file})')
         if wait:
-            command += f' &>> {log_file}"'
+            cold_start += f' &>> {log_file};'
+        else:
+            cold_start += f' &>> {log_file} &'
+        if self.warm_workers:
+            # Run the script in the host's warm worker daemon, which
+            # writes the log trailer and status file itself.  The
+            # client only needs the system python.  If the daemon
+            # can't run it (exit code 75) or python3 is missing (127),
+            # then start a new process as usual.
+            code_dir = os.environ['EOANALYSISJOBSDIR']
+            command += f'export EOANALYSISJOBSDIR={code_dir}; '
+            command += (f'python3 {self.warm_worker} submit '
+                        f'--status-file {status_file} --niceness {niceness} '
+                        f'--pid-file {pid_file} ')
+            if wait:
+                command += '--wait '
+            command += f'{task} &>> {log_file}; rc=$?; '
+            command += 'if [ $rc -eq 75 ] || [ $rc -eq 127 ]; then '
+            command += f'{cold_start} fi'
         else:
-            command += f' &>> {log_file}&"'
+            command += cold_start
         if self.verbose:
             logger.info(command)
         logger.info('Launching %s on %s', script, remote_host)
-        subprocess.check_call(command, shell=True)
+        self.command_runner.run(remote_host, command)
+
+    def start_warm_workers(self, hosts):
+        """
+        Start the warm worker daemon on each host that doesn't already
+        have one running.  Tasks on hosts where this fails run in new
+        processes.
+        """
+        logger = logging.getLogger('TaskRunner.start_warm_workers')
+        logger.setLevel(logging.INFO)
+
+        hosts = sorted(set(hosts).difference(self.warm_hosts))
+        if not hosts:
+            return
+        _, _, setup = self.params
+        command = f'source {setup}; python {self.warm_worker} start'
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            returncodes = executor.map(
+                lambda host: self.command_runner.run(host, command,
+                                                     check=False), hosts)
+        for host, returncode in zip(hosts, returncodes):
+            if returncode == 0:
+                self.warm_hosts.add(host)
+            else:
+                logger.info('Unable to start warm worker on %s', host)
+
+    def task_status(self, task_id, status_names=None, check_log=False):
+        """
+        Return the status of a task, 'succeeded', 'failed', or None if
+        it has not finished.
+
+        Parameters
+        ----------
+        task_id: str
+            The task id, i.e., the device name.
+        status_names: set [None]
+            Names of the files in the status directory from a single
+            directory listing.  If given, the task's status file is
+            only read if it is in this set.
+        check_log: bool [False]
+            If there is no status file, check the last line of the
+            log file.  This is a fallback for tasks whose remote
+            wrapper was unable to write the status file.
+        """
+        status_file = self.status_files.get(task_id)
+        if status_file is not None and (
+                status_names is None
+                or os.path.basename(status_file) in status_names):
+            status = self._read_status(task_id, status_file)
+            if status is not None:
+                return status
+        if check_log:
+            return log_tail_status(self.log_files[task_id])
+        return None
+
+    def _read_status(self, task_id, status_file):
+        try:
+            with open(status_file) as fd:
+                status = json.load(fd)
+            if status.get('peak_memory') is not None:
+                self.peak_memory[task_id] = status['peak_memory']
+            return status['status']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def kill_task(self, remote_host, pid_file):
+        """
+        Kill the remote process whose pid is in pid_file, along with
+        its descendants.
+        """
+        command = ('kill_tree() { kill -STOP $1; '
+                   'for child in `pgrep -P $1`; do kill_tree $child; done; '
+                   'kill -KILL $1; }; '
+                   f'if [ -f {pid_file} ]; then '
+                   f'kill_tree `cat {pid_file}`; fi 2> /dev/null')
+        self.command_runner.run(remote_host, command, check=False)
+
+    def launch_copy(self, task_id):
+        """
+        Start a speculative copy of a running task on another host.
+        The copy runs in working_dir/speculative/<task_id>, which
+        mirrors the inputs in the working directory (see
+        _mirror_inputs), so that the copy writes its outputs as real
+        files in its own directory.  If data staging is enabled, the
+        data for the device are only on the original host, so they are
+        staged on the copy's host before the copy is started.  The
+        first of the original and the copy to succeed is used (see
+        finish_copy).
+        """
+        logger = logging.getLogger('TaskRunner.launch_copy')
+        logger.setLevel(logging.INFO)
+
+        script, working_dir, setup = self.params
+        original_host = self.host_map[task_id]
+        remote_host = None
+        for _ in range(getattr(self.remote_hosts, 'num_hosts', 1)):
+            host = next(self.remote_hosts)
+            if host != original_host:
+                remote_host = host
+                break
+        if remote_host is None:
+            return
+        self.copied.add(task_id)
+        copy_dir = os.path.join(working_dir, 'speculative', task_id)
+        shutil.rmtree(copy_dir, ignore_errors=True)
+        os.makedirs(copy_dir)
+        self._mirror_inputs(task_id, working_dir, copy_dir)
+        log_stem = os.path.splitext(self.log_files[task_id])[0]
+        status_stem = os.path.splitext(self.status_files[task_id])[0]
+        files = (f'{log_stem}_copy.log', f'{status_stem}_copy.json',
+                 f'{status_stem}_copy.pid')
+        for item in files:
+            if os.path.isfile(item):
+                os.remove(item)
+        self.copies[task_id] = dict(host=remote_host, dir=copy_dir,
+                                    files=files, inputs=set())
+        logger.info('Starting a copy of %s on %s after %d s', task_id,
+                    remote_host, time.time() - self.start_times[task_id])
+        if self.warm_workers:
+            self.start_warm_workers([remote_host])
+        params = (script, copy_dir, setup)
+        if bool(os.environ.get('LCATR_STAGE_DATA', False)):
+            # Stage the device's data on the copy's host, in the
+            # background, with a device map for that host only.
+            device_map_file = os.path.join(copy_dir, 'device_list_map.json')
+            if os.path.lexists(device_map_file):
+                os.remove(device_map_file)
+            with open(device_map_file, 'w') as output:
+                json.dump({remote_host: [task_id]}, output)
+            self.copies[task_id]['inputs'].add('device_list_map.json')
+            self.copy_executor.submit(self._stage_and_launch_copy, task_id,
+                                      remote_host, params, files)
+        else:
+            self.launch_script(remote_host, task_id, params=params,
+                               files=files)
 
-    def monitor_tasks(self, max_time=None, interval=1):
+    def _mirror_inputs(self, task_id, src_dir, dest_dir):
         """
-        Function to keep track of remote processes by inspecting the
-        log files.
+        Mirror the inputs of a task in src_dir for a copy of the task
+        in dest_dir.  Directories are recreated, files that predate
+        the original task are symlinked, except for those with the
+        task_id in their names, which are copied since the task may
+        rewrite them.  Files written since the original task started,
+        i.e., the outputs of running tasks, are left out.
+        """
+        start_time = self.start_times[task_id]
+        skip = (self.log_dir, os.path.join(self.params[1], 'speculative'))
+        for entry in os.scandir(src_dir):
+            if entry.path in skip:
+                continue
+            dest = os.path.join(dest_dir, entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                os.makedirs(dest, exist_ok=True)
+                self._mirror_inputs(task_id, entry.path, dest)
+            elif entry.stat().st_mtime < start_time:
+                if task_id in entry.name:
+                    shutil.copy2(entry.path, dest)
+                else:
+                    os.symlink(entry.path, dest)
+
+    def _stage_and_launch_copy(self, task_id, remote_host, params, files):
+        """
+        Stage the data for a device on the host of its speculative
+        copy and then start the copy.  If the staging fails, the copy
+        is marked as failed.
+        """
+        logger = logging.getLogger('TaskRunner.launch_copy')
+        logger.setLevel(logging.INFO)
+        copy_script = os.path.join(os.environ['EOANALYSISJOBSDIR'],
+                                   'python', 'stage_bot_data.py')
+        log_file, status_file, pid_file = files
+        stem = os.path.splitext(status_file)[0]
+        staging_files = (os.path.splitext(log_file)[0] + '_staging.log',
+                         f'{stem}_staging.json', f'{stem}_staging.pid')
+        for item in staging_files:
+            if os.path.isfile(item):
+                os.remove(item)
+        self.launch_script(remote_host, remote_host,
+                           params=(copy_script, *params[1:]), wait=True,
+                           files=staging_files)
+        if task_id not in self.copies:
+            # The original finished while the data were being staged.
+            return
+        try:
+            with open(staging_files[1]) as fd:
+                status = json.load(fd)['status']
+        except (OSError, ValueError, KeyError):
+            status = None
+        if status != 'succeeded':
+            logger.info('Staging for the copy of %s on %s failed',
+                        task_id, remote_host)
+            with open(status_file, 'w') as output:
+                json.dump(dict(task_id=task_id, status='failed',
+                               host=remote_host), output)
+            return
+        self.launch_script(remote_host, task_id, params=params, files=files)
+
+    def finish_copy(self, task_id, use_copy):
+        """
+        Remove the speculative copy of a task.  If use_copy is True,
+        the original task is killed, its partial outputs are removed,
+        and the outputs of the copy are moved to the working directory,
+        otherwise the copy is killed.
+        """
+        logger = logging.getLogger('TaskRunner.finish_copy')
+        logger.setLevel(logging.INFO)
+
+        copy = self.copies.pop(task_id)
+        working_dir = self.params[1]
+        if use_copy:
+            logger.info('Using the copy of %s from %s', task_id,
+                        copy['host'])
+            self.kill_task(self.host_map[task_id], self.pid_files[task_id])
+            outputs = set()
+            for root, _, names in os.walk(copy['dir']):
+                for name in names:
+                    src = os.path.join(root, name)
+                    rel_path = os.path.relpath(src, copy['dir'])
+                    if os.path.islink(src) or rel_path in copy['inputs']:
+                        continue
+                    dest = os.path.join(working_dir, rel_path)
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    os.replace(src, dest)
+                    outputs.add(rel_path)
+            self._remove_partial_outputs(task_id, outputs)
+        else:
+            self.kill_task(copy['host'], copy['files'][2])
+        shutil.rmtree(copy['dir'], ignore_errors=True)
+
+    def _remove_partial_outputs(self, task_id, outputs):
+        """
+        Remove the files written by the killed original of a task,
+        i.e., those in the working directory with the task_id in their
+        names that were written after it started, other than the
+        outputs of its copy.
+        """
+        working_dir = self.params[1]
+        skip = (self.log_dir, os.path.join(working_dir, 'speculative'))
+        for root, dirs, names in os.walk(working_dir):
+            dirs[:] = [_ for _ in dirs if os.path.join(root, _) not in skip]
+            for name in names:
+                path = os.path.join(root, name)
+                if (task_id not in name or os.path.islink(path)
+                        or os.path.relpath(path, working_dir) in outputs):
+                    continue
+                if os.path.getmtime(path) >= self.start_times[task_id]:
+                    os.remove(path)
+
+    def _copy_outcome(self, task_id, status, status_names):
+        """
+        Combine the status of a task with that of its speculative
+        copy, and remove the copy once the outcome is known.
+        """
+        status_file = self.copies[task_id]['files'][1]
+        copy_status = None
+        if os.path.basename(status_file) in status_names:
+            copy_status = self._read_status(task_id, status_file)
+        if status == 'succeeded':
+            self.finish_copy(task_id, use_copy=False)
+        elif copy_status == 'succeeded':
+            self.finish_copy(task_id, use_copy=True)
+            return 'succeeded'
+        elif copy_status == 'failed':
+            self.finish_copy(task_id, use_copy=False)
+        elif status == 'failed':
+            # Wait for the copy to finish.
+            return None
+        return status
+
+    def speculate(self, pending, min_completed=3):
+        """
+        Start copies of the pending tasks that have been running for
+        longer than speculative_factor times the median run time of
+        the completed tasks.  Each task is copied at most once, and
+        only after min_completed tasks have succeeded.
+        """
+        if len(self.run_times) < min_completed:
+            return
+        max_run_time \
+            = self.speculative_factor*statistics.median(self.run_times)
+        now = time.time()
+        for task_id in pending:
+            if (task_id not in self.copied and task_id in self.start_times
+                    and now - self.start_times[task_id] > max_run_time):
+                self.launch_copy(task_id)
+
+    def monitor_tasks(self, max_time=None, interval=0.25,
+                      log_check_interval=30):
+        """
+        Function to keep track of remote processes via the json status
+        files they write on completion.
 
         Parameters
         ----------
@@ -146,9 +717,12 @@ class TaskRunner:
             Maximum time allowed for the parent task to complete.
             Note that processes on the remote nodes are not killed
             if the parent task times out.
-        interval: float [1]
-            Polling interval in seconds for checking log files for
-            task completion.
+        interval: float [0.25]
+            Polling interval in seconds for listing the status file
+            directory.
+        log_check_interval: float [30]
+            Interval in seconds for checking the ends of the log files
+            of tasks that have not written status files.
 
         Raises
         ------
@@ -157,51 +731,80 @@ class TaskRunner:
         logger = logging.getLogger('TaskRunner.monitor_tasks')
         logger.setLevel(logging.INFO)
 
-        # Poll log files for completion of each task:
-        log_files = list(self.log_files.values())
+        # Poll the status directory for completion of each task.  A
+        # single directory listing per poll suffices for all of the
+        # tasks, so only the status files of finished tasks are read.
+        pending = list(self.log_files)
         t0 = time.time()
+        last_log_check = t0
         failures = []
-        while log_files:
+        while pending:
             if max_time is not None and time.time() - t0 > max_time:
                 break
-            items = copy.deepcopy(log_files)
+            check_log = time.time() - last_log_check > log_check_interval
+            if check_log:
+                last_log_check = time.time()
+            if self.unstaged:
+                self.launch_staged()
+            status_names = set(os.listdir(self.status_dir))
             to_retry = []
-            for log_file in items:
-                task_id = self.task_ids[log_file]
-                with open(log_file, 'r') as fd:
-                    lines = fd.readlines()
-                    if lines and lines[-1].startswith('Task succeeded'):
-                        log_files.remove(log_file)
-                        logger.info('Done: %s', os.path.basename(log_file))
-                    if lines and lines[-1].startswith('Task failed'):
-                        if self.retries[task_id] >= self.max_retries:
-                            log_files.remove(log_file)
-                            logger.info('Failed: %s after %d attempt(s)',
-                                        os.path.basename(log_file),
-                                        self.max_retries + 1)
-                            failures.append(task_id)
-                        else:
-                            to_retry.append(task_id)
-                            self.retries[task_id] += 1
+            for task_id in list(pending):
+                status = self.task_status(task_id, status_names=status_names,
+                                          check_log=check_log)
+                if task_id in self.staging_failed:
+                    # The data for the device could not be staged, so
+                    # the task was never launched.
+                    status = 'failed'
+                    self.retries[task_id] = self.max_retries
+                if task_id in self.copies:
+                    status = self._copy_outcome(task_id, status,
+                                                status_names)
+                log_name = os.path.basename(self.log_files[task_id])
+                if status == 'succeeded':
+                    pending.remove(task_id)
+                    logger.info('Done: %s', log_name)
+                    self.wall_times[task_id] \
+                        = time.time() - self.start_times[task_id]
+                    self.run_times.append(self.wall_times[task_id])
+                    if self.on_complete is not None:
+                        self.on_complete(task_id, True)
+                elif status == 'failed':
+                    if self.retries[task_id] >= self.max_retries:
+                        pending.remove(task_id)
+                        logger.info('Failed: %s after %d attempt(s)',
+                                    log_name, self.max_retries + 1)
+                        failures.append(task_id)
+                        if self.on_complete is not None:
+                            self.on_complete(task_id, False)
+                    else:
+                        to_retry.append(task_id)
+                        self.retries[task_id] += 1
             if to_retry:
                 logger.info('Retrying tasks for: ')
                 for item in to_retry:
                     logger.info('  %s', item)
                 self.submit_jobs(to_retry, retry=True)
+            if self.speculative_factor is not None:
+                self.speculate(pending)
             time.sleep(interval)
+        for task_id in list(self.copies):
+            self.finish_copy(task_id, use_copy=False)
         messages = []
-        if log_files:
-            messages.append('\n  Unresponsive tasks: {}'\
-                            .format([self.task_ids[_] for _ in log_files]))
+        if pending:
+            messages.append(f'\n  Unresponsive tasks: {pending}')
         if failures:
             messages.append('  Failed tasks after {} retries: {}'\
                             .format(self.max_retries, failures))
         if messages:
             raise RuntimeError('\n'.join(messages))
 
-    def stage_data(self, device_map_file='device_list_map.json'):
+    def stage_data(self, device_map_file='device_list_map.json', wait=True):
         """
         Function to dispatch data staging script to the remote hosts.
+        If wait is False, then the staging scripts run in the
+        background and write a marker file in ready_dir for each
+        device as its data land, and a <host>.done status file when
+        they finish.
         """
         # Make inverse index of host -> list of devices and
         # save as json for the staging script to use.
@@ -210,28 +813,163 @@ class TaskRunner:
             device_map[host].append(device_name)
         with open(device_map_file, 'w') as fd:
             json.dump(dict(device_map), fd)
+        # Save the launch order of the devices over all of the hosts,
+        # so that the staging scripts' reads from the file server are
+        # prioritized across the hosts.
+        priority_file = os.path.join(os.path.dirname(device_map_file),
+                                     'device_priority.json')
+        with open(priority_file, 'w') as fd:
+            json.dump({device_name: index for index, device_name
+                       in enumerate(self.host_map)}, fd)
+        self.start_coordinator()
         # Loop over hosts and launch the copy script on each host.
         copy_script = os.path.join(os.environ['EOANALYSISJOBSDIR'],
                                    'python', 'stage_bot_data.py')
         # Set params to override self.params in self.make_log_file
         # and self.launch_script
         params = (copy_script, *self.params[1:])
+
+        if not wait:
+            # Remove the markers from any earlier staging.
+            if os.path.isdir(self.ready_dir):
+                shutil.rmtree(self.ready_dir)
+            os.makedirs(self.ready_dir)
+            self.staging_params = params
+            self.staged_hosts = set()
+            self.staging_retries = defaultdict(zero_func)
+            with ThreadPoolExecutor(max_workers=len(device_map)) as executor:
+                futures = [executor.submit(self.launch_staging, host)
+                           for host in device_map]
+            _ = [_.result() for _ in futures]
+            return
+
         # Loop over hosts and launch staging script.
-        with multiprocessing.Pool(processes=len(device_map)) as pool:
-            workers = []
+        with ThreadPoolExecutor(max_workers=len(device_map)) as executor:
+            futures = []
             for host in device_map:
                 if host not in self.log_files:
                     self.make_log_file(host, params=params)
-                args = (host, host)
-                kwds = dict(params=params, wait=True)
-                time.sleep(0.5)
-                workers.append(pool.apply_async(self.launch_script, args, kwds))
-            pool.close()
-            pool.join()
-            _ = [_.get() for _ in workers]
+                futures.append(executor.submit(self.launch_script, host, host,
+                                               params=params, wait=True))
+        _ = [_.result() for _ in futures]
 
         # Clear self.log_files of staging script entries.
         self.log_files = dict()
+        self.status_files = dict()
+
+    def start_coordinator(self):
+        """
+        Start a bandwidth_coordinator.BandwidthCoordinator for the
+        staging scripts, if LCATR_STAGING_MAX_RATE or
+        LCATR_STAGING_MAX_OPEN_FILES is set and it isn't running, and
+        pass its address to the staging scripts.
+        """
+        max_rate, max_open_files = staging_limits()
+        if self.coordinator is not None or (max_rate is None
+                                            and max_open_files is None):
+            return
+        self.coordinator = start_coordinator(max_rate=max_rate,
+                                             max_open_files=max_open_files)
+        self.lcatr_envs['LCATR_BANDWIDTH_COORDINATOR'] \
+            = self.coordinator.address
+
+    def stop_coordinator(self):
+        """
+        Stop the bandwidth coordinator, if it is running, and write the
+        staging throughput of each host to staging_throughput.json in
+        the working directory.
+        """
+        logger = logging.getLogger('TaskRunner.stop_coordinator')
+        logger.setLevel(logging.INFO)
+        if self.coordinator is None:
+            return
+        report = self.coordinator.report()
+        for host, stats in sorted(report.items()):
+            logger.info('%s: %d files, %.1f MB, %.1f MB/s, %.1f s waiting',
+                        host, stats['files'], stats['mb'],
+                        stats['mb_per_sec'], stats['waited'])
+        with open(self.throughput_file, 'w') as output:
+            json.dump(report, output, indent=2)
+        self.coordinator.shutdown()
+        self.coordinator.server_close()
+        self.coordinator = None
+        del self.lcatr_envs['LCATR_BANDWIDTH_COORDINATOR']
+
+    def launch_staging(self, host):
+        """
+        Launch the staging script on a host in the background.  It
+        writes a ready marker in ready_dir for each device as its data
+        land, and its status to <host>.done in ready_dir when it
+        finishes.
+        """
+        done_file = os.path.join(self.ready_dir, f'{host}.done')
+        if os.path.isfile(done_file):
+            os.remove(done_file)
+        files = (os.path.join(self.log_dir, f'stage_bot_data_{host}.log'),
+                 done_file, os.path.join(self.ready_dir, f'{host}.pid'))
+        self.launch_script(host, host, self.ready_dir,
+                           params=self.staging_params, files=files)
+
+    def staging_status(self, host, ready_names):
+        """
+        Return the status of the staging script on a host, 'succeeded'
+        or 'failed', or None if it has not finished.
+        """
+        if f'{host}.done' not in ready_names:
+            return None
+        try:
+            with open(os.path.join(self.ready_dir, f'{host}.done')) as fd:
+                status = json.load(fd)['status']
+        except (OSError, ValueError, KeyError):
+            status = None
+        return 'succeeded' if status == 'succeeded' else 'failed'
+
+    def is_staged(self, device_name, ready_names):
+        """
+        Return True if the data for a device have been staged, i.e.,
+        if its ready marker, or that of its CCD for an amp-level work
+        item, is among ready_names, or if the staging script on its
+        host has succeeded.
+        """
+        device = split_work_item(device_name)[0]
+        return (f'{device}.ready' in ready_names
+                or self.host_map[device_name] in self.staged_hosts)
+
+    def launch_staged(self):
+        """
+        Launch the tasks for the devices in self.unstaged whose data
+        have been staged.  If the staging script on a host fails, then
+        it is run again, up to max_retries times, after which the
+        tasks for the devices on that host that were not staged are
+        failed.
+        """
+        logger = logging.getLogger('TaskRunner.launch_staged')
+        logger.setLevel(logging.INFO)
+
+        ready_names = set(os.listdir(self.ready_dir))
+        for host in sorted({self.host_map[_] for _ in self.unstaged}):
+            status = self.staging_status(host, ready_names)
+            if status == 'succeeded':
+                self.staged_hosts.add(host)
+            elif status == 'failed':
+                missing = [_ for _ in self.unstaged
+                           if self.host_map[_] == host
+                           and not self.is_staged(_, ready_names)]
+                if self.staging_retries[host] < self.max_retries:
+                    self.staging_retries[host] += 1
+                    logger.info('Staging failed on %s, restaging', host)
+                    self.launch_staging(host)
+                    continue
+                logger.info('Staging failed on %s after %d attempt(s), '
+                            'failing the tasks for: %s', host,
+                            self.staging_retries[host] + 1, missing)
+                self.staging_failed.update(missing)
+                self.unstaged = [_ for _ in self.unstaged
+                                 if _ not in missing]
+        staged = [_ for _ in self.unstaged if self.is_staged(_, ready_names)]
+        if staged:
+            self.unstaged = [_ for _ in self.unstaged if _ not in staged]
+            self.launch_tasks(staged)
 
     def submit_jobs(self, device_names, retry=False):
         """
@@ -241,31 +979,85 @@ class TaskRunner:
         ----------
         device_names: list
             List of devices for which the task script will be run.
+        retry: bool [False]
+            Flag to indicate that the tasks are being retried, so
+            that their placements and data are reused.
+
+        If LCATR_STAGE_DATA and LCATR_PIPELINED_STAGING=True are set,
+        then each task is launched once the data for its device have
+        been staged on its host, while the rest of the data are staged
+        (see launch_staged), rather than after all of the staging has
+        finished.
+
+        Returns
+        -------
+        list: The devices that were not submitted since they don't fit
+            in the memory of any of the hosts (see place_devices).
         """
-        num_tasks = len(device_names)
+        deferred = []
         if not retry:
-            self.host_map = dict(zip(device_names, self.remote_hosts))
-            if bool(os.environ.get('LCATR_STAGE_DATA', False)):
-                self.stage_data()
-
-        # Using multiprocessing allows one to launch the scripts much
-        # faster since it can be done asynchronously.
-        with multiprocessing.Pool(processes=num_tasks) as pool:
-            outputs = []
-            for device_name, remote_host in self.host_map.items():
+            if hasattr(self.remote_hosts, 'refresh'):
+                # Re-measure the host loads for each subsequent batch.
+                self.remote_hosts.refresh(force=False)
+            self.host_map = place_devices(device_names, self.remote_hosts,
+                                          policy=self.placement,
+                                          raft_hosts=self.raft_hosts)
+            deferred = [_ for _ in device_names if _ not in self.host_map]
+            device_names = [_ for _ in device_names if _ in self.host_map]
+            if self.placement == 'raft':
+                # Save the raft placements so that later tasks in the
+                # same working directory, e.g., the raft-level tasks
+                # following the CCD-level ones, run where the data for
+                # the raft have already been staged.
+                with open(self.raft_host_file, 'w') as output:
+                    json.dump(self.raft_hosts, output)
+            stage_data = bool(os.environ.get('LCATR_STAGE_DATA', False))
+            pipelined = stage_data and self.pipelined_staging
+            if stage_data:
+                self.stage_data(wait=not pipelined)
+            if self.warm_workers:
+                self.start_warm_workers(self.host_map.values())
+            if pipelined:
+                # Register the tasks so that monitor_tasks waits for
+                # them, and launch them as their data land (see
+                # launch_staged).
+                for device_name in device_names:
+                    self.make_log_file(device_name)
+                self.unstaged.extend(device_names)
+                self.launch_staged()
+                return deferred
+
+        self.launch_tasks(device_names)
+        return deferred
+
+    def launch_tasks(self, device_names):
+        """
+        Launch the task script processes for the devices on the hosts
+        given by self.host_map.
+        """
+        num_tasks = len(device_names)
+        # Launch the scripts concurrently from a thread pool.  The
+        # command runner limits the number of concurrent sessions for
+        # each host.
+        max_workers = max(1, min(num_tasks, self.concurrency))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = []
+            for device_name in device_names:
+                remote_host = self.host_map[device_name]
                 if device_name not in self.log_files:
                     self.make_log_file(device_name)
-                args = remote_host, device_name
-                time.sleep(0.5)
-                outputs.append(pool.apply_async(self.launch_script, args))
-            pool.close()
-            pool.join()
-            _ = [_.get() for _ in outputs]
+                elif os.path.isfile(self.status_files[device_name]):
+                    # Remove the status file from the failed attempt.
+                    os.remove(self.status_files[device_name])
+                self.start_times[device_name] = time.time()
+                futures.append(executor.submit(self.launch_script,
+                                               remote_host, device_name))
+        _ = [_.result() for _ in futures]
 
 
 def ssh_device_analysis_pool(task_script, device_names, cwd='.', setup=None,
                              max_time=None, remote_hosts=None, verbose=False,
-                             max_retries=1):
+                             max_retries=1, on_complete=None):
     """
     Submit JH tasks on remote nodes.
 
@@ -293,31 +1085,118 @@ def ssh_device_analysis_pool(task_script, device_names, cwd='.', setup=None,
         Flag for additional diagnostic output.
     max_retries: int [1]
         Maximum number of retries for failed tasks.
+    on_complete: function [None]
+        Function called with the device name and a bool indicating
+        success as the task for each device finishes.
 
     Raises
     ------
     RuntimeError:  This will be raised if max_time is reached.
+
+    Notes
+    -----
+    If LCATR_PLACEMENT=raft, all of the devices of a raft run on the
+    same host and in the same batch, so that the data for the raft are
+    staged once, and raft-level tasks run where the CCD-level tasks
+    for the raft ran (see place_devices).
+
+    The devices are run in batches sized so that the expected peak
+    memory of the tasks, from the TaskMemoryHistory file or the
+    declared values in memory_admission, fits in the available memory
+    of the hosts, as measured before each batch.  The tasks are also
+    placed so that each host's share fits in its memory, and any that
+    don't fit are run in a later batch (see LoadAwareHosts.reserve).
+    The peak memory of each task is measured with /usr/bin/time, if
+    available, or by the warm worker daemons, and is recorded in the
+    TaskMemoryHistory file.  If the hosts don't
+    provide memory measurements, e.g., for LCATR_HOST_SELECTION=
+    round_robin, or if LCATR_NUM_BATCHES is set, then the devices are
+    divided into that many batches, or 2 batches if more than 100
+    devices are requested.
+
+    If LCATR_STAGE_DATA and LCATR_PIPELINED_STAGING=True are set, then
+    each task starts as soon as the data for its device are staged on
+    its host, while the staging of the other devices continues.
+
+    If LCATR_STAGING_MAX_RATE (MB/s) or LCATR_STAGING_MAX_OPEN_FILES is
+    set, then the staging scripts read from the file server subject to
+    those cluster-wide limits, and their throughput by host is written
+    to staging_throughput.json (see bandwidth_coordinator).
+
+    Unless LCATR_USE_TASK_HISTORY=False, the wall time of each task,
+    from its launch until its status file is seen, is recorded in the
+    TaskRuntimeHistory file.
+
+    If LCATR_SPECULATIVE_FACTOR is set, then tasks that run longer
+    than that factor times the median run time of the completed tasks
+    are started again on another host, and the first copy to succeed
+    is used (see TaskRunner.launch_copy).
     """
     cwd = os.path.abspath(cwd)
     if setup is None:
         setup = os.environ.get('LCATR_SETUP_SCRIPT',
                                os.path.join(os.environ['INST_DIR'], 'setup.sh'))
 
+    task = task_name(task_script)
+    history = None
+    if os.environ.get('LCATR_USE_TASK_HISTORY', 'True') == 'True':
+        history = TaskRuntimeHistory()
+    memory_history = TaskMemoryHistory()
+    mem_per_task = task_peak_memory(task, device_names, memory_history)
     task_runner = TaskRunner(task_script, cwd, setup, max_retries=max_retries,
-                             remote_hosts=remote_hosts, verbose=verbose)
-    # In order to limit memory usage and to avoid overloading the file
-    # server, divide into 2 batches by default if processing for more
-    # than 100 devices is requested.
+                             remote_hosts=remote_hosts, verbose=verbose,
+                             mem_per_task=mem_per_task,
+                             on_complete=on_complete)
+    if task_runner.placement == 'raft':
+        # Keep the devices of each raft in the same batch.
+        device_names = group_by_raft(device_names)
     ndev = len(device_names)
-    num_batches = 2 if ndev > 100 else 1
-
-    # Use override value from LCATR_NUM_BATCHES if it is set.
-    num_batches = int(os.environ.get('LCATR_NUM_BATCHES', num_batches))
-    print("# devices, # batches, # hosts:",
-          ndev, num_batches, task_runner.remote_hosts.num_hosts)
-
-    bounds = np.linspace(0, ndev, num_batches + 1, dtype=int)
-    print(bounds)
-    for imin, imax in zip(bounds[:-1], bounds[1:]):
-        task_runner.submit_jobs(device_names[imin:imax])
-        task_runner.monitor_tasks(max_time=max_time)
+    try:
+        if ('LCATR_NUM_BATCHES' in os.environ
+                or not hasattr(task_runner.remote_hosts, 'capacity')):
+            # In order to limit memory usage and to avoid overloading
+            # the file server, divide into 2 batches by default if
+            # processing for more than 100 devices is requested.
+            num_batches = 2 if ndev > 100 else 1
+
+            # Use override value from LCATR_NUM_BATCHES if it is set.
+            num_batches = int(os.environ.get('LCATR_NUM_BATCHES',
+                                             num_batches))
+            print("# devices, # batches, # hosts:",
+                  ndev, num_batches, task_runner.remote_hosts.num_hosts)
+
+            bounds = np.linspace(0, ndev, num_batches + 1, dtype=int)
+            if task_runner.placement == 'raft':
+                bounds = sorted({raft_boundary(device_names, _)
+                                 for _ in bounds})
+            print(bounds)
+            deferred = []
+            for imin, imax in zip(bounds[:-1], bounds[1:]):
+                deferred = task_runner.submit_jobs(
+                    deferred + device_names[imin:imax])
+                task_runner.monitor_tasks(max_time=max_time)
+            while deferred:
+                deferred = task_runner.submit_jobs(deferred)
+                task_runner.monitor_tasks(max_time=max_time)
+        else:
+            remaining = list(device_names)
+            while remaining:
+                task_runner.remote_hosts.refresh(force=False)
+                num_tasks = task_runner.remote_hosts.capacity()
+                print("# devices, # admitted, # hosts, GB per task:",
+                      len(remaining), num_tasks,
+                      task_runner.remote_hosts.num_hosts, mem_per_task)
+                if task_runner.placement == 'raft':
+                    num_tasks = whole_rafts(remaining, num_tasks)
+                batch, remaining = remaining[:num_tasks], remaining[num_tasks:]
+                remaining = task_runner.submit_jobs(batch) + remaining
+                task_runner.monitor_tasks(max_time=max_time)
+    finally:
+        task_runner.stop_coordinator()
+        for device_name, peak_memory in task_runner.peak_memory.items():
+            memory_history.record(task, device_name, peak_memory)
+        memory_history.save()
+        if history is not None:
+            for device_name, wall_time in task_runner.wall_times.items():
+                history.record(task, device_name, wall_time)
+            history.save()
@@ -6,11 +6,17 @@ import os
 import sys
 import glob
 import json
-import shutil
+import fnmatch
+import functools
 import pickle
 import subprocess
 import siteUtils
 from camera_components import camera_info
+from amp_tasks import split_work_item
+from staging_cache import StagingCache
+from copy_engine import CopyEngine
+from peer_staging import peer_index_dir, PeerIndex, PeerFetcher
+from bandwidth_coordinator import coordinator_client
 from bot_eo_analyses import glob_pattern, bias_filename, medianed_dark_frame,\
     get_mask_files
 
@@ -36,6 +42,9 @@ CCD_DATA_KEYS = {'bias_frame_BOT': ('bias_frame', 'bias_stability'),
 RAFT_DATA_KEYS = {'read_noise_BOT': ('raft_noise_correlations',),
                   'tearing_BOT': ('divisadero_tearing',)}
 
+# Order in which the jobs of the traveler are run.
+TRAVELER_JOBS = tuple(CCD_DATA_KEYS)
+
 
 def write_hj_server_file(hj_fp_server_file='hj_fp_server.pkl'):
     """
@@ -94,10 +103,48 @@ def get_isr_files(det_name, run):
     return files
 
 
-def stage_isr_files(device_list, dest_dir):
+def staging_peers(host):
+    """
+    Return the PeerIndex for the current run, if peer staging is
+    enabled with LCATR_PEER_INDEX_DIR and the current host is known,
+    otherwise None.
+    """
+    index_dir = peer_index_dir(siteUtils.getRunNumber())
+    if host is None or index_dir is None:
+        return None
+    return PeerIndex(index_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def staging_throttle(host):
+    """
+    Return the client of the bandwidth coordinator for the reads from
+    the file server, if LCATR_BANDWIDTH_COORDINATOR is set, otherwise
+    None.
+    """
+    return coordinator_client(host)
+
+
+def make_copy_engine(host, peer_index):
+    """
+    Make the CopyEngine for staging files on host, which fetches the
+    files that other hosts have already staged from those hosts, if
+    peer_index is not None, and otherwise copies them from the file
+    server, subject to the bandwidth coordinator, if there is one.
+    """
+    throttle = staging_throttle(host)
+    if peer_index is None:
+        return CopyEngine(throttle=throttle)
+    peer_index.load()
+    return CopyEngine(fetch=PeerFetcher(peer_index, host), throttle=throttle)
+
+
+def stage_isr_files(device_list, dest_dir, host=None, priority=0):
     """
     Stage bias frame, dark frame, and mask files for the specified
-    devices.
+    devices.  If host is given, then these files may be fetched from
+    other hosts, see staging_peers.  The priority is that of the reads
+    from the file server, with lower values going first.
     """
     run = siteUtils.getRunNumber()
     fits_files = set()
@@ -116,27 +163,125 @@ def stage_isr_files(device_list, dest_dir):
             det_name = '_'.join((raft, slot))
             fits_files = fits_files.union(get_isr_files(det_name, run))
 
+    files = dict()
     for src in fits_files:
         folder = os.path.basename(os.path.dirname(src))
-        os.makedirs(os.path.join(dest_dir, folder), exist_ok=True)
-        dest = os.path.join(dest_dir, folder, os.path.basename(src))
-        if not os.path.isfile(dest):
-            print('copying', src, 'to', dest)
-            shutil.copy(src, dest)
+        files[src] = os.path.join(dest_dir, folder, os.path.basename(src))
+    peer_index = staging_peers(host)
+    make_copy_engine(host, peer_index).copy(files, priority=priority)
+    if peer_index is not None:
+        peer_index.update(host, files)
+
+
+def raft_ccds(raft):
+    """Return the names of the CCDs in a raft."""
+    return sorted(_ for _ in CCDS if _.startswith(raft + '_'))
+
+
+def raft_device_groups(ccds):
+    """
+    Replace the CCDs that make up whole rafts with the raft names, so
+    that the files for each of those rafts are found with one glob,
+    e.g., for the 'raft' LCATR_PLACEMENT policy of the ssh_dispatcher.
+    The order of the CCDs is preserved, with each raft in the place of
+    its first CCD.
+    """
+    ccds = list(ccds)
+    devices = []
+    for ccd in ccds:
+        raft = ccd.split('_')[0]
+        if raft in RAFTS and set(raft_ccds(raft)).issubset(ccds):
+            ccd = raft
+        if ccd not in devices:
+            devices.append(ccd)
+    return devices
+
+
+def device_priorities(priority_file='device_priority.json'):
+    """
+    Read the launch order of the devices over all of the hosts, as
+    written by the ssh_dispatcher.TaskRunner, and return the priority
+    of each CCD and raft, i.e., the place of its first work item in
+    that order, or None if the file can't be read.
+    """
+    try:
+        with open(priority_file) as fd:
+            order = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    priorities = dict()
+    for device_name, index in order.items():
+        device_name = split_work_item(device_name)[0]
+        for device in {device_name, device_name.split('_')[0]}:
+            priorities[device] = min(index, priorities.get(device, index))
+    return priorities
+
+
+def write_ready_markers(ready_dir, device_names):
+    """
+    Write a marker file in ready_dir for each device whose data have
+    been staged, for the ssh_dispatcher.TaskRunner to launch its task.
+    """
+    for device_name in device_names:
+        with open(os.path.join(ready_dir, f'{device_name}.ready'), 'w'):
+            pass
+
+
+def remaining_jobs(job_name):
+    """
+    Return the current job and the jobs that follow it in the
+    traveler.  The job order is given by the comma-separated
+    LCATR_TRAVELER_JOBS environment variable, if set, otherwise by
+    TRAVELER_JOBS.
+    """
+    jobs = os.environ.get('LCATR_TRAVELER_JOBS', ','.join(TRAVELER_JOBS))
+    jobs = [_.strip() for _ in jobs.split(',') if _.strip()]
+    if job_name not in jobs:
+        return [job_name]
+    return jobs[jobs.index(job_name):]
 
 
-def stage_files(device_list, data_keys):
+def jobs_needing(folder, jobs):
+    """
+    Return the jobs that need the files in the exposure folder, i.e.,
+    those with a data key whose glob pattern matches the folder name.
+    """
+    needed_by = set()
+    for job in jobs:
+        data_keys = CCD_DATA_KEYS.get(job, ()) + RAFT_DATA_KEYS.get(job, ())
+        if any(fnmatch.fnmatch(folder, glob_pattern.task_patterns[_])
+               for _ in data_keys):
+            needed_by.add(job)
+    return needed_by
+
+
+def stage_files(device_list, data_keys, job_name=None, ready=None,
+                host=None, priorities=None):
     """
     Function to stage the needed raw image files from the specified
     devices (CCDs or rafts) for the current job in the scratch area.
+    The files are kept in a cache for the whole traveler, see
+    staging_cache.StagingCache, so that files used by later jobs are
+    only copied once.  If job_name is None, then use the LCATR_JOB
+    environment variable.
+
+    The devices are staged one at a time, in order, and, if given,
+    ready(device) is called once the raw image files and the ISR files
+    for each device are in place, so that its task can start while the
+    remaining devices are staged.
+
+    If host, the name of the current host, is given and
+    LCATR_PEER_INDEX_DIR is set, then files that other hosts have
+    already staged for this run are fetched from those hosts rather
+    than from the file server (see peer_staging).  The reads from the
+    file server for each device have the priority given in the
+    priorities dict, e.g., from device_priorities(), so that they are
+    ordered over all of the hosts, or, for devices not in it, priority
+    over those for the devices after it.
     """
-    # Gather the filenames of the needed data.
-    fits_files = set()
-    for device in device_list:
-        fits_files = fits_files.union(get_files(data_keys, device))
-
-    if not fits_files:
-        return
+    if job_name is None:
+        job_name = os.environ['LCATR_JOB']
+    jobs = remaining_jobs(job_name)
 
     # Make the scratch directory for the BOT data.
     run_number = siteUtils.getRunNumber()
@@ -144,11 +289,29 @@ def stage_files(device_list, data_keys):
     dest_dir = os.path.join(scratch_dir, 'bot_data', str(run_number))
     os.makedirs(dest_dir, exist_ok=True)
 
-    # Glob existing files to avoid re-copying or for possible clean up.
-    old_files = set(glob.glob(os.path.join(dest_dir, '*', 'MC_C*.fits')))
-    old_files = old_files.union(
-        glob.glob(os.path.join(dest_dir, '*', 'Photodiode*.txt')))
+    if priorities is None:
+        priorities = dict()
+    for index, device in enumerate(device_list):
+        priority = priorities.get(device, index)
+        # Gather the filenames of the needed data.
+        fits_files = get_files(data_keys, device)
 
+        if fits_files:
+            stage_device_files(fits_files, dest_dir, job_name, jobs,
+                               host=host, priority=priority)
+            stage_isr_files([device], dest_dir, host=host,
+                            priority=priority)
+
+        if ready is not None:
+            ready(device)
+
+
+def stage_device_files(fits_files, dest_dir, job_name, jobs, host=None,
+                       priority=0):
+    """
+    Stage the raw image files for a device, along with any photodiode
+    readings files, in the cache in dest_dir.
+    """
     # Create a dict that maps src to dest file paths.  Preserve the
     # folder name of the exposure so that the PTC and flat pairs tasks
     # can identify the paired exposures.
@@ -167,19 +330,21 @@ def stage_files(device_list, data_keys):
             new_files[src] = os.path.join(dest_dir, os.path.basename(frame_dir),
                                           os.path.basename(src))
 
-    # Clean up unneeded files.
-    unneeded_files = old_files.difference(new_files.values())
-    for item in unneeded_files:
-        print('removing', item)
-        os.remove(item)
-
-    # Copy the remaining files.
+    # Tag each file with the jobs that need it, so that files used
+    # by later jobs are kept in the cache.
+    needed_by = dict()
     for src, dest in new_files.items():
-        if dest not in old_files:
-            print('copying', src, 'to', dest)
-            shutil.copy(src, dest)
+        folder = os.path.basename(os.path.dirname(src))
+        needed_by[dest] = jobs_needing(folder, jobs).union({job_name})
 
-    stage_isr_files(device_list, dest_dir)
+    peer_index = staging_peers(host)
+    engine = make_copy_engine(host, peer_index)
+    copy = functools.partial(engine.copy, priority=priority)
+    with StagingCache(dest_dir, copy=copy, job=job_name) as cache:
+        cache.release(jobs)
+        cache.stage(new_files, needed_by)
+    if peer_index is not None:
+        peer_index.update(host, new_files, removed=cache.evicted)
 
 
 if __name__ == '__main__':
@@ -191,14 +356,36 @@ if __name__ == '__main__':
     with open('device_list_map.json', 'r') as fd:
         device_list_map = json.load(fd)
     host = sys.argv[1]
-    device_list = device_list_map[host]
+    # Directory for the ready markers of the staged devices, if the
+    # dispatcher launches the tasks as their data land.
+    ready_dir = sys.argv[2] if len(sys.argv) > 2 else None
+    # Map any amp-level work items to their CCDs, keeping the order in
+    # which the dispatcher will launch them.
+    device_list = list(dict.fromkeys(split_work_item(_)[0]
+                                     for _ in device_list_map[host]))
 
     job_name = os.environ['LCATR_JOB']
 
-    ccds = CCDS.intersection(device_list)
+    def ccds_ready(device):
+        """Mark the CCDs of a staged CCD or raft as ready."""
+        if ready_dir is not None:
+            write_ready_markers(ready_dir, raft_ccds(device)
+                                if device in RAFTS else [device])
+
+    def raft_ready(device):
+        """Mark a staged raft as ready."""
+        if ready_dir is not None:
+            write_ready_markers(ready_dir, [device])
+
+    priorities = device_priorities()
+
+    ccds = [_ for _ in device_list if _ in CCDS]
     if ccds and job_name in CCD_DATA_KEYS:
-        stage_files(ccds, CCD_DATA_KEYS[job_name])
+        stage_files(raft_device_groups(ccds), CCD_DATA_KEYS[job_name],
+                    job_name, ready=ccds_ready, host=host,
+                    priorities=priorities)
 
-    rafts = RAFTS.intersection(device_list)
+    rafts = [_ for _ in device_list if _ in RAFTS]
     if rafts and job_name in RAFT_DATA_KEYS:
-        stage_files(rafts, RAFT_DATA_KEYS[job_name])
+        stage_files(rafts, RAFT_DATA_KEYS[job_name], job_name,
+                    ready=raft_ready, host=host, priorities=priorities)
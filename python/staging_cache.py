@@ -0,0 +1,191 @@
+"""
+Node-local cache of the files staged in a scratch area, shared by the
+jobs of a traveler.  Each cached file is tagged with the jobs that
+still need it, so files used by several jobs, e.g., the flats used by
+the ptc, flat pairs, brighter-fatter and overscan jobs, are copied
+once per run per node, and files are evicted in least recently used
+order, unneeded files first, to keep the cache within a disk budget.
+"""
+import os
+import json
+import time
+import fcntl
+import logging
+from copy_engine import CopyEngine, is_current
+
+__all__ = ['StagingCache', 'scratch_budget']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+def scratch_budget(budget=None):
+    """
+    Disk budget in bytes for the staging cache:  the value in GB of
+    LCATR_SCRATCH_BUDGET_GB, if set, otherwise budget.  None means no
+    budget.
+    """
+    budget = os.environ.get('LCATR_SCRATCH_BUDGET_GB', budget)
+    if budget is None:
+        return None
+    return float(budget)*1024**3
+
+
+class StagingCache:
+    """
+    Context manager for the index of the files staged in a cache
+    directory.  The index is kept in staging_cache.json in that
+    directory and is locked while in use, so that concurrent staging
+    processes on the same node don't interfere.
+
+    If there is no disk budget, files that no remaining job needs are
+    deleted as soon as a job is staged.  With a budget, they are kept,
+    e.g., for reruns, until space is needed.  Files needed by the
+    current job are never evicted, even if the job's inputs exceed the
+    budget, so that the devices staged first keep their data while the
+    rest of the devices are staged.
+    """
+    def __init__(self, cache_dir, budget=None, copy=None, job=None):
+        """
+        Parameters
+        ----------
+        cache_dir: str
+            Directory containing the cached files.
+        budget: float [None]
+            Disk budget in bytes for the cached files.  If None, then
+            use scratch_budget().
+        copy: function [None]
+            Function to copy files, given as a dict of destination
+            paths keyed by source path.  If None, then use the copy
+            method of a copy_engine.CopyEngine.
+        job: str [None]
+            The current job.  The files it needs are pinned in the
+            cache until it is released, see release().
+        """
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, 'staging_cache.json')
+        self.budget = scratch_budget() if budget is None else budget
+        self.copy = CopyEngine().copy if copy is None else copy
+        self.job = job
+        self.index = dict()
+        self.evicted = []
+        self._lock = None
+        self.logger = logging.getLogger('StagingCache')
+        self.logger.setLevel(logging.INFO)
+
+    def __enter__(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._lock = open(self.index_file + '.lock', 'w')
+        fcntl.flock(self._lock, fcntl.LOCK_EX)
+        try:
+            with open(self.index_file) as fd:
+                self.index = json.load(fd)
+        except (OSError, ValueError):
+            self.index = dict()
+        # Forget files that have been removed by other means.
+        self.evicted = [_ for _ in self.index if not os.path.isfile(_)]
+        for dest in self.evicted:
+            del self.index[dest]
+        return self
+
+    def __exit__(self, *args):
+        tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as output:
+            json.dump(self.index, output)
+        os.replace(tmp_file, self.index_file)
+        self._lock.close()
+        self._lock = None
+
+    def usage(self):
+        """Total size in bytes of the cached files."""
+        return sum(_['size'] for _ in self.index.values())
+
+    def _is_cached(self, src, dest):
+        entry = self.index.get(dest)
+        if entry is not None:
+            return entry['src'] == src
+        # Adopt a complete copy made before the index existed.
+        if is_current(src, dest):
+            self.index[dest] = dict(src=src, size=os.path.getsize(src),
+                                    last_used=0, jobs=[])
+            return True
+        return False
+
+    def release(self, remaining_jobs):
+        """
+        Remove the jobs that are not in remaining_jobs from the jobs
+        that need each file.
+        """
+        remaining_jobs = set(remaining_jobs)
+        for entry in self.index.values():
+            entry['jobs'] = sorted(remaining_jobs.intersection(entry['jobs']))
+
+    def evict(self, nbytes, keep=()):
+        """
+        Evict files so that nbytes more fit in the budget, or, with no
+        budget, evict the files no job needs.  Files no job needs are
+        evicted first, then files needed by later jobs, each in least
+        recently used order.  Files in keep and files needed by the
+        current job are not evicted.
+
+        Returns
+        -------
+        list: The evicted files.
+        """
+        keep = set(keep).union(dest for dest, entry in self.index.items()
+                               if self.job in entry['jobs'])
+        candidates = sorted((_ for _ in self.index if _ not in keep),
+                            key=lambda _: (bool(self.index[_]['jobs']),
+                                           self.index[_]['last_used']))
+        evicted = []
+        usage = self.usage()
+        for dest in candidates:
+            if self.budget is None:
+                if self.index[dest]['jobs']:
+                    break
+            elif usage + nbytes <= self.budget:
+                break
+            usage -= self.index[dest]['size']
+            self.logger.info('evicting %s', dest)
+            try:
+                os.remove(dest)
+            except FileNotFoundError:
+                pass
+            del self.index[dest]
+            evicted.append(dest)
+        if self.budget is not None and usage + nbytes > self.budget:
+            self.logger.info('files pinned by %s exceed the budget of '
+                             '%.1f GB', self.job, self.budget/1024**3)
+        self.evicted.extend(evicted)
+        return evicted
+
+    def stage(self, files, jobs):
+        """
+        Stage files for the current job.
+
+        Parameters
+        ----------
+        files: dict
+            Destination paths in the cache directory keyed by source
+            path.
+        jobs: dict
+            The jobs that need each file, keyed by destination path,
+            including the current job and any later ones.
+
+        Returns
+        -------
+        list: The destination paths of the files that were copied.
+        """
+        now = time.time()
+        to_copy = {src: dest for src, dest in files.items()
+                   if not self._is_cached(src, dest)}
+        nbytes = sum(os.path.getsize(_) for _ in to_copy)
+        self.evict(nbytes, keep=files.values())
+        self.copy(to_copy)
+        for src, dest in to_copy.items():
+            self.index[dest] = dict(src=src, size=os.path.getsize(dest),
+                                    last_used=now, jobs=[])
+        for dest in files.values():
+            entry = self.index[dest]
+            entry['last_used'] = now
+            entry['jobs'] = sorted(set(entry['jobs']).union(jobs[dest]))
+        return list(to_copy.values())
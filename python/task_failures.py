@@ -0,0 +1,103 @@
+"""
+Retry settings and structured failure reports for device-level tasks.
+"""
+import os
+import json
+import time
+from collections import namedtuple
+
+__all__ = ['TaskFailure', 'TaskFailedError', 'FailureReport',
+           'max_task_retries', 'retry_delay']
+
+
+TaskFailure = namedtuple('TaskFailure', ('device_name', 'exception',
+                                         'traceback', 'timed_out'))
+TaskFailure.__doc__ = """
+Failure of a task on a device:  the repr of the exception, the
+formatted traceback from the process that ran the task, and whether
+the task was stopped for exceeding its walltime.
+"""
+
+
+class TaskFailedError(RuntimeError):
+    """
+    Tasks failed on some devices after all retries.  The `failures`
+    attribute is a dict of TaskFailure tuples keyed by device name.
+    """
+    def __init__(self, task, failures):
+        self.task = task
+        self.failures = failures
+        super().__init__(f'{task} failed for {sorted(failures)}')
+
+
+def max_task_retries(max_retries=None):
+    """
+    Number of times to retry a failed task on a device:  the value of
+    LCATR_MAX_RETRIES, if set, otherwise max_retries, or 1 if that is
+    None.
+    """
+    if max_retries is None:
+        max_retries = 1
+    return int(os.environ.get('LCATR_MAX_RETRIES', max_retries))
+
+
+def retry_delay(attempt, backoff=None, max_delay=600):
+    """
+    Delay in seconds before retrying after the given attempt, doubling
+    with each attempt.
+
+    Parameters
+    ----------
+    attempt: int
+        Number of the attempt that failed, starting at 1.
+    backoff: float [None]
+        Delay after the first attempt.  If None, then the value of
+        LCATR_RETRY_BACKOFF is used, if set, otherwise 10.
+    max_delay: float [600]
+        Maximum delay.
+    """
+    if backoff is None:
+        backoff = float(os.environ.get('LCATR_RETRY_BACKOFF', 10))
+    return min(max_delay, backoff*2**(attempt - 1))
+
+
+class FailureReport:
+    """
+    Class to append a json record for each failed task attempt to a
+    report file as the failures occur, so that the failures of a job
+    can be examined while it is still running.
+    """
+    def __init__(self, task, report_file=None):
+        """
+        Parameters
+        ----------
+        task: str
+            Task name.
+        report_file: str [None]
+            File to append the records to.  If None, then the
+            LCATR_FAILURE_REPORT environment variable is used, if set,
+            otherwise task_failures.jsonl in the current directory.
+        """
+        if report_file is None:
+            report_file = os.environ.get('LCATR_FAILURE_REPORT',
+                                         'task_failures.jsonl')
+        self.task = task
+        self.report_file = report_file
+
+    def record(self, failure, attempt, final):
+        """
+        Append the record of a failure.
+
+        Parameters
+        ----------
+        failure: TaskFailure
+            The failure to record.
+        attempt: int
+            Number of the attempt, starting at 1.
+        final: bool
+            True if the task will not be retried.
+        """
+        entry = dict(time=time.time(), task=self.task, attempt=attempt,
+                     final=final, **failure._asdict())
+        with open(self.report_file, 'a') as output:
+            output.write(json.dumps(entry) + '\n')
@@ -0,0 +1,196 @@
+"""
+Local store of per-(task, device) wall times from previous runs, used
+to submit the most expensive devices first and to choose the chunk
+size for device-level analyses.
+"""
+import os
+import json
+import statistics
+from collections import defaultdict
+from amp_tasks import AMP_SEPARATOR, split_work_item
+
+__all__ = ['TaskRuntimeHistory', 'device_type', 'task_name', 'history_key']
+
+
+def device_type(device_name):
+    """
+    Return the type of device, 'raft', 'corner' (wavefront or guider
+    CCD), or 'science', since these have very different costs.
+    """
+    if '_' not in device_name:
+        return 'raft'
+    slot = device_name.split('_')[-1]
+    if slot.startswith('SW') or slot.startswith('SG'):
+        return 'corner'
+    return 'science'
+
+
+def task_name(task_func):
+    """
+    Name used to key a task function or command-line script in the
+    runtime history.
+    """
+    if isinstance(task_func, str):
+        return os.path.basename(task_func).split('.')[0]
+    return getattr(task_func, '__name__', type(task_func).__name__)
+
+
+def history_key(task, device_name):
+    """
+    Key for a task run on a device in the histories.  The amp-level
+    work items, e.g., 'R22_S11:3', are kept under task + ':amp', since
+    their costs are much smaller than those for whole CCDs.
+    """
+    if split_work_item(device_name)[1] is not None:
+        return f'{task}{AMP_SEPARATOR}amp'
+    return task
+
+
+class TaskRuntimeHistory:
+    """
+    Class to record and query wall times for device-level tasks.  The
+    most recent `max_entries` wall times for each (task, device) are
+    kept in a json file.  Subclasses can keep other per-device
+    quantities by overriding the `env_var` and `default_file` class
+    attributes that set the location of the file.
+    """
+    env_var = 'LCATR_TASK_HISTORY_FILE'
+    default_file = 'task_runtimes.json'
+
+    def __init__(self, history_file=None, max_entries=5):
+        """
+        Parameters
+        ----------
+        history_file: str [None]
+            json file containing the wall time history.  If None, then
+            the LCATR_TASK_HISTORY_FILE environment variable is used,
+            if set, otherwise ~/.lcatr/task_runtimes.json.  Subclasses
+            use their own environment variable and file name.
+        max_entries: int [5]
+            Maximum number of wall times to keep for each task and device.
+        """
+        if history_file is None:
+            history_file = os.environ.get(
+                self.env_var,
+                os.path.join(os.path.expanduser('~'), '.lcatr',
+                             self.default_file))
+        self.history_file = history_file
+        self.max_entries = max_entries
+        self.wall_times = self._read()
+        self._new_entries = defaultdict(list)
+
+    def _read(self):
+        """Read the wall times from the history file."""
+        wall_times = defaultdict(dict)
+        try:
+            with open(self.history_file) as fd:
+                wall_times.update(json.load(fd))
+        except (OSError, ValueError):
+            pass
+        return wall_times
+
+    def record(self, task, device_name, wall_time):
+        """
+        Record the wall time in seconds for a task run on a device.
+        """
+        task = history_key(task, device_name)
+        self._new_entries[(task, device_name)].append(wall_time)
+        entries = self.wall_times[task].setdefault(device_name, [])
+        entries.append(wall_time)
+        del entries[:-self.max_entries]
+
+    def save(self):
+        """
+        Write the history file, merging with any entries written by
+        other processes since it was read.
+        """
+        if not self._new_entries:
+            return
+        wall_times = self._read()
+        for (task, device_name), values in self._new_entries.items():
+            entries = wall_times[task].setdefault(device_name, [])
+            entries.extend(values)
+            del entries[:-self.max_entries]
+        os.makedirs(os.path.dirname(os.path.abspath(self.history_file)),
+                    exist_ok=True)
+        tmp_file = f'{self.history_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as output:
+            json.dump(wall_times, output)
+        os.replace(tmp_file, self.history_file)
+        self.wall_times = wall_times
+        self._new_entries = defaultdict(list)
+
+    def estimate(self, task, device_name):
+        """
+        Estimated wall time for a task run on a device.  This is the
+        median of the recorded values for that device, or if there are
+        none, for devices of the same type, or if there are none of
+        those, for all devices.  None is returned if the task has no
+        history.
+        """
+        task = history_key(task, device_name)
+        task_times = self.wall_times.get(task, {})
+        if device_name in task_times and task_times[device_name]:
+            return statistics.median(task_times[device_name])
+        dtype = device_type(device_name)
+        same_type = [value for device, values in task_times.items()
+                     if device_type(device) == dtype for value in values]
+        if same_type:
+            return statistics.median(same_type)
+        all_values = [value for values in task_times.values()
+                      for value in values]
+        if all_values:
+            return statistics.median(all_values)
+        return None
+
+    def order(self, task, device_names):
+        """
+        Return the device names sorted by decreasing estimated wall time.
+        The original order is kept for devices with equal estimates or
+        if the task has no history.
+        """
+        estimates = {_: self.estimate(task, _) for _ in device_names}
+        if all(_ is None for _ in estimates.values()):
+            return list(device_names)
+        longest = max(_ for _ in estimates.values() if _ is not None)
+        return sorted(device_names,
+                      key=lambda _: -(estimates[_] if estimates[_] is not None
+                                      else longest))
+
+    def pool_params(self, task, device_names, processes, min_task_time=2.):
+        """
+        Choose the pool width and chunk size for running a task over a
+        set of devices.
+
+        All of the requested processes are used, up to the number of
+        devices, since using fewer can lengthen the makespan when the
+        estimates are off or the tasks don't pack evenly.  Devices are
+        sent one at a time unless the tasks are short enough that
+        dispatch overhead matters.
+
+        Parameters
+        ----------
+        task: str
+            Task name.
+        device_names: list
+            Device names to be processed.
+        processes: int
+            Maximum number of processes.
+        min_task_time: float [2.]
+            Median estimated wall time in seconds below which devices
+            are sent to the workers in chunks.
+
+        Returns
+        -------
+        (int, int): The number of processes and the chunk size.
+        """
+        ndev = len(device_names)
+        processes = max(1, min(processes, ndev))
+        estimates = [self.estimate(task, _) for _ in device_names]
+        estimates = [_ for _ in estimates if _ is not None]
+        if not estimates:
+            return processes, 1
+        chunksize = 1
+        if statistics.median(estimates) < min_task_time:
+            chunksize = max(1, ndev//(4*processes))
+        return processes, chunksize
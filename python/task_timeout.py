@@ -0,0 +1,192 @@
+"""
+Per-task walltime enforcement for device-level analysis tasks.
+"""
+import os
+import time
+import pickle
+import select
+import signal
+import logging
+import threading
+import traceback
+import contextlib
+import multiprocessing
+
+__all__ = ['TaskTimeoutError', 'task_walltime', 'deadline',
+           'run_with_deadline', 'WorkerWatchdog', 'dead_workers']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+
+class TaskTimeoutError(RuntimeError):
+    """A task did not finish within its walltime."""
+
+
+def task_walltime(walltime):
+    """
+    Return the walltime in seconds to enforce for each task:  the value
+    of LCATR_TASK_WALLTIME, if set, otherwise the walltime argument.
+    None is returned if the value is None or not positive, meaning that
+    no limit is enforced.
+    """
+    walltime = os.environ.get('LCATR_TASK_WALLTIME', walltime)
+    if walltime is None or float(walltime) <= 0:
+        return None
+    return float(walltime)
+
+
+@contextlib.contextmanager
+def deadline(walltime):
+    """
+    Context manager that raises TaskTimeoutError in the enclosed code
+    if it runs longer than walltime seconds.  This uses SIGALRM, so it
+    only has an effect in the main thread, and it can't interrupt a
+    blocking system call until that call returns.
+    """
+    if (walltime is None or
+            threading.current_thread() is not threading.main_thread()):
+        yield
+        return
+    def handler(signum, frame):
+        raise TaskTimeoutError(f'Task exceeded walltime of {walltime} s')
+    old_handler = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, walltime)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old_handler)
+
+
+def run_with_deadline(func, *args, walltime=None, **kwargs):
+    """
+    Run a function in a forked child process and return its result,
+    killing the child if it runs longer than walltime seconds.  The
+    result and any exception raised by the function must be
+    pickleable.  If walltime is None, then the function is run in the
+    current process.
+
+    Raises
+    ------
+    TaskTimeoutError: If the walltime is exceeded.
+    """
+    if walltime is None or not hasattr(os, 'fork'):
+        return func(*args, **kwargs)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            try:
+                payload = ('result', func(*args, **kwargs))
+            except BaseException as eobj:
+                traceback.print_exc()
+                payload = ('error', eobj)
+            try:
+                data = pickle.dumps(payload)
+            except Exception:
+                data = pickle.dumps(('error', RuntimeError(repr(payload[1]))))
+            with os.fdopen(write_fd, 'wb') as output:
+                output.write(data)
+        except BaseException:
+            status = 1
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    chunks = []
+    stop_time = time.time() + walltime
+    with os.fdopen(read_fd, 'rb') as fd:
+        while True:
+            remaining = stop_time - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                raise TaskTimeoutError(
+                    f'Task exceeded walltime of {walltime} s')
+            chunk = os.read(fd.fileno(), 1024**2)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    _, status = os.waitpid(pid, 0)
+    if not chunks:
+        raise RuntimeError(f'Task process exited with status {status} '
+                           'without returning a result')
+    kind, value = pickle.loads(b''.join(chunks))
+    if kind == 'error':
+        raise value
+    return value
+
+
+class WorkerWatchdog:
+    """
+    Class to kill pool worker processes that have spent longer than
+    the walltime on a device.  The workers record the device they are
+    working on and its start time, keyed by their pid, in a shared
+    dict, e.g., a multiprocessing.Manager().dict().
+    """
+    def __init__(self, running_tasks, walltime):
+        """
+        Parameters
+        ----------
+        running_tasks: dict-like
+            Mapping of worker pid to (device name, start time).
+        walltime: float
+            Maximum time in seconds for a device.
+        """
+        self.running_tasks = running_tasks
+        self.walltime = walltime
+        self.killed = []
+
+    def check(self):
+        """
+        Kill the workers whose device has exceeded the walltime.
+
+        Returns
+        -------
+        list: The names of the devices whose workers were killed.
+        """
+        logger = logging.getLogger('WorkerWatchdog.check')
+        logger.setLevel(logging.INFO)
+        now = time.time()
+        killed = []
+        for pid, (device_name, start_time) in list(self.running_tasks.items()):
+            if now - start_time <= self.walltime:
+                continue
+            logger.info('Killing worker %d: %s exceeded walltime of %s s',
+                        pid, device_name, self.walltime)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.running_tasks.pop(pid, None)
+            killed.append(device_name)
+        self.killed.extend(killed)
+        return killed
+
+
+def dead_workers(running_tasks):
+    """
+    Find the pool workers of the current process that died while
+    running a task, e.g., from a segfault or the OOM killer, in which
+    case multiprocessing.Pool drops the task without calling its
+    callbacks.  Their entries are removed from running_tasks.
+
+    Parameters
+    ----------
+    running_tasks: dict-like
+        Mapping of worker pid to (task name, start time), as for
+        WorkerWatchdog.
+
+    Returns
+    -------
+    list: (pid, task name) for each dead worker.
+    """
+    # active_children() also reaps the workers that have exited.
+    alive = {_.pid for _ in multiprocessing.active_children()}
+    dead = []
+    for pid, (name, _) in list(running_tasks.items()):
+        if pid not in alive:
+            running_tasks.pop(pid, None)
+            dead.append((pid, name))
+    return dead
@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 import lsst.eotest.sensor as sensorTest
 import lsst.eotest.image_utils as imutils
 import siteUtils
+from amp_tasks import map_amps
 
 __all__ = ['tearing_detection', 'persist_tearing_png_files']
 
@@ -40,8 +41,9 @@ def tearing_detection(fitsfiles, num_png_files=1, bias_frame=None):
     png_files = []
     for filename in fitsfiles:
         ts = sensorTest.TearingStats(filename, bias_frame=bias_frame)
-        for amp in amp_counts:
-            amp_counts[amp] = max(ts.amp_tearing_count(amp), amp_counts[amp])
+        counts = map_amps(ts.amp_tearing_count, amp_counts)
+        for amp, count in counts.items():
+            amp_counts[amp] = max(count, amp_counts[amp])
         if ts.has_tearing():
             files_with_tearing.append(filename)
             if len(png_files) < num_png_files:
@@ -0,0 +1,435 @@
+"""
+Node-resident daemon that runs task scripts in forked copies of a
+process that has already imported the LSST stack and the analysis
+modules, so that each task avoids paying the import costs.
+
+The daemon listens on a unix socket local to the node.  A client
+sends a json request with the script, its arguments, the working
+directory and the LCATR_* environment, along with its stdout and
+stderr file descriptors, and the forked worker runs the script with
+its output going to those descriptors.  On completion, the worker
+appends the usual "Task succeeded/failed on <host>" trailer and, if
+requested, writes the json status file used by the ssh dispatcher,
+including the task's peak memory in GB.
+
+Command-line usage:
+
+    python warm_worker.py start
+        Start the daemon in the background unless it is running.
+    python warm_worker.py serve
+        Run the daemon in the foreground.
+    python warm_worker.py submit [--wait] [--status-file FILE] \\
+        script task_id [args ...]
+        Run a task script with the daemon.  This exits with code 75
+        if the daemon is unavailable or declines the request, so that
+        the caller can fall back to running the script directly.
+"""
+import os
+import sys
+import json
+import time
+import array
+import fcntl
+import runpy
+import socket
+import logging
+import argparse
+import importlib
+import traceback
+import socketserver
+from memory_admission import reset_peak_rss, peak_rss
+
+__all__ = ['WarmWorkerServer', 'socket_path', 'submit', 'start_daemon',
+           'DEFAULT_PRELOAD_MODULES', 'UNAVAILABLE']
+
+logging.basicConfig(format='%(asctime)s %(name)s: %(message)s')
+
+DEFAULT_PRELOAD_MODULES = ('lsst.afw.image', 'lsst.eotest.sensor',
+                           'matplotlib.pyplot', 'pandas', 'bot_eo_analyses')
+
+# Exit code of the submit command if the daemon can't run the task
+# (EX_TEMPFAIL from sysexits.h).
+UNAVAILABLE = 75
+
+MAX_REQUEST_SIZE = 1024**2
+
+
+def socket_path():
+    """
+    The path to the daemon's socket.  This is set by the
+    LCATR_WARM_WORKER_SOCKET environment variable, if set, otherwise
+    a per-user path in /tmp is used.
+    """
+    return os.environ.get('LCATR_WARM_WORKER_SOCKET',
+                          f'/tmp/lcatr_warm_worker_{os.getuid()}.sock')
+
+
+def _send_json(sock, data, fds=()):
+    message = (json.dumps(data) + '\n').encode()
+    if fds:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                    array.array('i', fds))]
+        sent = sock.sendmsg([message], ancdata)
+        message = message[sent:]
+    sock.sendall(message)
+
+
+def _recv_json(sock, maxfds=0):
+    """Read a newline-terminated json message and any passed fds."""
+    fds = array.array('i')
+    data = b''
+    if maxfds:
+        data, ancdata, _, _ \
+            = sock.recvmsg(65536, socket.CMSG_LEN(maxfds*fds.itemsize))
+        for level, kind, cmsg_data in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg_data[:len(cmsg_data)
+                                        - len(cmsg_data) % fds.itemsize])
+    while not data.endswith(b'\n'):
+        chunk = sock.recv(65536)
+        if not chunk or len(data) > MAX_REQUEST_SIZE:
+            raise ConnectionError('incomplete message')
+        data += chunk
+    return json.loads(data.decode()), list(fds)
+
+
+def _write_status_file(status_file, task_id, status, returncode,
+                       peak_memory):
+    tmp_file = status_file + '.tmp'
+    with open(tmp_file, 'w') as fd:
+        json.dump(dict(task_id=task_id, status=status,
+                       host=socket.gethostname(), returncode=returncode,
+                       peak_memory=peak_memory), fd)
+    os.replace(tmp_file, status_file)
+
+
+def _exit_code(eobj):
+    if eobj.code is None:
+        return 0
+    if isinstance(eobj.code, int):
+        return eobj.code
+    print(eobj.code, file=sys.stderr)
+    return 1
+
+
+class _TaskHandler(socketserver.BaseRequestHandler):
+    """
+    Handle a task request in a forked copy of the daemon.
+    """
+    def handle(self):
+        try:
+            request, fds = _recv_json(self.request, maxfds=2)
+        except ConnectionError:
+            # A connection without a request, e.g., from _is_running.
+            return
+        reason = self.server.check_request(request)
+        if reason is not None or len(fds) != 2:
+            _send_json(self.request, dict(accepted=False,
+                                          reason=reason or 'missing fds'))
+            return
+        _send_json(self.request, dict(accepted=True, pid=os.getpid()))
+        returncode = self.run_task(request, fds)
+        try:
+            _send_json(self.request, dict(returncode=returncode))
+        except OSError:
+            # The client did not wait for the result.
+            pass
+
+    @staticmethod
+    def run_task(request, fds):
+        """Run the task script in this process."""
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(fds[0], 1)
+        os.dup2(fds[1], 2)
+        for fd in fds:
+            os.close(fd)
+        script = request['script']
+        args = [str(_) for _ in request.get('args', [])]
+        try:
+            os.chdir(request.get('cwd') or '.')
+            os.environ.update(request.get('env', {}))
+            os.nice(request.get('niceness', 0))
+            sys.argv = [script] + args
+            sys.path[0] = os.path.dirname(os.path.abspath(script))
+            print(flush=True)
+            reset_peak_rss()
+            runpy.run_path(script, run_name='__main__')
+            returncode = 0
+        except SystemExit as eobj:
+            returncode = _exit_code(eobj)
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        status = 'succeeded' if returncode == 0 else 'failed'
+        print(f'Task {status} on {socket.gethostname()}', flush=True)
+        sys.stderr.flush()
+        status_file = request.get('status_file')
+        if status_file is not None:
+            task_id = request.get('task_id', args[0] if args else script)
+            _write_status_file(status_file, task_id, status, returncode,
+                               peak_rss())
+        return returncode
+
+
+class WarmWorkerServer(socketserver.ForkingMixIn,
+                       socketserver.UnixStreamServer):
+    """
+    Unix socket server that imports the analysis modules once and
+    forks a worker for each task request.  The server exits after
+    `idle_timeout` seconds without requests, or once it has no running
+    workers after any of the preloaded modules has changed on disk.
+    """
+    def __init__(self, path=None, preload_modules=DEFAULT_PRELOAD_MODULES,
+                 max_children=40, idle_timeout=3600):
+        """
+        Parameters
+        ----------
+        path: str [None]
+            Path to the unix socket.  If None, then use socket_path().
+        preload_modules: tuple [DEFAULT_PRELOAD_MODULES]
+            Modules to import before serving requests.
+        max_children: int [40]
+            Maximum number of concurrent workers.  Further requests
+            wait until a worker finishes.
+        idle_timeout: float [3600]
+            Time in seconds without requests after which the server
+            exits.
+        """
+        logger = logging.getLogger('WarmWorkerServer')
+        logger.setLevel(logging.INFO)
+        self.module_mtimes = dict()
+        for module_name in preload_modules:
+            try:
+                module = importlib.import_module(module_name)
+            except Exception as eobj:
+                logger.info('Unable to preload %s: %s', module_name, eobj)
+                continue
+            module_file = getattr(module, '__file__', None)
+            if module_file is not None:
+                self.module_mtimes[module_file] = os.path.getmtime(module_file)
+        self.code_dir = os.environ.get('EOANALYSISJOBSDIR')
+        self.max_children = max_children
+        self.idle_timeout = idle_timeout
+        self.timeout = min(10, idle_timeout)
+        self.last_request = time.time()
+        self.stale = False
+        self.path = socket_path() if path is None else path
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        super().__init__(self.path, _TaskHandler)
+        os.chmod(self.path, 0o600)
+        self.inode = os.stat(self.path).st_ino
+
+    def check_request(self, request):
+        """
+        Return the reason a request can't be run by this server, or
+        None if it can.
+        """
+        env = request.get('env', {})
+        code_dir = env.get('EOANALYSISJOBSDIR', self.code_dir)
+        if code_dir != self.code_dir:
+            return f'server uses EOANALYSISJOBSDIR={self.code_dir}'
+        if self.stale:
+            return 'preloaded modules have changed'
+        return None
+
+    def verify_request(self, request, client_address):
+        self.last_request = time.time()
+        for module_file, mtime in self.module_mtimes.items():
+            try:
+                if os.path.getmtime(module_file) != mtime:
+                    self.stale = True
+            except OSError:
+                self.stale = True
+        return True
+
+    def serve_until_idle(self):
+        """Handle requests until the server is idle or stale."""
+        while True:
+            self.handle_request()
+            if self.active_children:
+                continue
+            if self.stale or time.time() - self.last_request \
+               > self.idle_timeout:
+                break
+
+    def server_close(self):
+        super().server_close()
+        # Only remove the socket file if it hasn't been replaced by
+        # another server.
+        try:
+            if os.stat(self.path).st_ino == self.inode:
+                os.remove(self.path)
+        except OSError:
+            pass
+
+
+def submit(script, args=(), cwd=None, env=None, status_file=None,
+           task_id=None, niceness=0, wait=False, path=None, fds=None):
+    """
+    Run a task script with the warm worker daemon.
+
+    Parameters
+    ----------
+    script: str
+        Path to the task script.
+    args: list [()]
+        Command line arguments for the script.
+    cwd: str [None]
+        Working directory for the task.  If None, then use the current
+        directory.
+    env: dict [None]
+        Environment variables to set for the task.  If None, then use
+        the LCATR_* variables and EOANALYSISJOBSDIR of this process.
+    status_file: str [None]
+        json file to write the task status to on completion.
+    task_id: str [None]
+        Task id for the status file.  If None, then use the first
+        script argument.
+    niceness: int [0]
+        Niceness increment for the task.
+    wait: bool [False]
+        If True, then wait for the task to finish.
+    path: str [None]
+        Path to the daemon's socket.  If None, then use socket_path().
+    fds: tuple [None]
+        File descriptors for the task's stdout and stderr.  If None,
+        then use those of this process.
+
+    Returns
+    -------
+    dict: The daemon's response, with the `returncode` if wait is True.
+
+    Raises
+    ------
+    OSError: If the daemon is not running.
+    """
+    if env is None:
+        env = {key: value for key, value in os.environ.items()
+               if key.startswith('LCATR_') or key == 'EOANALYSISJOBSDIR'}
+    request = dict(script=os.path.abspath(script), args=list(args),
+                   cwd=os.path.abspath(cwd or '.'), env=env,
+                   status_file=status_file, niceness=niceness)
+    if task_id is not None:
+        request['task_id'] = task_id
+    if fds is None:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        fds = (sys.stdout.fileno(), sys.stderr.fileno())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path() if path is None else path)
+        _send_json(sock, request, fds=fds)
+        response, _ = _recv_json(sock)
+        if response.get('accepted') and wait:
+            try:
+                result, _ = _recv_json(sock)
+            except ConnectionError:
+                result = dict(returncode=1)
+            response.update(result)
+    return response
+
+
+def _is_running(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def start_daemon(path=None, timeout=300, **server_kwds):
+    """
+    Start the daemon in the background unless one is already running,
+    and wait until it is accepting requests.
+
+    Returns
+    -------
+    bool: True if the daemon is running.
+    """
+    path = socket_path() if path is None else path
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if _is_running(path):
+            return True
+        read_fd, write_fd = os.pipe()
+        if os.fork() > 0:
+            os.close(write_fd)
+            with os.fdopen(read_fd, 'rb') as ready:
+                return ready.read(1) == b'1'
+        # In the daemon process:  detach from the session, the lock,
+        # and the caller's stdin and stdout.
+        lock.close()
+        os.close(read_fd)
+        os.setsid()
+        log_file = os.path.splitext(path)[0] + '.log'
+        with open(os.devnull) as devnull, open(log_file, 'a') as log:
+            os.dup2(devnull.fileno(), 0)
+            os.dup2(log.fileno(), 1)
+            os.dup2(log.fileno(), 2)
+        status = 0
+        try:
+            server = WarmWorkerServer(path=path, **server_kwds)
+            os.write(write_fd, b'1')
+            os.close(write_fd)
+            with server:
+                server.serve_until_idle()
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+
+
+def main(argv=None):
+    """Command-line interface."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for command in ('start', 'serve'):
+        subparser = subparsers.add_parser(command)
+        subparser.add_argument('--max-children', type=int, default=40)
+        subparser.add_argument('--idle-timeout', type=float, default=3600)
+        subparser.add_argument('--preload', default=None,
+                               help='comma-separated modules to preload')
+    subparser = subparsers.add_parser('submit')
+    subparser.add_argument('--wait', action='store_true')
+    subparser.add_argument('--status-file', default=None)
+    subparser.add_argument('--niceness', type=int, default=0)
+    subparser.add_argument('--pid-file', default=None,
+                           help='file to write the task process id to')
+    subparser.add_argument('script')
+    subparser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args(argv)
+
+    if args.command == 'submit':
+        try:
+            response = submit(args.script, args.args,
+                              status_file=args.status_file,
+                              niceness=args.niceness, wait=args.wait)
+        except OSError as eobj:
+            print('warm_worker: daemon unavailable:', eobj, file=sys.stderr)
+            return UNAVAILABLE
+        if not response['accepted']:
+            print('warm_worker: request declined:', response['reason'],
+                  file=sys.stderr)
+            return UNAVAILABLE
+        if args.pid_file is not None and not args.wait:
+            with open(args.pid_file, 'w') as output:
+                output.write(f"{response['pid']}\n")
+        return response.get('returncode', 0)
+
+    server_kwds = dict(max_children=args.max_children,
+                       idle_timeout=args.idle_timeout)
+    if args.preload is not None:
+        server_kwds['preload_modules'] = [_ for _ in args.preload.split(',')
+                                          if _]
+    if args.command == 'start':
+        return 0 if start_daemon(**server_kwds) else 1
+    with WarmWorkerServer(**server_kwds) as server:
+        server.serve_until_idle()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
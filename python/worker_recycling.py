@@ -0,0 +1,125 @@
+"""
+Recycling of long-lived pool workers, after a number of tasks or when
+their resident memory grows too large, and a report of the memory
+growth of the workers by task.
+"""
+import os
+import json
+
+__all__ = ['worker_max_tasks', 'worker_max_rss', 'current_rss',
+           'WorkerMemoryReport']
+
+
+def worker_max_tasks(max_tasks=None):
+    """
+    Number of tasks each pool worker runs before it is replaced:  the
+    value of LCATR_WORKER_MAX_TASKS, if set, otherwise max_tasks.  None
+    or a value <= 0 means the workers are not replaced.
+    """
+    max_tasks = os.environ.get('LCATR_WORKER_MAX_TASKS', max_tasks)
+    if max_tasks is None or int(max_tasks) <= 0:
+        return None
+    return int(max_tasks)
+
+
+def worker_max_rss(max_rss=None):
+    """
+    Resident memory in GB of a pool worker, measured between tasks,
+    above which the workers are replaced:  the value of
+    LCATR_WORKER_MAX_RSS_GB, if set, otherwise max_rss.  None or a
+    value <= 0 means no limit.
+    """
+    max_rss = os.environ.get('LCATR_WORKER_MAX_RSS_GB', max_rss)
+    if max_rss is None or float(max_rss) <= 0:
+        return None
+    return float(max_rss)
+
+
+def current_rss():
+    """
+    Current resident memory in GB of this process, or None if it
+    can't be determined.
+    """
+    try:
+        with open('/proc/self/status') as fd:
+            for line in fd:
+                if line.startswith('VmRSS:'):
+                    return float(line.split()[1])/1024**2
+    except OSError:
+        pass
+    return None
+
+
+class WorkerMemoryReport:
+    """
+    Class to collect the growth in the resident memory of the pool
+    workers over each device-level task, i.e., the memory each task
+    leaves behind after the worker has cleaned up, and to write a
+    summary by task, including the device with the largest growth, to
+    a json file.  The summaries from earlier calls, e.g., for other
+    jh_tasks of the same job, are kept in the file.
+    """
+    def __init__(self, report_file=None):
+        """
+        Parameters
+        ----------
+        report_file: str [None]
+            json file for the summary.  If None, then the
+            LCATR_WORKER_MEMORY_REPORT environment variable is used,
+            if set, otherwise worker_memory_report.json in the current
+            directory.
+        """
+        if report_file is None:
+            report_file = os.environ.get('LCATR_WORKER_MEMORY_REPORT',
+                                         'worker_memory_report.json')
+        self.report_file = report_file
+        self.entries = dict()
+        self.recycles = dict()
+
+    def record(self, task, device_name, pid, rss_before, rss_after):
+        """
+        Record the resident memory in GB of the worker before and after
+        running the task for a device.
+        """
+        if rss_before is None or rss_after is None:
+            return
+        self.entries.setdefault(task, []).append(
+            dict(device_name=device_name, pid=pid, rss_before=rss_before,
+                 rss_after=rss_after, growth=rss_after - rss_before))
+
+    def recycled(self, task):
+        """Count a replacement of the workers while running the task."""
+        self.recycles[task] = self.recycles.get(task, 0) + 1
+
+    def summary(self, task):
+        """
+        Return a dict with the number of devices, the total and largest
+        memory growth in GB, the device with the largest growth, the
+        largest worker resident memory, and the number of times the
+        workers were replaced.
+        """
+        entries = self.entries.get(task, [])
+        if not entries:
+            return dict(devices=0, recycles=self.recycles.get(task, 0))
+        worst = max(entries, key=lambda _: _['growth'])
+        return dict(devices=len(entries),
+                    total_growth=sum(_['growth'] for _ in entries),
+                    max_growth=worst['growth'],
+                    max_growth_device=worst['device_name'],
+                    max_rss=max(_['rss_after'] for _ in entries),
+                    recycles=self.recycles.get(task, 0))
+
+    def save(self):
+        """Write the summaries to the report file."""
+        tasks = set(self.entries).union(self.recycles)
+        if not tasks:
+            return
+        try:
+            with open(self.report_file) as fd:
+                report = json.load(fd)
+        except (OSError, ValueError):
+            report = dict()
+        for task in tasks:
+            report[task] = self.summary(task)
+        with open(self.report_file, 'w') as output:
+            json.dump(report, output, indent=2)
@@ -0,0 +1,124 @@
+"""
+Unit tests for the amp_tasks module.
+"""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from amp_tasks import split_work_item, amp_work_items, amp_split_enabled, \
+    partial_result_file, write_partial_result, gather_amp_results, \
+    make_once, amp_thread_budget, amp_thread_env, amp_threads, map_amps
+
+
+class AmpTasksTestCase(unittest.TestCase):
+    """TestCase class for the amp_tasks module."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_AMP_SPLIT', 'LCATR_AMP_THREADS')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_work_items(self):
+        """Test the expansion of devices into amp-level work items."""
+        items = amp_work_items(['R22_S11', 'R00_SW0', 'R10'])
+        self.assertEqual(len(items), 16 + 8 + 1)
+        self.assertEqual(items[0], 'R22_S11:1')
+        self.assertEqual(items[-2], 'R00_SW0:8')
+        self.assertEqual(items[-1], 'R10')
+        self.assertEqual(split_work_item('R22_S11:3'), ('R22_S11', 3))
+        self.assertEqual(split_work_item('R22_S11'), ('R22_S11', None))
+
+        self.assertFalse(amp_split_enabled('bias_frame_jh_task'))
+        os.environ['LCATR_AMP_SPLIT'] = 'True'
+        self.assertTrue(amp_split_enabled('bias_frame_jh_task'))
+        self.assertFalse(amp_split_enabled('read_noise_jh_task'))
+
+    def test_gather(self):
+        """Test gathering partial results and computing missing ones."""
+        prefix = os.path.join(self.tmpdir, 'R22_S11_6801D_000001')
+        for amp in (1, 2):
+            write_partial_result(prefix, 'bias_stability', amp, amp**2)
+        computed = []
+        def compute(amps):
+            computed.extend(amps)
+            return {amp: amp**2 for amp in amps}
+        results = gather_amp_results(prefix, 'bias_stability', [1, 2, 3],
+                                     compute)
+        self.assertEqual(results, {1: 1, 2: 4, 3: 9})
+        self.assertEqual(computed, [3])
+        for amp in (1, 2):
+            self.assertFalse(os.path.isfile(
+                partial_result_file(prefix, 'bias_stability', amp)))
+
+    def test_make_once(self):
+        """Test that make_once skips existing output files."""
+        outfile = os.path.join(self.tmpdir, 'superbias.fits')
+        calls = []
+        def make(value):
+            calls.append(value)
+            with open(outfile, 'w') as output:
+                output.write(value)
+        for _ in range(2):
+            self.assertEqual(make_once(outfile, make, 'x'), outfile)
+        self.assertEqual(calls, ['x'])
+
+    def test_make_once_inputs(self):
+        """Test that make_once remakes files with changed inputs."""
+        outfile = os.path.join(self.tmpdir, 'superbias.fits')
+        infile = os.path.join(self.tmpdir, 'bias_000.fits')
+        with open(infile, 'w') as output:
+            output.write('bias')
+        calls = []
+        def make(value):
+            calls.append(value)
+            with open(outfile, 'w') as output:
+                output.write(value)
+        # A file made without the inputs is made again.
+        make_once(outfile, make, 'x')
+        for value in ('y', 'z'):
+            make_once(outfile, make, value, input_files=[infile])
+        self.assertEqual(calls, ['x', 'y'])
+        with open(infile, 'a') as output:
+            output.write(' rerun')
+        make_once(outfile, make, 'w', input_files=[infile])
+        self.assertEqual(calls, ['x', 'y', 'w'])
+
+    def test_thread_budget(self):
+        """Test the number of amp threads per task."""
+        self.assertEqual(amp_thread_budget(9, cores=64), 7)
+        self.assertEqual(amp_thread_budget(63, num_tasks=9, cores=64), 7)
+        self.assertEqual(amp_thread_budget(100, cores=64), 1)
+        self.assertEqual(amp_threads(), 1)
+        with amp_thread_env(4):
+            self.assertEqual(amp_threads(), 4)
+            self.assertEqual(amp_thread_budget(9, cores=64), 4)
+        self.assertNotIn('LCATR_AMP_THREADS', os.environ)
+
+    def test_map_amps(self):
+        """Test processing the amps on a thread pool."""
+        thread_ids = set()
+        def func(amp):
+            thread_ids.add(threading.get_ident())
+            time.sleep(0.1)
+            return -amp
+        amps = list(range(1, 17))
+        t0 = time.time()
+        results = map_amps(func, amps, threads=16)
+        self.assertLess(time.time() - t0, 1)
+        self.assertEqual(list(results.items()), [(_, -_) for _ in amps])
+        self.assertGreater(len(thread_ids), 1)
+        thread_ids.clear()
+        self.assertEqual(map_amps(func, [1, 2]), {1: -1, 2: -2})
+        self.assertEqual(thread_ids, {threading.get_ident()})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+"""
+Unit tests for the bandwidth_coordinator module.
+"""
+import os
+import time
+import threading
+import unittest
+from bandwidth_coordinator import staging_limits, start_coordinator, \
+    BandwidthClient
+
+
+class BandwidthCoordinatorTestCase(unittest.TestCase):
+    """TestCase class for the bandwidth_coordinator module."""
+    def setUp(self):
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_STAGING_MAX_RATE',
+                     'LCATR_STAGING_MAX_OPEN_FILES')}
+        self.coordinator = None
+
+    def tearDown(self):
+        if self.coordinator is not None:
+            self.coordinator.shutdown()
+            self.coordinator.server_close()
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_staging_limits(self):
+        """Test the site limits."""
+        self.assertEqual(staging_limits(), (None, None))
+        os.environ['LCATR_STAGING_MAX_RATE'] = '500'
+        os.environ['LCATR_STAGING_MAX_OPEN_FILES'] = '16'
+        self.assertEqual(staging_limits(), (500*1024**2, 16))
+
+    def test_priority(self):
+        """Test that waiting transfers are granted in priority order."""
+        self.coordinator = start_coordinator(max_open_files=1)
+        client = BandwidthClient(self.coordinator.address, host='dc01')
+        order = []
+        holding = threading.Event()
+        release = threading.Event()
+
+        def first():
+            with client.transfer(100, priority=0):
+                holding.set()
+                release.wait()
+
+        def transfer(priority):
+            with client.transfer(100, priority=priority):
+                order.append(priority)
+
+        threads = [threading.Thread(target=first)]
+        threads[0].start()
+        holding.wait()
+        for priority in (5, 2, 9, 1):
+            threads.append(threading.Thread(target=transfer,
+                                            args=(priority,)))
+            threads[-1].start()
+        # Wait for the transfers to queue up behind the first one.
+        while len(self.coordinator.waiting) < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(order, [1, 2, 5, 9])
+        report = self.coordinator.report()
+        self.assertEqual(report['dc01']['files'], 5)
+        self.assertEqual(report['dc01']['bytes'], 500)
+
+    def test_rate(self):
+        """Test the cap on the total read rate."""
+        self.coordinator = start_coordinator(max_rate=1000)
+        client = BandwidthClient(self.coordinator.address)
+        t0 = time.time()
+        with client.transfer(1500) as consume:
+            for _ in range(3):
+                consume(500)
+        client.close()
+        # The first 1000 bytes are an allowed burst.
+        self.assertGreater(time.time() - t0, 0.4)
+        # The time for the rate limited blocks is in the report.
+        self.assertGreater(self.coordinator.report()[client.host]['waited'],
+                           0.4)
+
+    def test_global_priority(self):
+        """Test that blocks are granted in priority order over hosts."""
+        self.coordinator = start_coordinator(max_rate=1000)
+        clients = {host: BandwidthClient(self.coordinator.address, host=host)
+                   for host in ('dc01', 'dc02')}
+        order = []
+        # Empty the bucket so that the blocks queue up.
+        with clients['dc01'].transfer(1000) as consume:
+            consume(1000)
+
+        def transfer(host, priority):
+            with clients[host].transfer(100, priority=priority) as consume:
+                consume(100)
+                order.append((host, priority))
+
+        threads = [threading.Thread(target=transfer, args=_) for _ in
+                   (('dc01', 3), ('dc02', 2), ('dc01', 1), ('dc02', 0))]
+        for thread in threads:
+            thread.start()
+            # Start the transfers in order so that their arrival order
+            # differs from their priority order.
+            time.sleep(0.02)
+        for thread in threads:
+            thread.join()
+        for client in clients.values():
+            client.close()
+        self.assertEqual(order, [('dc02', 0), ('dc01', 1), ('dc02', 2),
+                                 ('dc01', 3)])
+
+    def test_unavailable(self):
+        """Test that transfers proceed if there is no coordinator."""
+        client = BandwidthClient('localhost:1', timeout=1)
+        with client.transfer(100):
+            pass
+        self.assertFalse(client.available)
+
+
+if __name__ == '__main__':
+    unittest.main()
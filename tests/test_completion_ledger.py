@@ -0,0 +1,98 @@
+"""
+Unit tests for the completion_ledger module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from completion_ledger import CompletionLedger
+
+
+class CompletionLedgerTestCase(unittest.TestCase):
+    """TestCase class for CompletionLedger."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ledger_file = os.path.join(self.tmpdir, 'jh_task_ledger.json')
+        self.devices = ['R22_S00', 'R22_S01', 'R22_S02']
+        self.files = dict()
+        for device in self.devices:
+            self.files[device] = os.path.join(self.tmpdir, f'{device}.fits')
+            with open(self.files[device], 'w') as output:
+                output.write(device)
+        self.version = 'v1'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def ledger(self):
+        """Create a ledger using the test files and code version."""
+        return CompletionLedger(self.ledger_file,
+                                input_files=lambda _: [self.files[_]],
+                                code_version_func=lambda _: self.version)
+
+    def test_pending(self):
+        """Test which devices are dispatched on a rerun."""
+        ledger = self.ledger()
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         self.devices)
+        ledger.record('ptc', None, 'R22_S00', True)
+        ledger.record('ptc', None, 'R22_S01', False)
+        ledger.save()
+
+        # Missing and failed devices are rerun.
+        ledger = self.ledger()
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         ['R22_S01', 'R22_S02'])
+        self.assertEqual(ledger.pending('fe55', None, self.devices),
+                         self.devices)
+
+        # Changed input files make an entry stale.
+        with open(self.files['R22_S00'], 'a') as output:
+            output.write('more data')
+        ledger = self.ledger()
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         self.devices)
+
+    def test_code_version(self):
+        """Test that a new code version makes all entries stale."""
+        ledger = self.ledger()
+        for device in self.devices:
+            ledger.record('ptc', None, device, True)
+        ledger.save()
+        self.assertEqual(self.ledger().pending('ptc', None, self.devices), [])
+        self.version = 'v2'
+        self.assertEqual(self.ledger().pending('ptc', None, self.devices),
+                         self.devices)
+
+    def test_fingerprinted_devices(self):
+        """Test that only succeeded devices are fingerprinted."""
+        queried = []
+
+        def input_files(device):
+            queried.append(device)
+            return [self.files[device]]
+        ledger = CompletionLedger(self.ledger_file, input_files=input_files,
+                                  code_version_func=lambda _: self.version)
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         self.devices)
+        self.assertEqual(queried, [])
+        ledger.record('ptc', None, 'R22_S00', True)
+        ledger.record('ptc', None, 'R22_S01', False)
+        del queried[:]
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         ['R22_S01', 'R22_S02'])
+        self.assertEqual(queried, ['R22_S00'])
+
+    def test_unknown_inputs(self):
+        """Test that devices with unknown inputs are always rerun."""
+        def input_files(device):
+            raise RuntimeError('eT db query failed')
+        ledger = CompletionLedger(self.ledger_file, input_files=input_files,
+                                  code_version_func=lambda _: self.version)
+        ledger.record('ptc', None, 'R22_S00', True)
+        self.assertEqual(ledger.pending('ptc', None, self.devices),
+                         self.devices)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""
+Unit tests for the copy_engine module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+import contextlib
+from copy_engine import copy_threads, is_current, copy_file, CopyEngine
+
+
+class CopyEngineTestCase(unittest.TestCase):
+    """TestCase class for the copy_engine module."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_COPY_THREADS', 'LCATR_COPY_CHECKSUM')}
+        self.src_dir = os.path.join(self.tmpdir, 'src')
+        self.dest_dir = os.path.join(self.tmpdir, 'dest')
+        os.makedirs(self.src_dir)
+        self.files = dict()
+        for i in range(10):
+            src = os.path.join(self.src_dir, f'frame{i:02d}.fits')
+            with open(src, 'wb') as output:
+                output.write(os.urandom(1000*(i + 1)))
+            self.files[src] = os.path.join(self.dest_dir, f'frame{i:02d}',
+                                           os.path.basename(src))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_copy_threads(self):
+        """Test the number of copy threads."""
+        self.assertEqual(copy_threads(), 8)
+        os.environ['LCATR_COPY_THREADS'] = '3'
+        self.assertEqual(copy_threads(), 3)
+
+    def test_copy(self):
+        """Test copying files with the thread pool."""
+        engine = CopyEngine(threads=4, checksum=True)
+        copied = engine.copy(self.files)
+        self.assertEqual(sum(copied.values()), 55000)
+        for src, dest in self.files.items():
+            self.assertTrue(is_current(src, dest, checksum=True))
+            self.assertFalse(os.path.isfile(dest + '.part'))
+        # Current copies are not redone.
+        self.assertEqual(sum(engine.copy(self.files).values()), 0)
+
+    def test_resume(self):
+        """Test resuming an interrupted copy from its .part file."""
+        src, dest = next(iter(self.files.items()))
+        os.makedirs(os.path.dirname(dest))
+        with open(src, 'rb') as fd, open(dest + '.part', 'wb') as output:
+            output.write(fd.read(400))
+        self.assertEqual(copy_file(src, dest), 600)
+        self.assertTrue(is_current(src, dest, checksum=True))
+
+        # A stale copy, e.g., of an older version of the file, is
+        # replaced.
+        with open(dest, 'wb') as output:
+            output.write(b'x'*1000)
+        self.assertFalse(is_current(src, dest))
+        self.assertEqual(copy_file(src, dest), 1000)
+        self.assertTrue(is_current(src, dest, checksum=True))
+
+    def test_throttle(self):
+        """Test that throttled copies are made block by block."""
+        src = os.path.join(self.src_dir, 'big.fits')
+        with open(src, 'wb') as output:
+            output.write(os.urandom(20*1024**2))
+        transfers = []
+
+        class Throttle:
+            @contextlib.contextmanager
+            def transfer(self, nbytes, priority=0):
+                blocks = []
+                transfers.append((nbytes, priority, blocks))
+                yield blocks.append
+
+        dest = os.path.join(self.dest_dir, 'big.fits')
+        CopyEngine(throttle=Throttle()).copy({src: dest}, priority=3)
+        self.assertTrue(is_current(src, dest, checksum=True))
+        self.assertEqual(transfers, [(20*1024**2, 3, [8*1024**2, 8*1024**2,
+                                                      4*1024**2])])
+
+    def test_errors(self):
+        """Test that errors are raised after the other copies finish."""
+        files = dict(self.files)
+        files[os.path.join(self.src_dir, 'missing.fits')] \
+            = os.path.join(self.dest_dir, 'missing.fits')
+        with self.assertRaises(OSError):
+            CopyEngine(threads=2).copy(files)
+        for src, dest in self.files.items():
+            self.assertTrue(is_current(src, dest))
+
+
+if __name__ == '__main__':
+    unittest.main()
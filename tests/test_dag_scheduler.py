@@ -0,0 +1,146 @@
+"""
+Unit tests for the dag_scheduler module.
+"""
+import os
+import signal
+import shutil
+import tempfile
+import unittest
+from dag_scheduler import DeviceTaskGraph, devices_overlap
+
+
+def _log(outdir, task_name, device_name):
+    with open(os.path.join(outdir, 'log.txt'), 'a') as output:
+        output.write(f'{task_name} {device_name}\n')
+
+
+class _Task:
+    """Pickleable task that appends its name and device to a log file."""
+    def __init__(self, outdir, name, fail_on=(), die_on=()):
+        self.outdir = outdir
+        self.name = name
+        self.fail_on = fail_on
+        self.die_on = die_on
+
+    def __call__(self, device_name):
+        if device_name in self.die_on:
+            os.kill(os.getpid(), signal.SIGKILL)
+        if device_name in self.fail_on:
+            raise RuntimeError(f'{self.name} failed for {device_name}')
+        _log(self.outdir, self.name, device_name)
+
+
+class DeviceTaskGraphTestCase(unittest.TestCase):
+    """TestCase class for DeviceTaskGraph."""
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.det_names = ['R22_S00', 'R22_S11', 'R10_S11']
+
+    def tearDown(self):
+        shutil.rmtree(self.outdir)
+
+    def _read_log(self):
+        with open(os.path.join(self.outdir, 'log.txt')) as fd:
+            return [tuple(_.split()) for _ in fd]
+
+    def _make_graph(self, fail_on=(), die_on=()):
+        graph = DeviceTaskGraph()
+        graph.add_task('bias', _Task(self.outdir, 'bias'), self.det_names)
+        graph.add_task('fe55', _Task(self.outdir, 'fe55', fail_on=fail_on,
+                                     die_on=die_on),
+                       self.det_names, depends_on=('bias',))
+        graph.add_task('ptc', _Task(self.outdir, 'ptc'), self.det_names,
+                       depends_on=('bias', 'fe55'))
+        graph.add_task('raft', _Task(self.outdir, 'raft'), ['R22', 'R10'],
+                       depends_on=('ptc',))
+        return graph
+
+    def test_devices_overlap(self):
+        """Test the devices_overlap function."""
+        self.assertTrue(devices_overlap('R22_S11', 'R22_S11'))
+        self.assertTrue(devices_overlap('R22', 'R22_S11'))
+        self.assertTrue(devices_overlap('R22_S11', 'R22'))
+        self.assertFalse(devices_overlap('R22', 'R10_S11'))
+        self.assertFalse(devices_overlap('R22_S11', 'R22_S10'))
+        self.assertFalse(devices_overlap('R10', 'R10S11'))
+
+    def test_prerequisites(self):
+        """Test the per-device prerequisites."""
+        graph = self._make_graph()
+        self.assertEqual(graph.prerequisites(('ptc', 'R22_S11')),
+                         {('bias', 'R22_S11'), ('fe55', 'R22_S11')})
+        self.assertEqual(graph.prerequisites(('raft', 'R22')),
+                         {('ptc', 'R22_S00'), ('ptc', 'R22_S11')})
+        with self.assertRaises(ValueError):
+            graph.add_task('bf', _Task(self.outdir, 'bf'), self.det_names,
+                           depends_on=('flat_pairs',))
+
+    def _check_order(self, entries):
+        position = {entry: i for i, entry in enumerate(entries)}
+        graph = self._make_graph()
+        for node in graph.nodes():
+            if node not in position:
+                continue
+            for prereq in graph.prerequisites(node):
+                self.assertLess(position[prereq], position[node])
+
+    def test_run_serial(self):
+        """Test serial execution."""
+        self._make_graph().run(processes=1)
+        entries = self._read_log()
+        self.assertEqual(len(entries), 11)
+        self._check_order(entries)
+
+    def test_run_pool(self):
+        """Test execution in a multiprocessing.Pool."""
+        self._make_graph().run(processes=3)
+        entries = self._read_log()
+        self.assertEqual(len(entries), 11)
+        self._check_order(entries)
+
+    def test_failure_isolation(self):
+        """Test that a failure only stops that device's chain."""
+        graph = self._make_graph(fail_on=('R22_S00',))
+        with self.assertRaises(RuntimeError):
+            graph.run(processes=2)
+        entries = self._read_log()
+        self.assertIn(('ptc', 'R22_S11'), entries)
+        self.assertIn(('raft', 'R10'), entries)
+        self.assertNotIn(('ptc', 'R22_S00'), entries)
+        self.assertNotIn(('raft', 'R22'), entries)
+
+    def test_dead_worker(self):
+        """Test that a node whose worker dies is marked as failed."""
+        graph = self._make_graph(die_on=('R22_S00',))
+        with self.assertRaises(RuntimeError) as context:
+            graph.run(processes=2, interval=0.1)
+        self.assertIn("('fe55', 'R22_S00')", str(context.exception))
+        entries = self._read_log()
+        self.assertIn(('raft', 'R10'), entries)
+        self.assertNotIn(('ptc', 'R22_S00'), entries)
+        self.assertNotIn(('raft', 'R22'), entries)
+
+    def test_run_by_task(self):
+        """Test running each task over its devices with a run_pool."""
+        calls = []
+        def run_pool(task_func, device_names, on_complete=None):
+            calls.append((task_func.name, device_names))
+            for device_name in device_names:
+                try:
+                    task_func(device_name)
+                except RuntimeError:
+                    on_complete(device_name, False)
+                else:
+                    on_complete(device_name, True)
+        graph = self._make_graph(fail_on=('R22_S00',))
+        with self.assertRaises(RuntimeError):
+            graph.run_by_task(run_pool)
+        self.assertEqual(calls, [('bias', self.det_names),
+                                 ('fe55', self.det_names),
+                                 ('ptc', ['R22_S11', 'R10_S11']),
+                                 ('raft', ['R10'])])
+        self._check_order(self._read_log())
+
+
+if __name__ == '__main__':
+    unittest.main()
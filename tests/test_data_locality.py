@@ -0,0 +1,68 @@
+"""
+Unit tests for the data_locality module.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from data_locality import read_device_hosts, LocalityQueues
+
+
+class DataLocalityTestCase(unittest.TestCase):
+    """TestCase class for read_device_hosts and LocalityQueues."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.device_map_file = os.path.join(self.tmpdir,
+                                            'device_list_map.json')
+        with open(self.device_map_file, 'w') as output:
+            json.dump({'host1': ['R22_S00', 'R22_S01', 'R22_S02'],
+                       'host2': ['R22_S11', 'R10_S00'],
+                       'host3': ['R30_S00']}, output)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_device_hosts(self):
+        """Test finding the hosts with the staged data."""
+        device_hosts = read_device_hosts(
+            ['R22_S00', 'R22_S11:3', 'R22', 'R30_S00', 'R40_S00'],
+            self.device_map_file, hosts=['host1', 'host2'])
+        self.assertEqual(device_hosts, {'R22_S00': 'host1',
+                                        'R22_S11:3': 'host2',
+                                        'R22': 'host1'})
+        self.assertEqual(read_device_hosts(
+            ['R22_S00'], os.path.join(self.tmpdir, 'missing.json')), {})
+
+    def test_queues(self):
+        """Test that hosts steal devices only when they are idle."""
+        devices = ['a1', 'a2', 'a3', 'a4', 'b1', 'x']
+        device_hosts = {'a1': 'A', 'a2': 'A', 'a3': 'A', 'a4': 'A',
+                        'b1': 'B'}
+        queues = LocalityQueues(devices, device_hosts, {'A': 2, 'B': 2})
+        self.assertEqual(sorted(queues.launch()),
+                         [('a1', 'A'), ('a2', 'A'), ('b1', 'B'),
+                          ('x', 'B')])
+        self.assertEqual(len(queues), 2)
+        self.assertEqual(queues.launch(), [])
+        queues.done('B')
+        # B has run out of its own devices, so it takes the last one
+        # queued for A.
+        self.assertEqual(queues.launch(), [('a4', 'B')])
+        self.assertEqual(queues.stolen, {'a4': 'A'})
+        queues.done('A')
+        self.assertEqual(queues.launch(), [('a3', 'A')])
+        self.assertEqual(len(queues), 0)
+
+    def test_max_running(self):
+        """Test the limit on the total number of running tasks."""
+        queues = LocalityQueues(['a1', 'a2', 'b1'], {'a1': 'A', 'a2': 'A',
+                                                     'b1': 'B'},
+                                {'A': 4, 'B': 4}, max_running=2)
+        self.assertEqual(queues.launch(), [('a1', 'A'), ('b1', 'B')])
+        queues.done('B')
+        self.assertEqual(queues.launch(), [('a2', 'A')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+"""
+Unit tests for the device_executors module.
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from device_executors import ResourceHints, InProcessExecutor, \
+    MultiprocessingExecutor, SshExecutor, run_device_tasks
+from host_selection import HostStatus, LoadAwareHosts
+from task_failures import TaskFailedError
+
+
+class _Task:
+    """Pickleable task that fails or sleeps for some devices."""
+    def __init__(self, outdir, fail_on=(), sleep_on=()):
+        self.outdir = outdir
+        self.fail_on = fail_on
+        self.sleep_on = sleep_on
+
+    def __call__(self, device_name):
+        with open(os.path.join(self.outdir, 'log.txt'), 'a') as output:
+            output.write(f'{device_name} {os.getpid()}\n')
+        if device_name in self.fail_on:
+            raise RuntimeError(f'failed for {device_name}')
+        if device_name in self.sleep_on:
+            time.sleep(30)
+        return device_name.lower()
+
+
+class DeviceExecutorsTestCase(unittest.TestCase):
+    """TestCase class for the executors and run_device_tasks."""
+    def setUp(self):
+        self.outdir = tempfile.mkdtemp()
+        self.env = dict(os.environ)
+        os.environ.update(
+            LCATR_USE_TASK_HISTORY='False', LCATR_RETRY_BACKOFF='0',
+            LCATR_FAILURE_REPORT=os.path.join(self.outdir, 'failures.jsonl'))
+        self.devices = ['R22_S00', 'R22_S11', 'R10_S11']
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.env)
+        shutil.rmtree(self.outdir)
+
+    def _read_log(self):
+        with open(os.path.join(self.outdir, 'log.txt')) as fd:
+            return [_.split() for _ in fd]
+
+    def test_in_process(self):
+        """Test running tasks in threads with retries."""
+        task = _Task(self.outdir, fail_on=('R22_S11',))
+        outcomes = []
+        with self.assertRaises(TaskFailedError) as context:
+            run_device_tasks(task, self.devices, backend='in_process',
+                             max_retries=2,
+                             on_complete=lambda *_: outcomes.append(_))
+        self.assertEqual(list(context.exception.failures), ['R22_S11'])
+        self.assertEqual(sorted(outcomes), [('R10_S11', True),
+                                            ('R22_S00', True),
+                                            ('R22_S11', False)])
+        self.assertEqual([_[0] for _ in self._read_log()].count('R22_S11'),
+                         3)
+        with open(os.environ['LCATR_FAILURE_REPORT']) as fd:
+            self.assertEqual([json.loads(_)['final'] for _ in fd],
+                             [False, False, True])
+
+    def test_multiprocessing(self):
+        """Test running tasks in forked processes with a walltime."""
+        task = _Task(self.outdir, sleep_on=('R10_S11',))
+        executor = MultiprocessingExecutor(processes=2, memory_budget=None)
+        t0 = time.time()
+        with self.assertRaises(TaskFailedError) as context:
+            run_device_tasks(task, self.devices, walltime=2,
+                             executor=executor)
+        self.assertLess(time.time() - t0, 20)
+        self.assertTrue(context.exception.failures['R10_S11'].timed_out)
+        pids = {_[1] for _ in self._read_log()}
+        self.assertEqual(len(pids), 3)
+        self.assertNotIn(str(os.getpid()), pids)
+        self.assertEqual(sorted(executor.run_times), ['R22_S00', 'R22_S11'])
+        self.assertEqual(run_device_tasks(task, self.devices[:2],
+                                          executor=executor),
+                         ['r22_s00', 'r22_s11'])
+
+    def test_admission(self):
+        """Test that memory hints limit the concurrent tasks."""
+        executor = InProcessExecutor(processes=4, memory_budget=8)
+        running = []
+        max_running = []
+        def task(device_name):
+            running.append(device_name)
+            max_running.append(len(running))
+            time.sleep(0.1)
+            running.remove(device_name)
+        async def run():
+            hints = ResourceHints(memory=3)
+            futures = [executor.submit(task, _, hints)
+                       for _ in self.devices + ['R22_S22']]
+            async for future in executor.as_completed(futures):
+                self.assertIsNone(future.result())
+        asyncio.run(run())
+        executor.close()
+        self.assertEqual(max(max_running), 2)
+
+    def test_ssh_host_reservation(self):
+        """Test that ssh tasks wait for a host with room for them."""
+        executor = SshExecutor(cwd=self.outdir)
+        remote_hosts = LoadAwareHosts(
+            hosts=['a', 'b'], probe=lambda _: HostStatus(0, 8, 8, 100),
+            mem_per_task=2, min_scratch_free=0)
+        async def run():
+            hosts = [await executor.reserve_host(remote_hosts)
+                     for _ in range(6)]
+            self.assertEqual(sorted(hosts), ['a']*3 + ['b']*3)
+            waiting = asyncio.create_task(
+                executor.reserve_host(remote_hosts))
+            await asyncio.sleep(0.1)
+            self.assertFalse(waiting.done())
+            hosts.remove('b')
+            await executor.release_host(remote_hosts, 'b')
+            self.assertEqual(await asyncio.wait_for(waiting, 5), 'b')
+            for host in hosts:
+                await executor.release_host(remote_hosts, host)
+            self.assertEqual(dict(remote_hosts.assigned), dict(a=0, b=1))
+        asyncio.run(run())
+        executor.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Unit tests for the device placement functions of the ssh_dispatcher.
+"""
+import itertools
+import unittest
+from ssh_dispatcher import place_devices, group_by_raft, raft_boundary, \
+    whole_rafts
+
+
+class DevicePlacementTestCase(unittest.TestCase):
+    """TestCase class for place_devices and the raft batching."""
+    def setUp(self):
+        self.devices = [f'{raft}_S{i}{j}' for raft in ('R01', 'R02', 'R03')
+                        for i in range(3) for j in range(3)]
+        self.devices.append('R22_S11')
+
+    def tearDown(self):
+        pass
+
+    def test_device_policy(self):
+        """Test that devices are placed cyclically by default."""
+        host_map = place_devices(self.devices,
+                                 itertools.cycle(['host1', 'host2']),
+                                 policy='device')
+        self.assertEqual(list(host_map.values())[:3],
+                         ['host1', 'host2', 'host1'])
+
+    def test_raft_policy(self):
+        """Test that the devices of each raft share a host."""
+        hosts = ['host1', 'host2']
+        raft_hosts = dict()
+        host_map = place_devices(self.devices, itertools.cycle(hosts),
+                                 policy='raft', raft_hosts=raft_hosts)
+        self.assertEqual(list(host_map), self.devices)
+        for device, host in host_map.items():
+            self.assertEqual(host, raft_hosts[device.split('_')[0]])
+        self.assertEqual(sorted(raft_hosts), ['R01', 'R02', 'R03', 'R22'])
+        self.assertEqual(set(raft_hosts.values()), set(hosts))
+
+    def test_unplaced_devices(self):
+        """Test that devices without a host are left out."""
+        hosts = itertools.chain(['host1', 'host2'], itertools.repeat(None))
+        host_map = place_devices(self.devices, hosts, policy='raft')
+        self.assertEqual(sorted(set(_.split('_')[0] for _ in host_map)),
+                         ['R01', 'R02'])
+        hosts = itertools.chain(['host1'], itertools.repeat(None))
+        host_map = place_devices(self.devices, hosts, policy='device')
+        self.assertEqual(host_map, {self.devices[0]: 'host1'})
+
+    def test_raft_batches(self):
+        """Test that batches contain whole rafts."""
+        devices = group_by_raft(['R01_S00', 'R02_S00', 'R01_S11:3',
+                                 'R02_S11', 'R03'])
+        self.assertEqual(devices, ['R01_S00', 'R01_S11:3', 'R02_S00',
+                                   'R02_S11', 'R03'])
+        self.assertEqual(raft_boundary(devices, 3), 4)
+        self.assertEqual(raft_boundary(devices, 0), 0)
+        self.assertEqual(whole_rafts(devices, 3), 2)
+        self.assertEqual(whole_rafts(devices, 1), 2)
+        self.assertEqual(whole_rafts(devices, 10), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
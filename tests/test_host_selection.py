@@ -0,0 +1,169 @@
+"""
+Unit tests for the host_selection module.
+"""
+import os
+import tempfile
+import unittest
+from host_selection import HostStatus, SshHostProbe, LoadAwareHosts, \
+    worker_node_names, probe_hosts, workers_per_host
+
+
+class StubProbe:
+    """Probe returning fixed host statuses."""
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = 0
+
+    def __call__(self, host):
+        self.calls += 1
+        status = self.statuses[host]
+        if status is None:
+            raise RuntimeError(f'{host} is down')
+        return status
+
+
+class LoadAwareHostsTestCase(unittest.TestCase):
+    """TestCase class for LoadAwareHosts."""
+    def setUp(self):
+        self.statuses = {'host1': HostStatus(0, 4, 64, 100),
+                         'host2': HostStatus(2, 4, 64, 100),
+                         'host3': HostStatus(0, 8, 64, 5),
+                         'host4': None}
+
+    def tearDown(self):
+        pass
+
+    def test_parse(self):
+        """Test parsing of the remote probe output."""
+        output = ('3.50 2.10 1.00 2/500 1234\n'
+                  '28\n'
+                  'MemAvailable:   16777216 kB\n'
+                  '/dev/sda1 1000 500 52428800 1% /scratch\n')
+        self.assertEqual(SshHostProbe.parse(output),
+                         HostStatus(3.5, 28, 16., 50.))
+
+    def test_placement(self):
+        """Test that tasks go to the least utilized usable hosts."""
+        probe = StubProbe(self.statuses)
+        hosts = LoadAwareHosts(hosts=sorted(self.statuses), probe=probe,
+                               min_scratch_free=20)
+        # host3 has too little scratch space and host4 is down.
+        self.assertEqual(hosts.hosts, ['host1', 'host2'])
+        self.assertEqual(hosts.num_hosts, 2)
+        placements = [next(hosts) for _ in range(6)]
+        # host2 has a load of 2, so host1 gets two tasks before host2
+        # gets any.
+        self.assertEqual(placements[:2], ['host1', 'host1'])
+        self.assertEqual(placements.count('host1'), 4)
+        self.assertEqual(placements.count('host2'), 2)
+
+        # Refreshing re-probes the hosts and clears the assignments.
+        hosts.refresh()
+        self.assertEqual(probe.calls, 8)
+        self.assertEqual(next(hosts), 'host1')
+
+    def test_reserve(self):
+        """Test placing groups of tasks on one host."""
+        statuses = {'host1': HostStatus(0, 16, 64, 100),
+                    'host2': HostStatus(4, 16, 64, 100)}
+        hosts = LoadAwareHosts(hosts=['host1', 'host2'],
+                               probe=StubProbe(statuses), mem_per_task=2,
+                               min_scratch_free=20)
+        self.assertEqual(hosts.reserve(9), 'host1')
+        self.assertEqual(hosts.reserve(9), 'host2')
+        self.assertEqual(hosts.reserve(4, host='host2'), 'host2')
+        self.assertEqual(hosts.reserve(4, host='host3'), 'host1')
+        self.assertEqual(hosts.assigned, {'host1': 13, 'host2': 13})
+
+    def test_memory_limit(self):
+        """Test that memory bounds the placements on a host."""
+        statuses = {'host1': HostStatus(0, 32, 4, 100),
+                    'host2': HostStatus(0, 4, 64, 100)}
+        hosts = LoadAwareHosts(hosts=['host1', 'host2'],
+                               probe=StubProbe(statuses), mem_per_task=2,
+                               min_scratch_free=20)
+        placements = [next(hosts) for _ in range(4)]
+        self.assertEqual(placements.count('host1'), 1)
+
+    def test_memory_capacity(self):
+        """Test that no host is given more tasks than fit in memory."""
+        statuses = {'host1': HostStatus(0, 8, 8, 100),
+                    'host2': HostStatus(0, 8, 8, 100)}
+        hosts = LoadAwareHosts(hosts=['host1', 'host2'],
+                               probe=StubProbe(statuses), mem_per_task=3,
+                               min_scratch_free=20)
+        placements = [next(hosts) for _ in range(5)]
+        self.assertEqual(placements[:4].count('host1'), 2)
+        self.assertIsNone(placements[4])
+        self.assertIsNone(hosts.reserve(1, host='host2'))
+        # A host with no tasks takes a whole group.
+        hosts.refresh()
+        self.assertEqual(hosts.reserve(9, host='host2'), 'host2')
+        self.assertEqual(hosts.reserve(2, host='host2'), 'host1')
+
+    def test_capacity(self):
+        """Test the number of tasks that fit on the hosts."""
+        statuses = {'host1': HostStatus(0, 32, 20, 100),
+                    'host2': HostStatus(0, 4, 64, 100)}
+        hosts = LoadAwareHosts(hosts=['host1', 'host2'],
+                               probe=StubProbe(statuses), mem_per_task=4,
+                               min_scratch_free=20)
+        # host1 is limited by memory and host2 by its cores.
+        self.assertEqual(hosts.capacity(), 4 + 4)
+        next(hosts)
+        # Without force, the hosts are only re-probed if tasks were
+        # assigned since the last refresh.
+        calls = hosts.probe.calls
+        hosts.refresh(force=False)
+        hosts.refresh(force=False)
+        self.assertEqual(hosts.probe.calls, calls + 2)
+
+    def test_fallback(self):
+        """Test that all hosts are used if none pass the checks."""
+        hosts = LoadAwareHosts(hosts=['host3', 'host4'],
+                               probe=StubProbe(self.statuses),
+                               min_scratch_free=20)
+        self.assertEqual(hosts.hosts, ['host3', 'host4'])
+        self.assertEqual([next(hosts) for _ in range(4)],
+                         ['host3', 'host4', 'host3', 'host4'])
+
+
+class WorkerNodesTestCase(unittest.TestCase):
+    """TestCase class for the parsl worker node discovery functions."""
+    def setUp(self):
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_PARSL_NODES', 'LCATR_PARSL_NODE_FILE',
+                     'LCATR_PARSL_MEM_PER_WORKER')}
+
+    def tearDown(self):
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_node_names(self):
+        """Test reading the node list from the environment or a file."""
+        os.environ['LCATR_PARSL_NODES'] = 'host1,host2 host3_host1'
+        self.assertEqual(worker_node_names(), ['host1', 'host2', 'host3'])
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as node_file:
+            node_file.write('host4\n# host5\nhost6  # big memory\n\n')
+            node_file.flush()
+            os.environ['LCATR_PARSL_NODE_FILE'] = node_file.name
+            self.assertEqual(worker_node_names(), ['host4', 'host6'])
+
+    def test_workers(self):
+        """Test sizing the workers from the probed resources."""
+        statuses = {'host1': HostStatus(0, 28, 120, 100),
+                    'host2': HostStatus(0, 64, 40, 100),
+                    'host3': None}
+        probed = probe_hosts(sorted(statuses), probe=StubProbe(statuses))
+        self.assertEqual(sorted(probed), ['host1', 'host2'])
+        self.assertEqual(workers_per_host(probed),
+                         {'host1': 28, 'host2': 18})
+        os.environ['LCATR_PARSL_MEM_PER_WORKER'] = '100'
+        self.assertEqual(workers_per_host(probed),
+                         {'host1': 1, 'host2': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+"""
+Unit tests for the memory_admission module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from memory_admission import TaskMemoryHistory, task_peak_memory, \
+    available_memory, memory_limited_processes, reset_peak_rss, peak_rss
+
+
+class MemoryAdmissionTestCase(unittest.TestCase):
+    """TestCase class for the memory_admission functions."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.tmpdir, 'task_peak_memory.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_task_peak_memory(self):
+        """Test the measured, declared, and default peak memory."""
+        history = TaskMemoryHistory(self.history_file)
+        self.assertEqual(task_peak_memory('flat_pairs_jh_task'), 6)
+        self.assertEqual(task_peak_memory('read_noise_jh_task',
+                                          history=history), 2)
+        history.record('flat_pairs_jh_task', 'R22_S11', 3)
+        history.record('flat_pairs_jh_task', 'R22_S11', 5)
+        history.record('flat_pairs_jh_task', 'R10_S00', 10)
+        history.save()
+        history = TaskMemoryHistory(self.history_file)
+        self.assertEqual(history.peak('flat_pairs_jh_task', ['R22_S11']), 5)
+        self.assertEqual(history.peak('flat_pairs_jh_task', ['R01_S00']), 10)
+        self.assertIsNone(history.peak('ptc_jh_task', ['R22_S11']))
+        self.assertAlmostEqual(task_peak_memory('flat_pairs_jh_task',
+                                                ['R22_S11'], history), 6)
+        with mock.patch.dict(os.environ, {'LCATR_TASK_MEMORY_GB': '1.5'}):
+            self.assertEqual(task_peak_memory('flat_pairs_jh_task',
+                                              ['R22_S11'], history), 1.5)
+
+    def test_memory_limited_processes(self):
+        """Test limiting the number of processes by available memory."""
+        self.assertEqual(memory_limited_processes(16, 4, mem_available=40), 9)
+        self.assertEqual(memory_limited_processes(4, 4, mem_available=400), 4)
+        self.assertEqual(memory_limited_processes(4, 40, mem_available=10), 1)
+        meminfo = os.path.join(self.tmpdir, 'meminfo')
+        with open(meminfo, 'w') as fd:
+            fd.write('MemTotal:       65536000 kB\n'
+                     'MemAvailable:   20971520 kB\n')
+        self.assertEqual(available_memory(meminfo), 20)
+        self.assertIsNone(available_memory(meminfo + '_missing'))
+
+    def test_peak_rss(self):
+        """Test measuring the peak memory of the current process."""
+        reset_peak_rss()
+        baseline = peak_rss()
+        data = bytearray(200*1024**2)
+        self.assertGreater(peak_rss() - baseline, 0.15)
+        del data
+
+
+if __name__ == '__main__':
+    unittest.main()
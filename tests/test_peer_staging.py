@@ -0,0 +1,78 @@
+"""
+Unit tests for the peer_staging module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from copy_engine import CopyEngine, is_current
+from peer_staging import peer_index_dir, PeerIndex, PeerFetcher
+
+
+class PeerStagingTestCase(unittest.TestCase):
+    """TestCase class for the peer_staging module."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index_dir = os.environ.pop('LCATR_PEER_INDEX_DIR', None)
+        self.src = os.path.join(self.tmpdir, 'gpfs', 'bias.fits')
+        os.makedirs(os.path.dirname(self.src))
+        with open(self.src, 'wb') as output:
+            output.write(os.urandom(5000))
+        # Scratch areas of two hosts.
+        self.scratch = {host: os.path.join(self.tmpdir, host, 'bias.fits')
+                        for host in ('dc01', 'dc02')}
+        self.index = PeerIndex(os.path.join(self.tmpdir, 'index'))
+        self.transfers = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        os.environ.pop('LCATR_PEER_INDEX_DIR', None)
+        if self.index_dir is not None:
+            os.environ['LCATR_PEER_INDEX_DIR'] = self.index_dir
+
+    def _transfer(self, host, remote_path, local_path):
+        self.transfers.append((host, remote_path))
+        if not remote_path.startswith(os.path.join(self.tmpdir, host)):
+            return False
+        shutil.copy(remote_path, local_path)
+        return True
+
+    def test_peer_index_dir(self):
+        """Test the per-run index directory."""
+        self.assertIsNone(peer_index_dir(1234))
+        os.environ['LCATR_PEER_INDEX_DIR'] = '/gpfs/peers'
+        self.assertEqual(peer_index_dir(1234), '/gpfs/peers/1234')
+
+    def test_fetch_from_peer(self):
+        """Test fetching a file staged on another host."""
+        files = {self.src: self.scratch['dc01']}
+        CopyEngine(fetch=PeerFetcher(self.index, 'dc01',
+                                     self._transfer)).copy(files)
+        self.assertEqual(self.transfers, [])
+        self.index.update('dc01', files)
+
+        fetcher = PeerFetcher(self.index, 'dc02', self._transfer)
+        CopyEngine(fetch=fetcher).copy({self.src: self.scratch['dc02']})
+        self.assertEqual(self.transfers, [('dc01', self.scratch['dc01'])])
+        self.assertEqual(fetcher.fetched, 1)
+        self.assertTrue(is_current(self.src, self.scratch['dc02'],
+                                   checksum=True))
+
+    def test_fall_back(self):
+        """Test copying from the file server if no peer has the file."""
+        self.index.update('dc01', {self.src: self.scratch['dc01']})
+        # The copy on dc01 has been evicted.
+        self.index.update('dc03', {self.src: '/missing/bias.fits'})
+        self.index.update('dc01', {}, removed=[self.scratch['dc01']])
+        self.assertEqual(self.index.host_files('dc01'), {})
+
+        fetcher = PeerFetcher(self.index, 'dc02', self._transfer)
+        CopyEngine(fetch=fetcher).copy({self.src: self.scratch['dc02']})
+        self.assertEqual(self.transfers, [('dc03', '/missing/bias.fits')])
+        self.assertEqual(fetcher.fetched, 0)
+        self.assertTrue(is_current(self.src, self.scratch['dc02']))
+        self.assertFalse(os.path.isfile(self.scratch['dc02'] + '.part'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+"""
+Unit tests for the rate_limiter module.
+"""
+import unittest
+from rate_limiter import TokenBucket
+
+
+class FakeClock:
+    """Clock that only advances when sleep is called."""
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, dt):
+        self.now += dt
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """TestCase class for TokenBucket."""
+    def setUp(self):
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        pass
+
+    def test_rate(self):
+        """Test that acquisitions are throttled to the given rate."""
+        bucket = TokenBucket(5, capacity=2, clock=self.clock,
+                             sleep=self.clock.sleep)
+        # The initial burst is free.
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        for _ in range(10):
+            bucket.acquire()
+        self.assertAlmostEqual(self.clock.now, 2.)
+        self.assertGreater(bucket.try_acquire(), 0)
+
+    def test_large_request(self):
+        """Test requests larger than the bucket capacity."""
+        bucket = TokenBucket(10, capacity=10, clock=self.clock,
+                             sleep=self.clock.sleep)
+        self.assertEqual(bucket.acquire(30), 0)
+        # The bucket is in debt for the excess 20 tokens plus the 10
+        # needed for the next request.
+        self.assertAlmostEqual(bucket.acquire(10), 3.)
+
+    def test_unlimited(self):
+        """Test that a bucket without a rate never waits."""
+        bucket = TokenBucket(None, clock=self.clock, sleep=self.clock.sleep)
+        for _ in range(100):
+            self.assertEqual(bucket.acquire(1000), 0)
+        self.assertEqual(self.clock.now, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
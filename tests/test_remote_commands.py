@@ -0,0 +1,60 @@
+"""
+Unit tests for the remote_commands module.
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from remote_commands import LocalCommandRunner, SshCommandRunner
+
+
+class CommandRunnerTestCase(unittest.TestCase):
+    """TestCase class for the command runners."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_local_runner(self):
+        """Test running shell commands with the local runner."""
+        runner = LocalCommandRunner()
+        outfile = os.path.join(self.tmpdir, 'out.txt')
+        self.assertEqual(runner.run('host1', f'echo $((1 + 2)) > {outfile}'),
+                         0)
+        with open(outfile) as fd:
+            self.assertEqual(fd.read().strip(), '3')
+        self.assertRaises(subprocess.CalledProcessError, runner.run,
+                          'host1', 'exit 3')
+        self.assertEqual(runner.run('host1', 'exit 3', check=False), 3)
+
+    def test_max_sessions(self):
+        """Test the limit on concurrent commands for each host."""
+        runner = LocalCommandRunner(max_sessions=2)
+        hosts = ['host1']*4 + ['host2']*2
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            futures = [executor.submit(runner.run, host, 'sleep 0.3')
+                       for host in hosts]
+        _ = [_.result() for _ in futures]
+        # host1 needs two rounds of two commands, and host2 runs
+        # concurrently with the first round.
+        dt = time.time() - t0
+        self.assertGreater(dt, 0.55)
+        self.assertLess(dt, 0.85)
+
+    def test_ssh_command(self):
+        """Test the ssh command line for a multiplexed session."""
+        runner = SshCommandRunner(max_sessions=4, control_dir=self.tmpdir)
+        command = runner.command('lsst-dc01', 'cd /tmp; ls')
+        self.assertEqual(command[0], 'ssh')
+        self.assertEqual(command[-2:], ['lsst-dc01', 'cd /tmp; ls'])
+        self.assertIn(f'ControlPath={self.tmpdir}/%C', command)
+        self.assertIn('ControlMaster=no', command)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+"""
+Unit tests for the staging_cache module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from staging_cache import StagingCache, scratch_budget
+
+
+class StagingCacheTestCase(unittest.TestCase):
+    """TestCase class for the StagingCache class."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.budget = os.environ.pop('LCATR_SCRATCH_BUDGET_GB', None)
+        self.src_dir = os.path.join(self.tmpdir, 'src')
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        os.makedirs(self.src_dir)
+        self.copies = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        os.environ.pop('LCATR_SCRATCH_BUDGET_GB', None)
+        if self.budget is not None:
+            os.environ['LCATR_SCRATCH_BUDGET_GB'] = self.budget
+
+    def _copy(self, files):
+        for src, dest in files.items():
+            self.copies.append(src)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copy(src, dest)
+
+    def _files(self, names, size=100):
+        files = dict()
+        for name in names:
+            src = os.path.join(self.src_dir, name)
+            if not os.path.isfile(src):
+                with open(src, 'w') as output:
+                    output.write('x'*size)
+            files[src] = os.path.join(self.cache_dir, 'frame', name)
+        return files
+
+    def _stage(self, names, jobs, budget=None, job=None):
+        files = self._files(names)
+        needed_by = {dest: jobs[os.path.basename(dest)]
+                     for dest in files.values()}
+        with StagingCache(self.cache_dir, budget=budget,
+                          copy=self._copy, job=job) as cache:
+            cache.release(set().union(*needed_by.values()))
+            cache.stage(files, needed_by)
+            return set(os.path.basename(_) for _ in cache.index)
+
+    def test_scratch_budget(self):
+        """Test the disk budget setting."""
+        self.assertIsNone(scratch_budget())
+        os.environ['LCATR_SCRATCH_BUDGET_GB'] = '2'
+        self.assertEqual(scratch_budget(), 2*1024**3)
+
+    def test_shared_files(self):
+        """Test that files needed by later jobs are copied once."""
+        cached = self._stage(['flat0.fits', 'flat1.fits'],
+                             {'flat0.fits': {'ptc', 'flat_pairs'},
+                              'flat1.fits': {'ptc', 'flat_pairs'}})
+        self.assertEqual(cached, {'flat0.fits', 'flat1.fits'})
+        self.assertEqual(len(self.copies), 2)
+
+        # The flats are still needed by flat_pairs, so they aren't
+        # copied again, and with no budget, files no job needs are
+        # evicted.
+        cached = self._stage(['flat0.fits', 'flat1.fits', 'bias.fits'],
+                             {'flat0.fits': {'flat_pairs'},
+                              'flat1.fits': {'flat_pairs'},
+                              'bias.fits': {'flat_pairs'}})
+        self.assertEqual(len(self.copies), 3)
+        cached = self._stage(['dark.fits'], {'dark.fits': {'dark'}})
+        self.assertEqual(cached, {'dark.fits'})
+        self.assertFalse(os.path.isfile(
+            os.path.join(self.cache_dir, 'frame', 'flat0.fits')))
+
+    def test_lru_eviction(self):
+        """Test eviction in least recently used order under a budget."""
+        self._stage(['a.fits'], {'a.fits': {'job1'}}, budget=300)
+        self._stage(['b.fits'], {'b.fits': {'job2', 'job3'}}, budget=300)
+        self._stage(['c.fits'], {'c.fits': {'job3'}}, budget=300)
+        # a.fits is no longer needed, so it is evicted first, and then
+        # b.fits, which is needed by job3, as the least recently used.
+        cached = self._stage(['d.fits', 'e.fits'],
+                             {'d.fits': {'job3'}, 'e.fits': {'job3'}},
+                             budget=300)
+        self.assertEqual(cached, {'c.fits', 'd.fits', 'e.fits'})
+
+        # With a budget, unneeded files are kept until space is needed.
+        cached = self._stage(['f.fits'], {'f.fits': {'job4'}}, budget=1000)
+        self.assertEqual(cached, {'c.fits', 'd.fits', 'e.fits', 'f.fits'})
+
+
+    def test_pinned_files(self):
+        """Test that the current job's files are kept over budget."""
+        self._stage(['old.fits'], {'old.fits': {'dark'}}, budget=150,
+                    job='dark')
+        # The ptc inputs for the devices exceed the budget, but the
+        # files staged for the first devices aren't evicted for the
+        # later ones.
+        for name in ('flat0.fits', 'flat1.fits', 'flat2.fits'):
+            cached = self._stage([name], {name: {'ptc'}}, budget=150,
+                                 job='ptc')
+        self.assertEqual(cached, {'flat0.fits', 'flat1.fits', 'flat2.fits'})
+        # Once ptc is released, its files can be evicted for the next
+        # job, least recently used first.
+        cached = self._stage(['flat3.fits'], {'flat3.fits': {'bf'}},
+                             budget=250, job='bf')
+        self.assertEqual(cached, {'flat2.fits', 'flat3.fits'})
+
+
+if __name__ == '__main__':
+    unittest.main()
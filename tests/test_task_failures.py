@@ -0,0 +1,59 @@
+"""
+Unit tests for the task_failures module.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from task_failures import TaskFailure, TaskFailedError, FailureReport, \
+    max_task_retries, retry_delay
+
+
+class TaskFailuresTestCase(unittest.TestCase):
+    """TestCase class for the task_failures module."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_MAX_RETRIES', 'LCATR_RETRY_BACKOFF')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_retry_settings(self):
+        """Test the number of retries and the backoff delays."""
+        self.assertEqual(max_task_retries(), 1)
+        self.assertEqual(max_task_retries(3), 3)
+        os.environ['LCATR_MAX_RETRIES'] = '0'
+        self.assertEqual(max_task_retries(3), 0)
+        self.assertEqual([retry_delay(_) for _ in (1, 2, 3)], [10, 20, 40])
+        os.environ['LCATR_RETRY_BACKOFF'] = '100'
+        self.assertEqual(retry_delay(4, max_delay=600), 600)
+
+    def test_report(self):
+        """Test writing the failure report."""
+        report_file = os.path.join(self.tmpdir, 'task_failures.jsonl')
+        report = FailureReport('bias_frame_task', report_file=report_file)
+        failure = TaskFailure('R22_S11', "OSError('stale file handle')",
+                              'Traceback ...', False)
+        report.record(failure, 1, False)
+        report.record(failure, 2, True)
+        with open(report_file) as fd:
+            entries = [json.loads(_) for _ in fd]
+        self.assertEqual([(_['attempt'], _['final']) for _ in entries],
+                         [(1, False), (2, True)])
+        self.assertEqual(entries[0]['task'], 'bias_frame_task')
+        self.assertEqual(entries[0]['device_name'], 'R22_S11')
+        self.assertEqual(entries[0]['traceback'], 'Traceback ...')
+
+        error = TaskFailedError('bias_frame_task', {'R22_S11': failure})
+        self.assertIsInstance(error, RuntimeError)
+        self.assertIn('R22_S11', str(error))
+
+
+if __name__ == '__main__':
+    unittest.main()
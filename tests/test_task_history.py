@@ -0,0 +1,106 @@
+"""
+Unit tests for the task_history module.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from task_history import TaskRuntimeHistory, device_type, task_name, \
+    history_key
+
+
+class TaskRuntimeHistoryTestCase(unittest.TestCase):
+    """TestCase class for TaskRuntimeHistory."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.history_file = os.path.join(self.tmpdir, 'lcatr',
+                                         'task_runtimes.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_device_type(self):
+        """Test the device_type and task_name functions."""
+        self.assertEqual(device_type('R22'), 'raft')
+        self.assertEqual(device_type('R00_SW0'), 'corner')
+        self.assertEqual(device_type('R44_SG1'), 'corner')
+        self.assertEqual(device_type('R22_S11'), 'science')
+        self.assertEqual(task_name('/a/b/ptc_jh_task.py'), 'ptc_jh_task')
+        self.assertEqual(task_name(device_type), 'device_type')
+
+    def test_record_and_estimate(self):
+        """Test recording, persisting, and estimating wall times."""
+        history = TaskRuntimeHistory(self.history_file, max_entries=3)
+        self.assertIsNone(history.estimate('ptc', 'R22_S11'))
+        for wall_time in (1, 100, 10, 20):
+            history.record('ptc', 'R22_S11', wall_time)
+        history.record('ptc', 'R00_SW0', 5)
+        history.save()
+
+        history = TaskRuntimeHistory(self.history_file, max_entries=3)
+        # Only the last three values are kept.
+        self.assertEqual(history.estimate('ptc', 'R22_S11'), 20)
+        # Fall back to devices of the same type.
+        self.assertEqual(history.estimate('ptc', 'R10_S00'), 20)
+        self.assertEqual(history.estimate('ptc', 'R04_SW1'), 5)
+        # Fall back to all devices for the task.
+        self.assertEqual(history.estimate('ptc', 'R22'), 15)
+
+    def test_amp_work_items(self):
+        """Test that amp-level work items are kept separately."""
+        self.assertEqual(history_key('bias_frame_jh_task', 'R22_S11'),
+                         'bias_frame_jh_task')
+        self.assertEqual(history_key('bias_frame_jh_task', 'R22_S11:3'),
+                         'bias_frame_jh_task:amp')
+        history = TaskRuntimeHistory(self.history_file)
+        history.record('bias_frame_jh_task', 'R22_S11', 160)
+        history.record('bias_frame_jh_task', 'R22_S11:3', 10)
+        history.record('bias_frame_jh_task', 'R22_S11:4', 12)
+        history.save()
+        history = TaskRuntimeHistory(self.history_file)
+        self.assertEqual(sorted(history.wall_times),
+                         ['bias_frame_jh_task', 'bias_frame_jh_task:amp'])
+        self.assertEqual(history.estimate('bias_frame_jh_task', 'R22_S00'),
+                         160)
+        self.assertEqual(history.estimate('bias_frame_jh_task', 'R22_S00:1'),
+                         11)
+
+    def test_merge_on_save(self):
+        """Test that concurrent writers do not clobber each other."""
+        history1 = TaskRuntimeHistory(self.history_file)
+        history2 = TaskRuntimeHistory(self.history_file)
+        history1.record('ptc', 'R22_S11', 10)
+        history2.record('fe55', 'R22_S11', 30)
+        history1.save()
+        history2.save()
+        history = TaskRuntimeHistory(self.history_file)
+        self.assertEqual(history.estimate('ptc', 'R22_S11'), 10)
+        self.assertEqual(history.estimate('fe55', 'R22_S11'), 30)
+
+    def test_order_and_pool_params(self):
+        """Test longest-job-first ordering and pool sizing."""
+        history = TaskRuntimeHistory(self.history_file)
+        devices = ['R00_SW0', 'R22_S00', 'R22_S11', 'R22_S22']
+        self.assertEqual(history.order('ptc', devices), devices)
+        self.assertEqual(history.pool_params('ptc', devices, 8), (4, 1))
+
+        history.record('ptc', 'R00_SW0', 10)
+        history.record('ptc', 'R22_S11', 40)
+        history.record('ptc', 'R22_S22', 30)
+        # R22_S00 has the science CCD median of 35 s.
+        self.assertEqual(history.order('ptc', devices),
+                         ['R22_S11', 'R22_S00', 'R22_S22', 'R00_SW0'])
+        # The pool is never narrower than requested, up to the number
+        # of devices.
+        self.assertEqual(history.pool_params('ptc', devices, 8), (4, 1))
+        self.assertEqual(history.pool_params('ptc', devices, 2), (2, 1))
+
+        devices = [f'R22_S{i}{j}' for i in range(3) for j in range(3)]*4
+        for device in devices:
+            history.record('read_noise', device, 0.1)
+        self.assertEqual(history.pool_params('read_noise', devices, 2),
+                         (2, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Unit tests for the task_timeout module.
+"""
+import os
+import time
+import unittest
+import subprocess
+import multiprocessing
+from task_timeout import TaskTimeoutError, task_walltime, deadline, \
+    run_with_deadline, WorkerWatchdog, dead_workers
+
+
+def _fail(message):
+    raise ValueError(message)
+
+
+class TaskTimeoutTestCase(unittest.TestCase):
+    """TestCase class for the task_timeout functions."""
+    def setUp(self):
+        self.walltime = os.environ.pop('LCATR_TASK_WALLTIME', None)
+
+    def tearDown(self):
+        if self.walltime is None:
+            os.environ.pop('LCATR_TASK_WALLTIME', None)
+        else:
+            os.environ['LCATR_TASK_WALLTIME'] = self.walltime
+
+    def test_task_walltime(self):
+        """Test the walltime setting and its environment override."""
+        self.assertEqual(task_walltime(3600), 3600)
+        self.assertIsNone(task_walltime(None))
+        os.environ['LCATR_TASK_WALLTIME'] = '0'
+        self.assertIsNone(task_walltime(3600))
+        os.environ['LCATR_TASK_WALLTIME'] = '60'
+        self.assertEqual(task_walltime(3600), 60)
+
+    def test_run_with_deadline(self):
+        """Test running functions in a child process with a walltime."""
+        self.assertEqual(run_with_deadline(sum, [1, 2, 3], walltime=10), 6)
+        with self.assertRaises(ValueError):
+            run_with_deadline(_fail, 'oops', walltime=10)
+        t0 = time.time()
+        with self.assertRaises(TaskTimeoutError):
+            run_with_deadline(time.sleep, 30, walltime=0.5)
+        self.assertLess(time.time() - t0, 10)
+
+    def test_deadline(self):
+        """Test the SIGALRM-based deadline."""
+        with deadline(10):
+            time.sleep(0.01)
+        with self.assertRaises(TaskTimeoutError):
+            with deadline(0.2):
+                while True:
+                    pass
+
+    def test_watchdog(self):
+        """Test that workers running past the walltime are killed."""
+        proc = subprocess.Popen(['sleep', '30'])
+        running_tasks = {proc.pid: ('R22_S11', time.time() - 100),
+                         12345678: ('R22_S12', time.time())}
+        watchdog = WorkerWatchdog(running_tasks, 60)
+        self.assertEqual(watchdog.check(), ['R22_S11'])
+        self.assertEqual(proc.wait(timeout=10), -9)
+        self.assertEqual(list(running_tasks), [12345678])
+        self.assertEqual(watchdog.check(), [])
+        self.assertEqual(watchdog.killed, ['R22_S11'])
+
+    def test_dead_workers(self):
+        """Test that workers that died are found and removed."""
+        dead = multiprocessing.Process(target=time.sleep, args=(0,))
+        alive = multiprocessing.Process(target=time.sleep, args=(30,))
+        for proc in (dead, alive):
+            proc.start()
+        dead.join()
+        running_tasks = {dead.pid: ('R22_S11', time.time()),
+                         alive.pid: ('R22_S12', time.time())}
+        try:
+            self.assertEqual(dead_workers(running_tasks),
+                             [(dead.pid, 'R22_S11')])
+            self.assertEqual(list(running_tasks), [alive.pid])
+        finally:
+            alive.kill()
+            alive.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
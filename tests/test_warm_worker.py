@@ -0,0 +1,78 @@
+"""
+Unit tests for the warm_worker module.
+"""
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import warm_worker
+
+WARM_WORKER = warm_worker.__file__
+
+
+class WarmWorkerTestCase(unittest.TestCase):
+    """TestCase class for the warm worker daemon."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket = os.path.join(self.tmpdir, 'ww.sock')
+        self.env = dict(os.environ, LCATR_WARM_WORKER_SOCKET=self.socket)
+        subprocess.check_call([sys.executable, WARM_WORKER, 'start',
+                               '--preload', 'json', '--idle-timeout', '2'],
+                              env=self.env, timeout=30)
+        self.script = os.path.join(self.tmpdir, 'task.py')
+        with open(self.script, 'w') as fd:
+            fd.write('import os, sys\n'
+                     'print("running", sys.argv[1], os.getcwd(), '
+                     'os.environ["LCATR_TEST_VALUE"])\n'
+                     'sys.exit(int(sys.argv[2]))\n')
+        self.log_file = os.path.join(self.tmpdir, 'task.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def submit(self, returncode, wait=True, status_file=None):
+        """Submit the task script via the command-line client."""
+        command = [sys.executable, WARM_WORKER, 'submit', self.script,
+                   'R22_S11', str(returncode)]
+        if wait:
+            command.insert(3, '--wait')
+        if status_file is not None:
+            command[3:3] = ['--status-file', status_file]
+        env = dict(self.env, LCATR_TEST_VALUE='42')
+        with open(self.log_file, 'a') as log:
+            return subprocess.call(command, stdout=log, stderr=log,
+                                   cwd=self.tmpdir, env=env, timeout=30)
+
+    def test_submit(self):
+        """Test running tasks with the daemon."""
+        status_file = os.path.join(self.tmpdir, 'status.json')
+        self.assertEqual(self.submit(0, status_file=status_file), 0)
+        with open(status_file) as fd:
+            status = json.load(fd)
+        self.assertEqual(status['task_id'], 'R22_S11')
+        self.assertEqual(status['status'], 'succeeded')
+        self.assertEqual(self.submit(3), 3)
+        with open(self.log_file) as fd:
+            lines = [_.strip() for _ in fd if _.strip()]
+        self.assertEqual(lines[0], f'running R22_S11 {self.tmpdir} 42')
+        self.assertTrue(lines[1].startswith('Task succeeded on'))
+        self.assertTrue(lines[-1].startswith('Task failed on'))
+
+    def test_unavailable(self):
+        """Test the exit code for an unusable daemon."""
+        env = dict(self.env, LCATR_WARM_WORKER_SOCKET=self.socket + '.none')
+        command = [sys.executable, WARM_WORKER, 'submit', self.script,
+                   'R22_S11', '0']
+        self.assertEqual(subprocess.call(command, env=env,
+                                         stderr=subprocess.DEVNULL,
+                                         timeout=30),
+                         warm_worker.UNAVAILABLE)
+        self.env['EOANALYSISJOBSDIR'] = '/some/other/path'
+        self.assertEqual(self.submit(0), warm_worker.UNAVAILABLE)
+
+
+if __name__ == '__main__':
+    unittest.main()
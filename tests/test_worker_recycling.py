@@ -0,0 +1,63 @@
+"""
+Unit tests for the worker_recycling module.
+"""
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from worker_recycling import worker_max_tasks, worker_max_rss, \
+    current_rss, WorkerMemoryReport
+
+
+class WorkerRecyclingTestCase(unittest.TestCase):
+    """TestCase class for the worker_recycling module."""
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.env = {_: os.environ.pop(_, None) for _ in
+                    ('LCATR_WORKER_MAX_TASKS', 'LCATR_WORKER_MAX_RSS_GB')}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        for key, value in self.env.items():
+            os.environ.pop(key, None)
+            if value is not None:
+                os.environ[key] = value
+
+    def test_settings(self):
+        """Test the recycling thresholds."""
+        self.assertIsNone(worker_max_tasks())
+        self.assertEqual(worker_max_tasks(20), 20)
+        os.environ['LCATR_WORKER_MAX_TASKS'] = '0'
+        self.assertIsNone(worker_max_tasks(20))
+        self.assertIsNone(worker_max_rss())
+        os.environ['LCATR_WORKER_MAX_RSS_GB'] = '3.5'
+        self.assertEqual(worker_max_rss(), 3.5)
+        self.assertGreater(current_rss(), 0)
+
+    def test_report(self):
+        """Test the summary of the memory growth by task."""
+        report_file = os.path.join(self.tmpdir, 'report.json')
+        with open(report_file, 'w') as output:
+            json.dump({'fe55_jh_task': {'devices': 1}}, output)
+        report = WorkerMemoryReport(report_file=report_file)
+        report.record('bias_frame_jh_task', 'R22_S00', 10, 1.0, 1.2)
+        report.record('bias_frame_jh_task', 'R22_S11', 11, 1.0, 1.9)
+        report.record('bias_frame_jh_task', 'R22_S22', 10, 1.2, 1.3)
+        report.record('bias_frame_jh_task', 'R10_S00', 12, None, 1.0)
+        report.recycled('bias_frame_jh_task')
+        report.save()
+        with open(report_file) as fd:
+            summary = json.load(fd)
+        self.assertEqual(summary['fe55_jh_task'], {'devices': 1})
+        summary = summary['bias_frame_jh_task']
+        self.assertEqual(summary['devices'], 3)
+        self.assertEqual(summary['max_growth_device'], 'R22_S11')
+        self.assertAlmostEqual(summary['max_growth'], 0.9)
+        self.assertAlmostEqual(summary['total_growth'], 1.2)
+        self.assertEqual(summary['max_rss'], 1.9)
+        self.assertEqual(summary['recycles'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()